@@ -16,9 +16,15 @@ test_loader = unittest.TestLoader()
 from testsuite.TestPacker import TestPacker
 suite_Packer = test_loader.loadTestsFromTestCase(TestPacker)
 
+from testsuite.TestBandwidthLimiter import TestBandwidthLimiter
+suite_BandwidthLimiter = test_loader.loadTestsFromTestCase(TestBandwidthLimiter)
+
 from testsuite.TestContainer import TestContainer
 suite_Container = test_loader.loadTestsFromTestCase(TestContainer)
 
+from testsuite.TestContainerCache import TestContainerCache
+suite_ContainerCache = test_loader.loadTestsFromTestCase(TestContainerCache)
+
 from testsuite.TestIncrement import TestIncrement
 suite_Increment = test_loader.loadTestsFromTestCase(TestIncrement)
 
@@ -34,6 +40,12 @@ suite_Nodes = test_loader.loadTestsFromTestCase(TestNodes)
 from testsuite.TestExclusionProcessor import TestExclusionProcessor
 suite_Exclusion = test_loader.loadTestsFromTestCase(TestExclusionProcessor)
 
+from testsuite.TestRemoteFSHandler import TestRemoteFSHandler
+suite_RemoteFSHandler = test_loader.loadTestsFromTestCase(TestRemoteFSHandler)
+
+from testsuite.TestRestorePlanner import TestRestorePlanner
+suite_RestorePlanner = test_loader.loadTestsFromTestCase(TestRestorePlanner)
+
 from testsuite.TestStorage import TestStorage
 suite_Storage = test_loader.loadTestsFromTestCase(TestStorage)
 
@@ -50,16 +62,20 @@ from testsuite.TestCompletedNodesDB import TestCompletedNodesDB
 suite_CNDB = test_loader.loadTestsFromTestCase(TestCompletedNodesDB)
 
 suite = unittest.TestSuite([
+  suite_BandwidthLimiter,
   suite_BlockManager,
   suite_BlockSequencer,
   suite_CNDB,
   suite_Container,
+  suite_ContainerCache,
   suite_DB,
   suite_Exclusion,
   suite_Format,
   suite_Increment,
   suite_Nodes,
   suite_Packer,
+  suite_RemoteFSHandler,
+  suite_RestorePlanner,
   suite_Storage,
   suite_StorageManager,
   ])
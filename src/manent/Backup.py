@@ -21,7 +21,10 @@ import ExclusionProcessor
 import IncrementManager
 import Nodes
 import Reporting
+import RestorePlanner
+import Storage
 import StorageManager
+import utils.BandwidthLimiter as BandwidthLimiter
 
 def parse_to_keys(params):
   result = {}
@@ -103,7 +106,7 @@ class Backup:
         for k, v in self.config_db.iteritems():
           print k, '=', v
       elif args[0] == 'set':
-        for key in ['data_path']:
+        for key in ['data_path', 'upload_limit', 'download_limit']:
           if params.has_key(key):
             self.config_db[key] = params[key]
       elif args[0] == 'add_exclusion':
@@ -126,6 +129,10 @@ class Backup:
         self.__open_storage()
         storage_idx = self.storage_manager.add_storage(params)
         self.storage_manager.make_active_storage(storage_idx)
+      elif args[0] == 'add_mirror_storage':
+        self.__open_storage()
+        storage_idx = self.storage_manager.add_storage(params)
+        self.storage_manager.make_mirror_storage(storage_idx)
       elif args[0] == 'add_base_storage':
         self.__open_storage()
         self.storage_manager.add_storage(params)
@@ -225,8 +232,18 @@ class Backup:
       root.set_digest(increment.get_fs_digest())
       root.set_level(increment.get_fs_level())
       root.set_stats(increment.get_fs_stats())
-      ctx = RestoreContext()
-      root.restore(ctx)
+      ctx = RestoreContext(
+          params.get('incremental', 'false') in ["true", "yes", "1"],
+          params.get('compare_data', 'false') in ["true", "yes", "1"])
+      if params.get('planned', 'true') not in ["false", "no", "0"]:
+        # Load every container once, rather than restoring file by file
+        num_writers = int(params.get('writers',
+          RestorePlanner.DEFAULT_WRITERS))
+        planner = RestorePlanner.RestorePlanner(self, self.storage_manager,
+            num_writers)
+        planner.restore(root, ctx)
+      else:
+        root.restore(ctx)
       
       self.txn_handler.commit()
     except:
@@ -293,12 +310,15 @@ class Backup:
   #
   def info(self, args):
     try:
-      self.__open_all()
-      self.__open_storage()
-
       detail = args[0]
       params = parse_to_keys(args[1:])
 
+      self.__open_all()
+      # relist=true lists all the container files of the storages, to find
+      # the increments of other clients without waiting for listing_max_age
+      self.__open_storage(
+          full_listing=params.get('relist', 'false') in ["true", "yes", "1"])
+
       if detail == 'increments':
         increments = self.increment_manager.get_increments()
         for storage, increment_idxs in increments.iteritems():
@@ -343,6 +363,8 @@ class Backup:
     return self.storage_manager.add_block(digest, code, data)
   def load_block(self, digest):
     return self.storage_manager.load_block(digest)
+  def prefetch_blocks(self, digests):
+    self.storage_manager.prefetch_blocks(digests)
   def get_block_code(self, digest):
     return self.storage_manager.get_block_code(digest)
   def get_completed_nodes_db(self):
@@ -414,16 +436,22 @@ class Backup:
         action_str = self.config_db['exclusion_rule_%d.action' % r]
         pattern = self.config_db['exclusion_rule_%d.pattern' % r]
         process_rule(type_str, action_str, pattern)
-  def __open_storage(self):
+  def __open_storage(self, full_listing=False):
     # TODO: consider not loading storages on initialization, only on meaningful
     # operations
     logging.debug("Opening storage")
     self.storage_manager = StorageManager.StorageManager(
         self.db_manager, self.txn_handler)
     self.storage_manager.set_report_manager(self.report_manager)
+    # The limits of the total bandwidth of all the storages
+    for direction in ["upload", "download"]:
+      key = direction + "_limit"
+      if self.config_db.has_key(key):
+        BandwidthLimiter.scheduler.set_limit(direction,
+            Storage.parse_bandwidth_schedule(self.config_db[key]))
     self.increment_manager = IncrementManager.IncrementManager(
       self.db_manager, self.txn_handler, self.label, self.storage_manager)
-    self.storage_manager.load_storages()
+    self.storage_manager.load_storages(full_listing)
     self.storage_opened = True
   def __close_all(self):
     if self.storage_opened:
@@ -628,5 +656,8 @@ class ScanContext:
 # RestoreContext
 #=========================================================
 class RestoreContext:
-  def __init__(self):
+  def __init__(self, incremental=False, compare_data=False):
     self.inodes_db = {}
+    # Skip the files that are already in place on the target
+    self.incremental = incremental
+    self.compare_data = compare_data
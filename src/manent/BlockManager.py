@@ -21,6 +21,18 @@ def is_cached(code):
 def is_indexed(code):
   return code != Container.CODE_HEADER
 
+# Listener that requests from a container only the given blocks, and hands
+# them to the block manager.
+class SelectiveListener:
+  def __init__(self, block_manager, digests):
+    self.block_manager = block_manager
+    self.digests = set(digests)
+  def is_requested(self, digest, code):
+    return (digest in self.digests and
+        self.block_manager.is_requested(digest, code))
+  def loaded(self, digest, code, data):
+    self.block_manager.loaded(digest, code, data)
+
 # Block Manager performs caching for different kinds of blocks.
 # Some blocks (such as container ones) are stored unconditionally.
 # Other blocks (data) are stored only temporarily.
@@ -115,9 +127,12 @@ class BlockManager:
       # self._start_block_epoch(digest)
       # self.tmp_blocks[digest] = data
       pass
-  def get_listener(self):
+  def get_listener(self, digests=None):
     # Block Manager implements all the interface of a proper listener, so it can
-    # be a listener itself.
+    # be a listener itself. If digests are given, only these blocks are
+    # requested.
+    if digests is not None:
+      return SelectiveListener(self, digests)
     return self
   def is_requested(self, digest, code):
     return not is_cached(code)
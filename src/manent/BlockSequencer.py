@@ -12,6 +12,10 @@ import traceback
 import BlockManager
 import Container
 
+# The number of containers that can be opened while looking for the index of
+# a summary container
+NUM_SUMMARY_TRIES = 4
+
 class BlockSequencer:
   def __init__(self, db_manager, txn_manager, storage_manager, block_manager):
     self.db_manager = db_manager
@@ -31,6 +35,16 @@ class BlockSequencer:
     self.loaded = None
     self._read_vars()
     self.current_open_container = None
+    # Containers are uploaded in the background while the blocks for the next
+    # containers are collected. pending_uploads holds the (container, task) of
+    # the uploads that are not yet registered with the storage manager, and
+    # pending_blocks the digests of their blocks.
+    self.pending_uploads = []
+    self.pending_blocks = set()
+    # The uploads of the containers to the mirror storages, by storage.
+    # Each mirror has its own queue, so that a slow one can lag behind the
+    # active storage and the other mirrors.
+    self.pending_mirror_uploads = {}
     # Statistics kept to support testing.
     self.num_containers_created = 0
 
@@ -38,6 +52,9 @@ class BlockSequencer:
     return self.aside_block_num
   def get_aside_blocks_size(self):
     return self.aside_block_size
+  def has_pending_block(self, digest):
+    # Is the block in a container that is still being uploaded?
+    return digest in self.pending_blocks
   def get_piggyback_headers_num(self):
     return self.aside_block_last + 1 - self.aside_block_first
   def _read_vars(self):
@@ -98,6 +115,12 @@ class BlockSequencer:
       logging.debug("%d aside blocks out of %d are bad" % 
           (num_bad, self.aside_block_num))
   def close(self):
+    # If the containers still being uploaded were not waited for, it's because
+    # the backup was interrupted. They are not registered, and since their
+    # indices were reserved, the storage adopts them the next time it's loaded
+    # instead of taking them for containers of another client. Their blocks
+    # are stored again if they are needed. The mirrors adopt the containers
+    # uploaded to them the same way.
     self._write_vars()
     self.piggyback_headers_db.close()
     self.aside_block_db.close()
@@ -158,14 +181,16 @@ class BlockSequencer:
     # this end, we just create empty containers until the index of the created
     # container tells us it's summary.
     if self.num_containers_created != 0:
-      for i in range(4):
+      for i in range(NUM_SUMMARY_TRIES):
         container = self.open_container()
         if (container.index + 1) % 4 == 0:
           self.write_container(container)
           break
       else:
-        raise Exception("Failed to generate a summary container in 4 tries")
-    self._write_vars()
+        raise Exception("Failed to generate a summary container in %d tries" %
+            NUM_SUMMARY_TRIES)
+    self.wait_uploads()
+    self.wait_mirror_uploads()
   def write_container(self, container):
     logging.debug("Finalizing container %d" % container.get_index())
     self.num_containers_created += 1
@@ -176,15 +201,73 @@ class BlockSequencer:
     self.piggyback_headers_db[str(container.get_index())] = header_contents
     logging.debug("Created piggyback header %d" % container.get_index())
     self.piggyback_header_last = container.index
-    # 2. Ask the container to upload itself.
-    container.upload()
-    # 3. Let the storage manager know about the finalized container.
-    self.storage_manager.container_written(container)
+    # 2. Ask the container to upload itself. The upload goes on in the
+    # background, while we continue with the next containers.
+    mirrors = self.storage_manager.get_mirror_storages()
+    mirror_uploads = container.create_mirror_uploads(mirrors)
+    storage = container.get_storage()
+    task = storage.get_upload_pool().submit(container.upload)
+    for mirror, upload in zip(mirrors, mirror_uploads):
+      self.submit_mirror_upload(container, mirror, upload)
+    self.pending_uploads.append((container, task))
+    for digest, code in container.list_blocks():
+      self.pending_blocks.add(digest)
+    if len(self.pending_uploads) >= storage.get_max_pending_uploads():
+      self.wait_uploads()
+  def submit_mirror_upload(self, container, mirror, upload):
+    queue = self.pending_mirror_uploads.setdefault(mirror, [])
+    task = mirror.get_upload_pool().submit(upload)
+    queue.append((container.get_index(), task))
+    # Only the oldest uploads are waited for, so the mirror keeps uploading
+    # while more containers are written.
+    while len(queue) > mirror.get_max_pending_uploads():
+      index, task = queue.pop(0)
+      self.finish_mirror_upload(mirror, index, task)
+  def finish_mirror_upload(self, mirror, index, task):
+    # The uploads are finished in the order of their containers, so the
+    # mirror's next index grows over the containers it has. A failed upload
+    # doesn't fail the backup, which has the container in the active storage,
+    # but the mirror lags behind from then on.
+    try:
+      task.result()
+    except Exception, e:
+      if not mirror.is_lagging():
+        logging.warning("Failed to upload container %d to mirror storage %d,"
+            " it won't get new containers: %s" % (index, mirror.get_index(), e))
+        mirror.set_lagging()
+      return
+    if not mirror.is_lagging():
+      mirror.set_next_index(index + 1)
+  def wait_mirror_uploads(self):
+    for mirror, queue in self.pending_mirror_uploads.iteritems():
+      for index, task in queue:
+        self.finish_mirror_upload(mirror, index, task)
+    self.pending_mirror_uploads = {}
+  def wait_uploads(self):
+    # 3. Wait until all the containers are uploaded, let the storage manager
+    # know about them and commit.
+    # We commit only when no upload is pending and no container is open, so
+    # that the committed state never refers to blocks that are not stored yet.
+    # If any of the uploads fails, nothing is registered or committed.
+    for container, task in self.pending_uploads:
+      task.result()
+    for container, task in self.pending_uploads:
+      self.storage_manager.container_written(container)
+    self.pending_uploads = []
+    self.pending_blocks = set()
     self._write_vars()
+    # The containers that can be uploaded before the next commit are the
+    # pending uploads and the ones opened looking for a summary index.
+    # Reserving their indices in the same commit lets the storage recognize
+    # them if the backup is interrupted before that commit.
+    self.storage_manager.reserve_containers(NUM_SUMMARY_TRIES)
     self.txn_manager.commit()
   def open_container(self):
     # 1. Ask the storage to create a new empty container.
     logging.debug("BlockSequencer: creating a new container")
+    if not self.storage_manager.has_reserved_container():
+      # No container is open now, so this is a point where we can commit
+      self.wait_uploads()
     container = self.storage_manager.create_container()
     # 2. Push into the container as many piggybacking blocks as it's willing to
     # accept.
@@ -4,6 +4,7 @@
 #
 
 import fnmatch
+import getpass
 import logging
 import os
 import os.path
@@ -141,7 +142,7 @@ class Paths:
     if os.name == "nt":
       path = os.path.join(os.environ["TEMP"], "manent.staging")
     else:
-      path = "/tmp/manent.staging."+os.environ["USER"]
+      path = "/tmp/manent.staging."+getpass.getuser()
     if not self.staging_area_exists and not os.path.exists(path):
       os.makedirs(path, 0700)
       self.staging_area_exists = True
@@ -5,7 +5,9 @@
 
 import base64
 import bz2
+import Crypto.Cipher.AES
 import Crypto.Cipher.ARC4
+import Crypto.Util.Counter
 import logging
 import os, os.path, shutil
 import re
@@ -14,6 +16,16 @@ import sys
 import traceback
 import zlib
 
+# lzma is not a part of the standard library of python 2. Compression with
+# it is available only if a package that provides it is installed.
+try:
+  import lzma
+except ImportError:
+  try:
+    from backports import lzma
+  except ImportError:
+    lzma = None
+
 import manent.utils.Digest as Digest
 import manent.utils.Format as Format
 import Increment
@@ -29,7 +41,13 @@ import manent.utils.FileIO as FileIO
 # Each container consists of two kinds of data, the header and the body.
 # The header contains its own header and blocks that encode metadata.
 # One of the blocks is the BLOCK_TABLE that describes the blocks stored
-# in the body.
+# in the body. Another one is the BLOCK_OFFSETS index, that gives the place in
+# the body of every compression group, encryption section and block that is
+# not compressed, so that a block can be located without replaying the
+# compression and encryption of the body. Containers written before the index
+# was added don't have it; their offsets are computed from the block table.
+# The index is a sequence of integer triples: the position of the entry in
+# the block table, its offset in the body and its size in the body.
 #
 # Header file format:
 # 1. magic number "MNNT"
@@ -69,6 +87,10 @@ import manent.utils.FileIO as FileIO
 #        For example, for arc4 encryption:
 #        key = Digest(seed+password)
 #        encryptor = ARC4(key)
+#        For aes-ctr encryption, the key is computed the same way, and the
+#        counter is the index of the 16-byte block within the section, starting
+#        from 0. Unlike arc4, this allows decryption to start at any offset of
+#        the section, so the reader can skip the data it doesn't need.
 #     The start tag should always be closed with an END tag.
 #    ENCRYPTION_END
 #     The following entries are no longer encrypted.
@@ -90,7 +112,9 @@ import manent.utils.FileIO as FileIO
 #---------------------------------------------------
 
 MAGIC = "MNNT"
-VERSION = 2
+VERSION = 3
+# Version 3 added aes-ctr encryption. Older containers can still be read.
+SUPPORTED_VERSIONS = [2, 3]
 
 MAX_COMPRESSED_DATA = 256 * 1024
 
@@ -134,6 +158,11 @@ CODE_BLOCK_TABLE           = 18
 #
 CODE_HEADER                = 19
 
+#
+# Code for blocks stored in the header
+#
+CODE_BLOCK_OFFSETS         = 20
+
 CODE_CONTROL_START         = 48
 #
 # Codes for both kinds of blocks
@@ -141,9 +170,11 @@ CODE_CONTROL_START         = 48
 CODE_COMPRESSION_END       = 48
 CODE_COMPRESSION_BZ2       = 49
 CODE_COMPRESSION_GZIP      = 50
+CODE_COMPRESSION_LZMA      = 51
 
 CODE_ENCRYPTION_END        = 64
 CODE_ENCRYPTION_ARC4       = 65
+CODE_ENCRYPTION_AES_CTR    = 66
 
 CODE_NAME_TABLE = {
   CODE_DATA:                 "DATA          ",
@@ -154,12 +185,15 @@ CODE_NAME_TABLE = {
   CODE_INCREMENT_DESCRIPTOR: "INCREMENT_DESC",
   CODE_BLOCK_TABLE:          "BLOCK_TABLE   ",
   CODE_HEADER:               "HEADER        ",
+  CODE_BLOCK_OFFSETS:        "BLOCK_OFFSETS ",
   CODE_CONTROL_START:        "CONTROL_START ",
   CODE_COMPRESSION_END:      "COMPRESS_END  ",
   CODE_COMPRESSION_BZ2:      "COMPRESS_BZ2  ",
   CODE_COMPRESSION_GZIP:     "COMPRESS_GZIP ",
+  CODE_COMPRESSION_LZMA:     "COMPRESS_LZMA ",
   CODE_ENCRYPTION_END:       "ENCRYPT_END   ",
-  CODE_ENCRYPTION_ARC4:      "ENCRYPT_ARC4  "
+  CODE_ENCRYPTION_ARC4:      "ENCRYPT_ARC4  ",
+  CODE_ENCRYPTION_AES_CTR:   "ENCRYPT_AESCTR"
 }
 
 def compute_packer_code(code):
@@ -176,6 +210,12 @@ def is_packer_code(code):
 def is_user_code(code):
   return code < CODE_CONTROL_START
 
+def is_compression_code(code):
+  return COMPRESSION_CODECS.has_key(code)
+
+def is_encryption_code(code):
+  return code == CODE_ENCRYPTION_ARC4 or code == CODE_ENCRYPTION_AES_CTR
+
 def code_name(code):
   return CODE_NAME_TABLE[code]
 
@@ -198,11 +238,283 @@ def serialize_blocks(file, blocks):
     Format.write_int(file,size)
     Format.write_int(file,code)
 
+def compute_block_offsets(blocks):
+  """Compute the offset index of the body described by the block table:
+  (table position, body offset, body size) for every compression group,
+  encryption section and uncompressed block, in the order of the table"""
+  offsets = []
+  offset = 0
+  section = None
+  group = None
+  for i in range(len(blocks)):
+    (digest, size, code) = blocks[i]
+    if is_encryption_code(code):
+      section = len(offsets)
+      offsets.append([i, offset, 0])
+    elif code == CODE_ENCRYPTION_END:
+      offsets[section][2] = size
+      section = None
+    elif is_compression_code(code):
+      group = len(offsets)
+      offsets.append([i, offset, 0])
+    elif code == CODE_COMPRESSION_END:
+      offsets[group][2] = size
+      offset += size
+      group = None
+    elif group is None:
+      offsets.append([i, offset, size])
+      offset += size
+  return [tuple(entry) for entry in offsets]
+def serialize_block_offsets(offsets):
+  nums = []
+  for entry in offsets:
+    nums.extend(entry)
+  return Format.serialize_ints(nums)
+def unserialize_block_offsets(string):
+  nums = Format.deserialize_ints(string)
+  return [tuple(nums[i:i + 3]) for i in range(0, len(nums), 3)]
+
 #-------------------------------------------------------------------
 # Dump creation and reading utilities
 #-------------------------------------------------------------------
+
+#
+# Compression codecs, by the code that starts their compression group.
+# For every codec, we keep its name in the configuration, its default level,
+# and the constructors of its compressor and decompressor. The level affects
+# only the compressor, so it is not recorded in the container.
+# Storing the data without compression needs no codec: the blocks are just
+# written out of a compression group.
+#
+def _new_lzma_compressor(level):
+  return lzma.LZMACompressor(preset=level)
+def _new_lzma_decompressor():
+  return lzma.LZMADecompressor()
+
+COMPRESSION_CODECS = {
+  CODE_COMPRESSION_BZ2:  ("bz2", 9, bz2.BZ2Compressor, bz2.BZ2Decompressor),
+  CODE_COMPRESSION_GZIP: ("zlib", 6, zlib.compressobj, zlib.decompressobj),
+  CODE_COMPRESSION_LZMA: ("lzma", 6, _new_lzma_compressor,
+                          _new_lzma_decompressor),
+}
+COMPRESSION_NONE = "store"
+
+def parse_compression(spec):
+  """Parse the compression setting "<algorithm>[:<level>]". Returns the pair
+  (code, level), or None if the data is to be stored without compression."""
+  if spec == COMPRESSION_NONE:
+    return None
+  if spec.find(":") != -1:
+    name, level = spec.split(":", 1)
+    level = int(level)
+  else:
+    name, level = spec, None
+  for code, (codec_name, default_level, compressor, decompressor) in \
+      COMPRESSION_CODECS.iteritems():
+    if codec_name != name:
+      continue
+    if code == CODE_COMPRESSION_LZMA and lzma is None:
+      raise Exception("lzma compression requires the lzma module")
+    if level is None:
+      level = default_level
+    return (code, level)
+  raise Exception("Unknown compression algorithm %s" % name)
+
+def new_compressor(algorithm_code, level=None):
+  if not COMPRESSION_CODECS.has_key(algorithm_code):
+    raise Exception("Unsupported compression algorithm")
+  name, default_level, compressor, decompressor = \
+      COMPRESSION_CODECS[algorithm_code]
+  if level is None:
+    level = default_level
+  return compressor(level)
+
+def compress_group(algorithm_code, level, chunks):
+  """Compress all the data of a compression group at once. The result is
+  exactly what the compressor produces when fed with the chunks one by one"""
+  compressor = new_compressor(algorithm_code, level)
+  compressed = [compressor.compress(chunk) for chunk in chunks]
+  compressed.append(compressor.flush())
+  return "".join(compressed)
+
+AES_BLOCK_SIZE = 16
+
+def new_cipher(algorithm_code, seed, password, offset=0):
+  """Create the cipher for an encryption section, positioned at the given
+  offset within the section. Only aes-ctr can start at a nonzero offset."""
+  key = Digest.dataDigest(seed + password)
+  if algorithm_code == CODE_ENCRYPTION_ARC4:
+    assert offset == 0
+    return Crypto.Cipher.ARC4.new(key)
+  elif algorithm_code == CODE_ENCRYPTION_AES_CTR:
+    counter = Crypto.Util.Counter.new(128,
+        initial_value=offset / AES_BLOCK_SIZE)
+    cipher = Crypto.Cipher.AES.new(key, Crypto.Cipher.AES.MODE_CTR,
+        counter=counter)
+    # Consume the part of the first block that precedes the offset
+    cipher.decrypt("\0" * (offset % AES_BLOCK_SIZE))
+    return cipher
+  raise Exception("Unsupported encryption algorithm")
+
+def new_decompressor(algorithm_code):
+  if not COMPRESSION_CODECS.has_key(algorithm_code):
+    raise Exception("Unsupported compression algorithm")
+  name, default_level, compressor, decompressor = \
+      COMPRESSION_CODECS[algorithm_code]
+  if decompressor is _new_lzma_decompressor and lzma is None:
+    raise Exception("lzma decompression requires the lzma module")
+  return decompressor()
+
+def decompress_group(algorithm_code, data):
+  """Decompress all the data of a compression group at once"""
+  return new_decompressor(algorithm_code).decompress(data)
+
+def compressed_size_bound(size):
+  # Worst case expansion of bz2, which is more than enough for zlib and lzma
+  # too.
+  return size + size / 100 + 600
+
+# Blocks are sampled to see if they are worth compressing. A block whose
+# sample doesn't shrink below this ratio is considered incompressible.
+COMPRESSIBILITY_SAMPLE_SIZE = 8 * 1024
+COMPRESSIBILITY_RATIO = 0.95
+# With adaptive compression, a compression group is not closed for an
+# incompressible block before it has this much data, so that the container
+# doesn't end up with many tiny groups.
+MIN_COMPRESSION_GROUP_SIZE = 64 * 1024
+
+def is_compressible(data):
+  """Guess whether the data is worth compressing, by compressing a sample from
+  its middle with the fastest zlib level. Already compressed data, such as
+  media files and archives, won't shrink."""
+  if len(data) <= COMPRESSIBILITY_SAMPLE_SIZE:
+    # Small blocks are cheap to compress anyway
+    return True
+  start = (len(data) - COMPRESSIBILITY_SAMPLE_SIZE) / 2
+  sample = data[start:start + COMPRESSIBILITY_SAMPLE_SIZE]
+  compressed = zlib.compress(sample, 1)
+  return len(compressed) < len(sample) * COMPRESSIBILITY_RATIO
+
+# Ranges of the body that are closer than this are fetched together: one
+# larger request is cheaper than two round trips.
+RANGE_MERGE_GAP = 64 * 1024
+
+def compute_body_ranges(blocks, listener):
+  """Compute the (offset, size) ranges of the body that DataDumpLoader reads
+  to load the blocks requested by the listener. The offsets are relative to
+  the start of the body, and adjacent ranges are merged."""
+  ranges = []
+  def add_range(offset, size):
+    if ranges != []:
+      last_offset, last_size = ranges[-1]
+      if offset <= last_offset + last_size + RANGE_MERGE_GAP:
+        ranges[-1] = (last_offset,
+            max(last_size, offset + size - last_offset))
+        return
+    ranges.append((offset, size))
+  offset = 0
+  section_code = None
+  group_start = None
+  for (digest, size, code) in blocks:
+    if is_encryption_code(code):
+      section_code = code
+      section_start = offset
+    elif code == CODE_ENCRYPTION_END:
+      # A stream cipher section is always read whole, see
+      # DataDumpLoader._skip. Its end block tells its size.
+      if section_code == CODE_ENCRYPTION_ARC4:
+        add_range(section_start, size)
+      section_code = None
+    elif is_compression_code(code):
+      group_start = offset
+      group_requested = False
+    elif code == CODE_COMPRESSION_END:
+      if group_requested:
+        add_range(group_start, size)
+      offset += size
+      group_start = None
+    else:
+      requested = is_user_code(code) and listener.is_requested(digest, code)
+      if group_start is not None:
+        group_requested = group_requested or requested
+      else:
+        if requested:
+          add_range(offset, size)
+        offset += size
+  return ranges
+
+def compute_body_size(blocks):
+  """Compute the size of the body described by the block table"""
+  size = 0
+  in_compression = False
+  for (digest, block_size, code) in blocks:
+    if is_compression_code(code):
+      in_compression = True
+    elif code == CODE_COMPRESSION_END:
+      in_compression = False
+      size += block_size
+    elif is_user_code(code) and not in_compression:
+      size += block_size
+  return size
+
+class RangedFile:
+  """
+  A read-only file-like view of a container file of which only some ranges
+  are fetched from the storage. Reading outside of the fetched ranges fetches
+  the missing data on demand, so correctness doesn't depend on guessing the
+  ranges right.
+  fetch_range(offset, size) returns the data of the file at the given range.
+  Data fetched on demand is fetched in pieces of at least min_fetch_size, so
+  that a sequence of small reads doesn't turn into many round trips.
+  """
+  def __init__(self, fetch_range, position=0, min_fetch_size=0):
+    self.fetch_range = fetch_range
+    self.position = position
+    self.min_fetch_size = min_fetch_size
+    # Sorted list of non-overlapping (offset, data)
+    self.fetched = []
+  def prefetch(self, ranges):
+    for offset, size in ranges:
+      self._add(offset, self.fetch_range(offset, size))
+  def _add(self, offset, data):
+    if data != "":
+      self.fetched.append((offset, data))
+      self.fetched.sort()
+  def read(self, size):
+    result = []
+    while size > 0:
+      for offset, data in self.fetched:
+        if offset <= self.position < offset + len(data):
+          start = self.position - offset
+          chunk = data[start:start + size]
+          break
+      else:
+        # Fetch the missing data, up to the next fetched range
+        end = self.position + max(size, self.min_fetch_size)
+        for offset, data in self.fetched:
+          if self.position < offset < end:
+            end = offset
+        fetched = self.fetch_range(self.position, end - self.position)
+        if fetched == "":
+          break
+        self._add(self.position, fetched)
+        chunk = fetched[:size]
+      result.append(chunk)
+      self.position += len(chunk)
+      size -= len(chunk)
+    return "".join(result)
+  def seek(self, offset, whence=0):
+    if whence == 0:
+      self.position = offset
+    elif whence == 1:
+      self.position += offset
+    else:
+      raise Exception("RangedFile can't seek relative to the end")
+  def tell(self):
+    return self.position
+
 class DataDumper:
-  def __init__(self,file):
+  def __init__(self, file, compression_pool=None):
     self.file = file
     self.blocks = []
     self.pending_compression_start_block = None
@@ -211,17 +523,59 @@ class DataDumper:
     
     self.encryptor = None
     self.compressor = None
+
+    # If a compression pool is given, every compression group is compressed as
+    # a whole by the pool workers. The output that comes after a group that is
+    # still being compressed is held in pending_output, so that the file is
+    # written in exactly the same order as without the pool.
+    # pending_size is an upper bound on the size of the held output.
+    self.compression_pool = compression_pool
+    self.group_chunks = None
+    self.pending_output = []
+    self.pending_size = 0
   def add_block(self, digest, code, data):
     if self.pending_compression_start_block is not None:
       self.blocks.append(self.pending_compression_start_block)
       self.pending_compression_start_block = None
     self.blocks.append((digest, len(data), code))
+    if self.group_chunks is not None:
+      self.uncompressed_size += len(data)
+      self.group_chunks.append(data)
+      return
     if self.compressor is not None:
       data = self.__compress(data)
+    self.__write(data)
+  def __write(self, data):
+    if self.pending_output != []:
+      self.pending_output.append((None, data, len(data)))
+      self.pending_size += len(data)
+      return
+    self.__write_out(data)
+  def __write_out(self, data):
     if self.encryptor is not None:
       data = self.__encrypt(data)
     self.file.write(data)
     self.total_size += len(data)
+  def __is_compressing(self):
+    return self.compressor is not None or self.group_chunks is not None
+  def flush_pending(self, max_pending=0):
+    """
+    Write out the output held back by compression groups in the pool.
+    Waits for the groups to be compressed as long as more than max_pending
+    entries are held.
+    """
+    while self.pending_output != []:
+      task, data, size_bound = self.pending_output[0]
+      if task is not None:
+        if len(self.pending_output) <= max_pending and not task.is_done():
+          break
+        end_block_idx = data
+        data = task.result()
+        self.blocks[end_block_idx] = (Digest.dataDigest(""), len(data),
+                                      CODE_COMPRESSION_END)
+      self.pending_output.pop(0)
+      self.pending_size -= size_bound
+      self.__write_out(data)
   #
   # Encryption support
   #
@@ -230,17 +584,17 @@ class DataDumper:
     Encryption can be started only when compression is inactive
     """
     assert self.encryptor is None
-    assert self.compressor is None
+    assert not self.__is_compressing()
+    self.flush_pending()
     
     self.blocks.append((seed, 0, algorithm_code))
-    if algorithm_code == CODE_ENCRYPTION_ARC4:
-      key = Digest.dataDigest(seed + password)
-      self.encryptor = Crypto.Cipher.ARC4.new(key)
+    self.encryptor = new_cipher(algorithm_code, seed, password)
     self.encrypted_data_size = 0
     self.encrypted_data_digest = Digest.DataDigestAccumulator()
   def stop_encryption(self):
     assert self.encryptor is not None
-    assert self.compressor is None
+    assert not self.__is_compressing()
+    self.flush_pending()
 
     self.blocks.append((self.encrypted_data_digest.digest(),
                         self.encrypted_data_size, CODE_ENCRYPTION_END))
@@ -252,21 +606,22 @@ class DataDumper:
   #
   # Compression support
   #
-  def start_compression(self, algorithm_code):
+  def start_compression(self, algorithm_code, level=None):
     """
     Compression can be started under encryption
     """
-    assert self.compressor is None
+    assert not self.__is_compressing()
 
     digest = Digest.dataDigest(str(len(self.blocks)))
     self.pending_compression_start_block = (digest, 0, algorithm_code)
-    if algorithm_code == CODE_COMPRESSION_BZ2:
-      self.compressor = bz2.BZ2Compressor(9)
-    elif algorithm_code == CODE_COMPRESSION_GZIP:
-      self.compressor = zlib.compressobj()
+    if self.compression_pool is not None:
+      if not is_compression_code(algorithm_code):
+        raise Exception("Unsupported compression algorithm")
+      self.group_chunks = []
     else:
-      raise Exception("Unsupported compression algorithm")
+      self.compressor = new_compressor(algorithm_code, level)
     self.compressor_algorithm = algorithm_code
+    self.compressor_level = level
     self.uncompressed_size = 0
     self.compressed_size = 0
   def stop_compression(self):
@@ -275,16 +630,28 @@ class DataDumper:
       # in this case, the start block wasn't added, and the stop block shouldn't
       # be added either.
       self.compressor = None
+      self.group_chunks = None
       self.pending_compression_start_block = None
       return
+    if self.group_chunks is not None:
+      # The size of the group is known only after it is compressed, so the
+      # stop block is filled in by flush_pending.
+      task = self.compression_pool.submit(compress_group,
+          self.compressor_algorithm, self.compressor_level, self.group_chunks)
+      size_bound = compressed_size_bound(self.uncompressed_size)
+      self.pending_output.append((task, len(self.blocks), size_bound))
+      self.pending_size += size_bound
+      self.blocks.append(None)
+      self.group_chunks = None
+      # Don't let too many groups wait in memory for a busy pool.
+      self.flush_pending(
+          max_pending=2 * max(1, self.compression_pool.get_num_workers()))
+      return
     assert self.compressor is not None
     tail = self.compressor.flush()
     self.compressed_size += len(tail)
     
-    if self.encryptor is not None:
-      tail = self.__encrypt(tail)
-    self.file.write(tail)
-    self.total_size += len(tail)
+    self.__write(tail)
     self.blocks.append((Digest.dataDigest(""), self.compressed_size,
                         CODE_COMPRESSION_END))
     self.compressor = None
@@ -305,27 +672,38 @@ class DataDumper:
   # Result
   #
   def get_blocks(self):
+    self.flush_pending()
     return self.blocks
 
+# The compressed data is read and uncompressed in chunks of this size
+UNCOMPRESS_READ_SIZE = 64 * 1024
+
 class DataDumpLoader:
   """The only mode of loading blocks from a container is through a listener.
   The listener can determine, given a digest and a code, whether a given block
   should be loaded. If the block is loaded, the listener returns it back to the
-  listener through callback."""
-  def __init__(self, file, blocks, password):
+  listener through callback.
+  If a decompression pool is given, the compression groups are decompressed by
+  the pool's workers, but the listener still receives the blocks in the order
+  of the block table."""
+  def __init__(self, file, blocks, password, decompression_pool=None):
     self.file = file
     self.blocks = blocks
     self.password = password
+    self.decompression_pool = decompression_pool
 
     self.uncompressor = None
     self.decryptor = None
   def load_blocks(self, listener):
+    if self.decompression_pool is not None:
+      self._load_blocks_pooled(listener)
+      return
     total_offset = 0
     uncompressed_offset = 0
     skip_until = None
     for i in range(len(self.blocks)):
       (digest, size, code) = self.blocks[i]
-      if code == CODE_ENCRYPTION_ARC4:
+      if is_encryption_code(code):
         # Since encryption blocks are not nested in anything,
         # we can't see start of encryption when skipping
         assert skip_until is None
@@ -346,54 +724,20 @@ class DataDumpLoader:
         if not requested:
           skip_until = CODE_ENCRYPTION_END
 
-        # We always perform decryption, even when it's needed
-        # only for checking.
-        key = Digest.dataDigest(digest + self.password)
-        self.decryptor = Crypto.Cipher.ARC4.new(key)
-        self.decryptor_data_digest = Digest.DataDigestAccumulator()
-        self.decrypted_bytes = 0
+        self._start_decryption(code, digest)
         
       elif code == CODE_ENCRYPTION_END:
         # Encryption cannot be nested in compression
         assert skip_until != CODE_COMPRESSION_END
         if skip_until == CODE_ENCRYPTION_END:
-          skipped = self.file.read(size)
-          skipped = self.decryptor.decrypt(skipped)
-          self.decrypted_bytes += len(skipped)
-          self.decryptor_data_digest.update(skipped)
+          self._skip(size)
           skip_until = None
-        assert self.decryptor_data_digest.digest() == digest
-        self.decryptor = None
-        self.decryptor_data_digest = None
+        self._stop_decryption(digest)
       
       #
       # Process compression tags
       #
-      elif code == CODE_COMPRESSION_BZ2:
-        if skip_until is not None:
-          assert skip_until == CODE_ENCRYPTION_END
-          continue
-        # find out if any of the blocks contained within
-        # the section is actually needed
-        requested = False
-        for j in range(i+1,len(self.blocks)):
-          s_digest,s_size,s_code = self.blocks[j]
-          if s_code == CODE_COMPRESSION_END:
-            self.uncompress_bytes = s_size
-            break
-          if (is_user_code(s_code) and
-              listener.is_requested(s_digest, s_code)):
-            requested = True
-        else:
-          raise Exception("Block table error: compression start "
-                            "without end")
-
-        if requested:
-          self.uncompressor = bz2.BZ2Decompressor()
-          self.uncompressed_buf = ""
-        else:
-          skip_until = CODE_COMPRESSION_END
-      elif code == CODE_COMPRESSION_GZIP:
+      elif is_compression_code(code):
         if skip_until is not None:
           assert skip_until == CODE_ENCRYPTION_END
           continue
@@ -412,8 +756,9 @@ class DataDumpLoader:
           raise Exception("Block table error: compression start without end")
 
         if requested:
-          self.uncompressor = zlib.decompressobj()
+          self.uncompressor = new_decompressor(code)
           self.uncompressed_buf = ""
+          self.uncompressed_pos = 0
         else:
           skip_until = CODE_COMPRESSION_END
       
@@ -422,20 +767,14 @@ class DataDumpLoader:
           assert self.uncompressor is None
           continue
         if skip_until == CODE_COMPRESSION_END:
-          data = self.file.read(size)
-          if self.decryptor is not None:
-            data = self.decryptor.decrypt(data)
-            self.decryptor_data_digest.update(data)
+          self._skip(size)
           skip_until = None
         else:
           if self.uncompress_bytes != 0:
-            chunk = self.file.read(self.uncompress_bytes)
-            if self.decryptor is not None:
-              chunk = self.decryptor.decrypt(chunk)
-              self.decrypted_bytes += len(chunk)
-              self.decryptor_data_digest.update(chunk)
+            self._skip(self.uncompress_bytes)
         self.uncompressor = None
         self.uncompressed_buf = ""
+        self.uncompressed_pos = 0
       #
       # Read normal data
       #
@@ -446,37 +785,167 @@ class DataDumpLoader:
         # consistency of the blocks
         # Uncompress data if necessary
         if self.uncompressor is not None:
-          data = ""
-          while len(data) < size:
-            if len(self.uncompressed_buf) > 0:
-              portion = min(size-len(data),
-                            len(self.uncompressed_buf))
-              data += self.uncompressed_buf[:portion]
-              self.uncompressed_buf = self.uncompressed_buf[portion:]
-            else:
-              toread = min(8192, self.uncompress_bytes)
-              self.uncompress_bytes -= toread
-              logging.debug("Reading chunk to uncompress at offset %d",
-                  self.file.tell())
-              chunk = self.file.read(toread)
-              logging.debug("Uncompressing chunk len=%s", len(chunk))
-              if self.decryptor is not None:
-                chunk = self.decryptor.decrypt(chunk)
-                self.decryptor_data_digest.update(chunk)
-                self.decrypted_bytes += len(data)
-              if len(chunk) < toread:
-                raise Exception(
-                    "Cannot read data expected in the container")
-              self.uncompressed_buf = self.uncompressor.decompress(chunk)
+          data = self._uncompress(size)
         else:
-          data = self.file.read(size)
-          if self.decryptor is not None:
-            data = self.decryptor.decrypt(data)
-            self.decryptor_data_digest.update(data)
-            self.decrypted_bytes += len(data)
+          if not (is_user_code(code) and listener.is_requested(digest, code)):
+            # Data that is not compressed needs not be read if not requested
+            self._skip(size)
+            continue
+          data = self._decrypt(self.file.read(size))
 
         if is_user_code(code) and listener.is_requested(digest, code):
           listener.loaded(digest, code, data)
+  #
+  # Loading with a decompression pool
+  #
+  def _load_blocks_pooled(self, listener):
+    # The file is still read in order, since the decryption needs that, but
+    # each requested compression group is read whole and handed to the pool.
+    # Every entry of pending is (task, data, blocks): the task computes the
+    # data of a compression group (it is None if the data is already known),
+    # and blocks are (digest, code, offset, size) of the blocks in the data.
+    pending = []
+    max_pending = 2 * max(1, self.decompression_pool.get_num_workers())
+    group_blocks = None
+    skip_until = None
+    for i in range(len(self.blocks)):
+      (digest, size, code) = self.blocks[i]
+      if is_encryption_code(code):
+        # Since encryption blocks are not nested in anything,
+        # we can't see start of encryption when skipping
+        assert skip_until is None
+        if not self._is_section_requested(listener, i, CODE_ENCRYPTION_END):
+          skip_until = CODE_ENCRYPTION_END
+        self._start_decryption(code, digest)
+      elif code == CODE_ENCRYPTION_END:
+        # Encryption cannot be nested in compression
+        assert skip_until != CODE_COMPRESSION_END
+        if skip_until == CODE_ENCRYPTION_END:
+          self._skip(size)
+          skip_until = None
+        self._stop_decryption(digest)
+      elif is_compression_code(code):
+        if skip_until is not None:
+          assert skip_until == CODE_ENCRYPTION_END
+          continue
+        if self._is_section_requested(listener, i, CODE_COMPRESSION_END):
+          group_code = code
+          group_blocks = []
+          group_size = 0
+        else:
+          skip_until = CODE_COMPRESSION_END
+      elif code == CODE_COMPRESSION_END:
+        if skip_until == CODE_ENCRYPTION_END:
+          continue
+        if skip_until == CODE_COMPRESSION_END:
+          self._skip(size)
+          skip_until = None
+          continue
+        data = self._read(size)
+        task = self.decompression_pool.submit(decompress_group,
+            group_code, data)
+        pending.append((task, None, group_blocks))
+        group_blocks = None
+        self._deliver_pending(listener, pending, max_pending)
+      else:
+        if skip_until is not None:
+          continue
+        if group_blocks is not None:
+          group_blocks.append((digest, code, group_size, size))
+          group_size += size
+        elif is_user_code(code) and listener.is_requested(digest, code):
+          pending.append((None, self._read(size), [(digest, code, 0, size)]))
+        else:
+          self._skip(size)
+    self._deliver_pending(listener, pending, 0)
+  def _uncompress(self, size):
+    # The block is collected from pieces, and the uncompressed buffer is
+    # consumed by advancing a position in it, so that no data is copied more
+    # than once however small the pieces are.
+    pieces = []
+    while size > 0:
+      available = len(self.uncompressed_buf) - self.uncompressed_pos
+      if available > 0:
+        portion = min(size, available)
+        pieces.append(self.uncompressed_buf[
+          self.uncompressed_pos:self.uncompressed_pos + portion])
+        self.uncompressed_pos += portion
+        size -= portion
+      else:
+        toread = min(UNCOMPRESS_READ_SIZE, self.uncompress_bytes)
+        if toread == 0:
+          raise Exception("Cannot read data expected in the container")
+        self.uncompress_bytes -= toread
+        self.uncompressed_buf = self.uncompressor.decompress(self._read(toread))
+        self.uncompressed_pos = 0
+    return "".join(pieces)
+  def _is_section_requested(self, listener, start, end_code):
+    # find out if any of the blocks contained within
+    # the section is actually needed
+    requested = False
+    for j in range(start + 1, len(self.blocks)):
+      (s_digest, s_size, s_code) = self.blocks[j]
+      if s_code == end_code:
+        return requested
+      if (is_user_code(s_code) and
+          listener.is_requested(s_digest, s_code)):
+        requested = True
+    raise Exception("Block table error: section start without end")
+  #
+  # Decryption support
+  #
+  def _start_decryption(self, code, seed):
+    self.decryptor_code = code
+    self.decryptor_seed = seed
+    self.decryptor_start = self.file.tell()
+    self.decryptor = new_cipher(code, seed, self.password)
+    self.decryptor_data_digest = Digest.DataDigestAccumulator()
+  def _stop_decryption(self, digest):
+    # If some of the data was skipped without decryption, the digest of the
+    # section cannot be verified. The digests of the blocks can still be.
+    if self.decryptor_data_digest is not None:
+      assert self.decryptor_data_digest.digest() == digest
+    self.decryptor = None
+    self.decryptor_data_digest = None
+  def _skip(self, size):
+    if (self.decryptor is not None and
+        self.decryptor_code != CODE_ENCRYPTION_AES_CTR):
+      # We always perform decryption of a stream cipher, even when it's needed
+      # only for checking.
+      self._read(size)
+      return
+    self.file.seek(size, 1)
+    if self.decryptor is not None:
+      self.decryptor_data_digest = None
+      self.decryptor = new_cipher(self.decryptor_code, self.decryptor_seed,
+          self.password, self.file.tell() - self.decryptor_start)
+  def _read(self, size):
+    data = self.file.read(size)
+    if len(data) < size:
+      raise Exception("Cannot read data expected in the container")
+    return self._decrypt(data)
+  def _decrypt(self, data):
+    if self.decryptor is None:
+      return data
+    data = self.decryptor.decrypt(data)
+    if self.decryptor_data_digest is not None:
+      self.decryptor_data_digest.update(data)
+    return data
+  def _deliver_pending(self, listener, pending, max_pending):
+    # Deliver the blocks whose data is ready, in order. Wait for the
+    # decompression as long as more than max_pending entries are pending.
+    while pending != []:
+      task, data, blocks = pending[0]
+      if task is not None:
+        if len(pending) <= max_pending and not task.is_done():
+          break
+        data = task.result()
+      pending.pop(0)
+      for (digest, code, offset, size) in blocks:
+        if len(data) < offset + size:
+          raise Exception("Cannot read data expected in the container")
+        if is_user_code(code) and listener.is_requested(digest, code):
+          listener.loaded(digest, code, data[offset:offset + size])
 
 class Container:
   """
@@ -500,6 +969,13 @@ class Container:
     self.mode = None
     
     self.body_blocks = []
+    # Header of a container in LOAD mode, read once
+    self.loaded_body_blocks = None
+    self.loaded_body_file = None
+    self.loaded_ranged_file = None
+    self.loaded_header_size = None
+    self.loaded_block_offsets = None
+    self.loaded_block_locations = None
 
     self.report_manager = None
   def get_index(self):
@@ -530,42 +1006,58 @@ class Container:
     logging.debug("Container %d can add %d piggyback headers" %
         (self.index, self.max_num_piggyback_headers))
 
-    self.body_dumper = DataDumper(self.body_file)
+    self.body_dumper = DataDumper(self.body_file,
+        self.storage.get_compression_pool())
     self.header_dump_os = StringIO.StringIO()
     self.header_dumper = DataDumper(self.header_dump_os)
 
     if self.storage.get_encryption_key() != "":
       self.encryption_active = True
       self.body_dumper.start_encryption(
-          CODE_ENCRYPTION_ARC4,
+          CODE_ENCRYPTION_AES_CTR,
           os.urandom(Digest.dataDigestSize()),
           self.storage.get_encryption_key())
       self.header_dumper.start_encryption(
-          CODE_ENCRYPTION_ARC4,
+          CODE_ENCRYPTION_AES_CTR,
           os.urandom(Digest.dataDigestSize()),
           self.storage.get_encryption_key())
     else:
       self.encryption_active = False
 
-    self.body_dumper.start_compression(CODE_COMPRESSION_BZ2)
-    self.compression_active = True
+    # The compression is (code, level), or None if the body is stored without
+    # compression. With adaptive compression, the blocks that don't compress
+    # are stored out of compression groups.
+    self.compression = self.storage.get_compression()
+    self.adaptive_compression = self.storage.is_compression_adaptive()
+    self.compression_active = False
     self.compressed_data = 0
+    self.enable_compression()
   def enable_compression(self):
-    if not self.compression_active:
-      self.body_dumper.start_compression(CODE_COMPRESSION_BZ2)
+    if not self.compression_active and self.compression is not None:
+      code, level = self.compression
+      self.body_dumper.start_compression(code, level)
       self.compression_active = True
       self.compressed_data = 0
   def disable_compression(self):
     if self.compression_active:
       self.body_dumper.stop_compression()
       self.compression_active = False
-  def _can_add_bytes(self, data_size):
+  def _current_size(self):
     # MAX_COMPRESSED_DATA is a safeguard for compressed data which was not yet
     # put into the output
     # 64 is for the header of the header
-    current_size = (self.body_dumper.total_size +
+    return (self.body_dumper.total_size +
+        self.body_dumper.pending_size +
         self.header_dumper.total_size +
         MAX_COMPRESSED_DATA + 64)
+  def _can_add_bytes(self, data_size):
+    current_size = self._current_size()
+    if (current_size + data_size > self.storage.container_size() and
+        self.body_dumper.pending_size != 0):
+      # The groups still being compressed are accounted by their worst case
+      # size. Wait for them to find out how much space is really left.
+      self.body_dumper.flush_pending()
+      current_size = self._current_size()
     logging.debug("Container trying to add to %d bytes block of %d, max: %d" %
         (current_size, data_size, self.storage.container_size()))
     return current_size + data_size <= self.storage.container_size()
@@ -582,10 +1074,15 @@ class Container:
   def add_block(self, digest, code, data):
     logging.debug("Container %d :adding block %s, %s, size:%d" % (
       self.index, base64.b64encode(digest), code_name(code), len(data)))
+    if self.adaptive_compression:
+      if is_compressible(data):
+        self.enable_compression()
+      elif (not self.compression_active or self.compressed_data == 0 or
+          self.compressed_data >= MIN_COMPRESSION_GROUP_SIZE):
+        self.disable_compression()
     if self.compression_active and self.compressed_data > MAX_COMPRESSED_DATA:
-      self.body_dumper.stop_compression()
-      self.body_dumper.start_compression(CODE_COMPRESSION_BZ2)
-      self.compressed_data = 0
+      self.disable_compression()
+      self.enable_compression()
 
     self.body_dumper.add_block(digest, code, data)
     self.compressed_data += len(data)
@@ -636,6 +1133,9 @@ class Container:
                    CODE_CONTAINER_DESCRIPTOR, message)
     self.header_dumper.add_block(Digest.dataDigest(body_table_str),
                    CODE_BLOCK_TABLE, body_table_str)
+    offsets_str = serialize_block_offsets(compute_block_offsets(body_blocks))
+    self.header_dumper.add_block(Digest.dataDigest(offsets_str),
+                   CODE_BLOCK_OFFSETS, offsets_str)
 
     if self.encryption_active:
       self.header_dumper.stop_encryption()
@@ -676,6 +1176,29 @@ class Container:
       self.header_file, self.body_file)
     self.header_file = None
     self.body_file = None
+  def create_mirror_uploads(self, storages):
+    """Returns a function for each of the given storages that uploads this
+    container to it, under the same sequence and index. Should be called
+    after finish_dump and before upload. All the uploads, including the one
+    done by upload, read the same files, so they can run concurrently."""
+    if storages == []:
+      return []
+    header = FileIO.SharedFile(self.header_file)
+    body = FileIO.SharedFile(self.body_file)
+    self.header_file = header.open()
+    self.body_file = body.open()
+    uploads = []
+    for storage in storages:
+      def upload(storage=storage, header_file=header.open(),
+          body_file=body.open()):
+        try:
+          storage.upload_container(self.sequence_id, self.index,
+              header_file, body_file)
+        finally:
+          # A failed upload must not keep the staging file open
+          body_file.close()
+      uploads.append(upload)
+    return uploads
   #
   # Loading mode implementation
   #
@@ -715,22 +1238,99 @@ class Container:
       if listener.is_requested(digest, code):
         return True
     return False
-  def load_blocks(self, listener):
+  def _load_body_blocks(self):
     # Header could be already available without reading the container file,
     # if it was piggybacked in another container that was already read.
     # In such case, it will be supplied in header_file. If the header was
     # not piggybacked, header_file is None.
+    # Otherwise, if the storage can read parts of the container file, only the
+    # header is read from it.
     # Since it might be unnecessary to load any blocks from the container,
     # we don't touch the body file before we know we need blocks from it.
-    logging.debug("Container %d loading blocks", self.index)
-
-    header_file = self.storage.load_header_file(self.sequence_id, self.index)
-    body_file = None
+    if self.loaded_body_blocks is None:
+      self.load_header(
+          self.storage.load_header_file(self.sequence_id, self.index))
+    return self.loaded_body_blocks
+  def load_header(self, header_file=None):
+    """Read the header from header_file if it's available already, or from
+    the container file otherwise. Unlike load_blocks, this doesn't look up
+    the piggybacked headers in the storage, so it can run in a thread other
+    than the one that uses the storage's databases."""
+    if header_file is None:
+      header_file = self.storage.load_header_range(
+          self.sequence_id, self.index)
+      self.loaded_ranged_file = header_file
     if header_file is None:
       logging.debug("Header file not ready. Reading it from body file")
-      body_file = self.storage.load_body_file(self.sequence_id, self.index)
-      header_file = body_file
-    body_blocks = self._load_header(header_file)
+      self.loaded_body_file = self.storage.load_body_file(
+          self.sequence_id, self.index)
+      header_file = self.loaded_body_file
+    self.loaded_body_blocks = self._load_header(header_file)
+    self.loaded_header_size = header_file.tell()
+  def list_requested_blocks(self, listener):
+    """Ask the listener about all the user blocks of the container, and
+    return the (digest, code) of the ones it requests"""
+    return [(digest, code) for (digest, size, code) in self._load_body_blocks()
+        if is_user_code(code) and listener.is_requested(digest, code)]
+  def get_block_sizes(self):
+    """Returns the sizes of the user blocks of the container, by digest"""
+    sizes = {}
+    for (digest, size, code) in self._load_body_blocks():
+      if is_user_code(code):
+        sizes[digest] = size
+    return sizes
+  def list_blocks_from(self, digest, max_size):
+    """List the digests of the user blocks of the body, starting from the given
+    one, as long as their total size is within max_size"""
+    result = []
+    size = 0
+    for (block_digest, block_size, code) in self._load_body_blocks():
+      if not is_user_code(code):
+        continue
+      if result == [] and block_digest != digest:
+        continue
+      if result != [] and size + block_size > max_size:
+        break
+      result.append(block_digest)
+      size += block_size
+    return result
+  def locate_block(self, digest):
+    """Find where the block is stored in the body. Returns (offset, size,
+    block_offset, block_size, compression_code): the offset and the size
+    within the body of the data to be read to get the block, which is either
+    a compression group or the block itself, and the offset and the size of
+    the block within this data once it is uncompressed. compression_code is
+    None if the block is not compressed. The offsets within the body are
+    relative to its start. Returns None if the container has no such block."""
+    if self.loaded_block_locations is None:
+      body_blocks = self._load_body_blocks()
+      holders = {}
+      for (table_idx, offset, size) in self.loaded_block_offsets:
+        code = body_blocks[table_idx][2]
+        if not is_encryption_code(code):
+          if not is_compression_code(code):
+            code = None
+          holders[table_idx] = (offset, size, code)
+      self.loaded_block_locations = {}
+      for i in range(len(body_blocks)):
+        (block_digest, block_size, code) = body_blocks[i]
+        if holders.has_key(i):
+          holder = holders[i]
+          block_offset = 0
+        if not is_user_code(code):
+          continue
+        offset, size, compression_code = holder
+        if not self.loaded_block_locations.has_key(block_digest):
+          self.loaded_block_locations[block_digest] = (offset, size,
+              block_offset, block_size, compression_code)
+        block_offset += block_size
+    return self.loaded_block_locations.get(digest)
+  def load_blocks(self, listener):
+    logging.debug("Container %d loading blocks", self.index)
+
+    body_blocks = self._load_body_blocks()
+    body_file = self.loaded_body_file
+    header_size = self.loaded_header_size
     
     body_needed = False
     for (digest, size, code) in body_blocks:
@@ -744,14 +1344,38 @@ class Container:
       logging.debug("Container %d does not need to load body" % self.index)
       return
     
-    if body_file is None:
-      header_size = header_file.tell()
-      body_file = self.storage.load_body_file(self.sequence_id, self.index)
+    if body_file is not None:
       body_file.seek(header_size)
+    else:
+      # Fetch only the parts of the body that are needed, unless they make up
+      # most of it anyway.
+      body_ranges = compute_body_ranges(body_blocks, listener)
+      ranges_size = sum([size for (offset, size) in body_ranges])
+      if ranges_size > compute_body_size(body_blocks) / 2:
+        body_file = self.storage.load_body_file(self.sequence_id, self.index)
+        body_file.seek(header_size)
+      else:
+        logging.debug("Container %d fetches %d bytes of the body in %d ranges"
+            % (self.index, ranges_size, len(body_ranges)))
+        def fetch_range(offset, size):
+          return self.storage.load_body_range(
+              self.sequence_id, self.index, offset, size)
+        body_file = self.loaded_ranged_file
+        if body_file is None:
+          body_file = RangedFile(fetch_range)
+        else:
+          # The header is kept, but the body is fetched as a body range, so
+          # that the storage counts the misses of the containers loaded
+          # repeatedly.
+          body_file.fetch_range = fetch_range
+        body_file.seek(header_size)
+        body_file.prefetch([(header_size + offset, size)
+          for (offset, size) in body_ranges])
 
     body_dump_loader = DataDumpLoader(
         body_file, body_blocks,
-        password=self.storage.get_encryption_key())
+        password=self.storage.get_encryption_key(),
+        decompression_pool=self.storage.get_compression_pool())
     body_dump_loader.load_blocks(listener)
   def _load_header(self, header_file):
     logging.debug("****************************** loading header")
@@ -759,7 +1383,7 @@ class Container:
     if MAGIC != magic:
       raise Exception("Manent: magic number not found")
     version = Format.read_int(header_file)
-    if version != VERSION:
+    if version not in SUPPORTED_VERSIONS:
       raise Exception("Container %d has unsupported version" % self.index)
     index = Format.read_int(header_file)
     if index != self.index:
@@ -781,11 +1405,15 @@ class Container:
     class BlockTableListener:
       def __init__(self):
         self.body_table_str = None
+        self.offsets_str = None
       def is_requested(self, digest, code):
-        return code == CODE_BLOCK_TABLE
+        return code == CODE_BLOCK_TABLE or code == CODE_BLOCK_OFFSETS
       def loaded(self, digest, code, data):
-        assert code == CODE_BLOCK_TABLE
-        self.body_table_str = data
+        if code == CODE_BLOCK_TABLE:
+          self.body_table_str = data
+        else:
+          assert code == CODE_BLOCK_OFFSETS
+          self.offsets_str = data
 
     listener = BlockTableListener()
     header_dump_str_io = StringIO.StringIO(header_dump_str)
@@ -795,5 +1423,10 @@ class Container:
 
     body_table_io = StringIO.StringIO(listener.body_table_str)
     blocks = unserialize_blocks(body_table_io)
+    if listener.offsets_str is not None:
+      self.loaded_block_offsets = unserialize_block_offsets(
+          listener.offsets_str)
+    else:
+      self.loaded_block_offsets = compute_block_offsets(blocks)
     return blocks
 
@@ -0,0 +1,114 @@
+#
+#    Copyright (C) 2008 Alex Gontmakher <gsasha@gmail.com>
+#    License: see LICENSE.txt
+#
+
+import logging
+import os
+import os.path
+import tempfile
+import threading
+
+import Reporting
+
+TMP_PREFIX = "tmp-"
+
+class ContainerCache:
+  """Keeps the downloaded container files in a local directory, so that a
+  container that is needed again is not downloaded again.
+
+  Containers never change once written, so a cached file never becomes
+  stale. The total size of the files is kept under max_size by removing the
+  least recently used ones. The time of the last use is kept as the
+  modification time of the file, so the order survives between runs and is
+  shared by all the caches that use the same directory.
+  """
+  def __init__(self, path, max_size):
+    self.path = path
+    self.max_size = max_size
+    self.lock = threading.Lock()
+    self.report_manager = Reporting.DummyReportManager()
+    if not os.path.isdir(path):
+      os.makedirs(path)
+  def set_report_manager(self, report_manager):
+    self.report_manager = report_manager
+  def get_max_size(self):
+    return self.max_size
+
+  def get(self, name):
+    """Returns the cached file open for reading, or None"""
+    path = os.path.join(self.path, name)
+    try:
+      file = open(path, "rb")
+    except IOError:
+      return None
+    try:
+      # Mark the file as recently used
+      os.utime(path, None)
+    except OSError:
+      pass
+    self.report_manager.increment("storage.container_cache.hits", 1)
+    return file
+  def load(self, name, download):
+    """Returns the cached file open for reading. If it's not in the cache,
+    download(file) is called to write it."""
+    file = self.get(name)
+    if file is not None:
+      return file
+    self.report_manager.increment("storage.container_cache.misses", 1)
+    # Download to a temporary name, so that an interrupted download is never
+    # taken for the container
+    handle, tmp_path = tempfile.mkstemp(prefix=TMP_PREFIX, dir=self.path)
+    try:
+      tmp_file = os.fdopen(handle, "wb")
+      try:
+        download(tmp_file)
+      finally:
+        tmp_file.close()
+      path = os.path.join(self.path, name)
+      os.rename(tmp_path, path)
+    except:
+      os.unlink(tmp_path)
+      raise
+    file = open(path, "rb")
+    self.evict()
+    return file
+
+  def get_size(self):
+    size = 0
+    for name, path, stat in self._list_files():
+      size += stat.st_size
+    return size
+  def evict(self):
+    """Remove the least recently used files until the cache fits in
+    max_size. A file that is open can still be read after it is removed."""
+    self.lock.acquire()
+    try:
+      files = [(stat.st_mtime, stat.st_size, path)
+          for name, path, stat in self._list_files()]
+      files.sort()
+      size = sum([file_size for mtime, file_size, path in files])
+      for mtime, file_size, path in files:
+        if size <= self.max_size:
+          break
+        logging.debug("Evicting cached container %s" % path)
+        try:
+          os.unlink(path)
+        except OSError:
+          # Removed by somebody else, or, on Windows, still open
+          continue
+        size -= file_size
+        self.report_manager.increment("storage.container_cache.evictions", 1)
+    finally:
+      self.lock.release()
+  def _list_files(self):
+    result = []
+    for name in os.listdir(self.path):
+      if name.startswith(TMP_PREFIX):
+        continue
+      path = os.path.join(self.path, name)
+      try:
+        result.append((name, path, os.stat(path)))
+      except OSError:
+        pass
+    return result
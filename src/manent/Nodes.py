@@ -38,6 +38,19 @@ STAT_PRESERVED_MODES = [
   stat.ST_SIZE,
   stat.ST_INO]
 
+# The stats that are compared to find whether a restored file is already in
+# place. The ones that change with the inode can't be restored.
+STAT_RESTORED_MODES = [
+  stat.ST_MODE,
+  stat.ST_UID,
+  stat.ST_GID,
+  stat.ST_MTIME,
+  stat.ST_SIZE]
+
+# The number of blocks of a file whose loading starts ahead of the block
+# being restored
+PREFETCH_BLOCKS = 16
+
 NULL_STAT = {}
 for s in STAT_PRESERVED_MODES:
   NULL_STAT[s] = 0
@@ -161,6 +174,7 @@ class Node:
       return False
     if not dryrun:
       otherFile = ctx.inodes_db[self.digest]
+      self.clear_target()
       os.link(otherFile, self.path())
     return True
 
@@ -226,6 +240,24 @@ class Node:
     #print "changed node", self.path()
     ctx.changed_nodes += 1
     return False
+  def has_restored_stats(self):
+    """Check if the node's path exists, and has the stats that
+    restore_stats would give it"""
+    try:
+      node_stat = os.lstat(self.path())
+    except OSError:
+      return False
+    for mode in STAT_RESTORED_MODES:
+      if os.name == 'nt' and mode in [stat.ST_UID, stat.ST_GID]:
+        continue
+      if node_stat[mode] != self.stats[mode]:
+        return False
+    return True
+  def clear_target(self):
+    """Remove the file or symlink that is in the way of restoring the node"""
+    if os.path.lexists(self.path()):
+      logging.info("Replacing " + self.path())
+      os.unlink(self.path())
   def restore_stats(self,
                     restore_chmod=True,
                     restore_chown=True,
@@ -325,8 +357,8 @@ class File(Node):
     """
     logging.info("Testing " + self.path())
     packer = PackerStream.PackerIStream(self.backup, self.digest,
-      self.level)
-    for data in FileIO.read_blocks(packer, Digest.dataDigestSize()):
+      self.level, PREFETCH_BLOCKS)
+    for data in packer.iter_blocks(verify=True):
       # Do nothing with the data, just make sure it got loaded
       pass
 
@@ -344,20 +376,45 @@ class File(Node):
     if self.restore_hlink(ctx):
       return
 
+    if ctx.incremental and self.is_restored(ctx):
+      logging.info("File %s is unchanged" % self.path())
+      return
+    # Writing to an existing file would change its other hard links too
+    self.clear_target()
+
     #
     # No, this file is new. Create it.
     #
     packer = PackerStream.PackerIStream(self.backup, self.digest,
-      self.level)
+      self.level, PREFETCH_BLOCKS)
     file = open(self.path(), "wb")
-    for data in FileIO.read_blocks(packer, Digest.dataDigestSize()):
-      #print "File", self.path(), "reading digest",
-      #    base64.b64encode(digest)
+    for data in packer.iter_blocks():
       file.write(data)
     file.close()
     
     self.restore_stats()
   
+  def is_restored(self, ctx):
+    """Check if the file on the target already has the restored stats. If
+    ctx.compare_data is set, its data is compared too, by the digests of its
+    blocks, which needs no data loaded from the storages."""
+    if not self.has_restored_stats():
+      return False
+    if not ctx.compare_data:
+      return True
+    digests = list(PackerStream.PackerDigestLister(self.backup, self.digest,
+      self.level))
+    num_blocks = 0
+    file = open(self.path(), "rb")
+    try:
+      for data in FileIO.read_blocks(file, self.backup.get_block_size()):
+        if (num_blocks == len(digests) or
+            Digest.dataDigest(data) != digests[num_blocks]):
+          return False
+        num_blocks += 1
+    finally:
+      file.close()
+    return num_blocks == len(digests)
   def retrieve(self, stream):
     """
     Recreate the data from the information stored in the backup into the given
@@ -365,8 +422,8 @@ class File(Node):
     """
     logging.info("Retrieving file " + self.path())
     packer = PackerStream.PackerIStream(self.backup, self.digest,
-        self.level)
-    for data in FileIO.read_blocks(packer, Digest.dataDigestSize()):
+        self.level, PREFETCH_BLOCKS)
+    for data in packer.iter_blocks():
       stream.write(data)
 
   def list_files(self):
@@ -426,6 +483,10 @@ class Symlink(Node):
     packer = PackerStream.PackerIStream(self.backup, self.digest,
       self.level)
     self.link = packer.read()
+    if ctx.incremental and self.is_restored(self.link):
+      logging.info("Symlink %s is unchanged" % self.path())
+      return
+    self.clear_target()
     try:
       os.symlink(self.link, self.path())
       # on Linux, there is no use of the mode of a symlink
@@ -435,6 +496,12 @@ class Symlink(Node):
       logging.info("Failed restoring symlink ", self.path(), " to ", self.link)
 
 
+  def is_restored(self, link):
+    """Check if the symlink on the target already points to the given
+    link"""
+    return (os.path.islink(self.path()) and
+        os.readlink(self.path()) == link)
+
   def list_files(self):
     logging.info("S " + base64.b64encode(self.get_digest())[:8] +
         '...' + self.path())
@@ -652,47 +719,19 @@ class Directory(Node):
   def test(self, ctx):
     logging.info("Testing " + self.path())
 
-    packer = PackerStream.PackerIStream(self.backup, self.get_digest(),
-      self.get_level())
-    for (node_type, node_name, node_stat, node_digest, node_level) in\
-      self.read_directory_entries(packer):
-      if node_type == NODE_TYPE_DIR:
-        node = Directory(self.backup, self, node_name)
-      elif node_type == NODE_TYPE_FILE:
-        node = File(self.backup, self, node_name)
-      elif node_type == NODE_TYPE_SYMLINK:
-        node = Symlink(self.backup, self, node_name)
-      else:
-        raise Exception("Unknown node type [%s]"%node_type)
-      node.set_stats(node_stat)
-      node.set_digest(node_digest)
-      node.set_level(node_level)
+    for node in self.list_child_nodes():
       node.test(ctx)
   
   def restore(self, ctx):
     logging.info("Restoring " + self.path())
     if self.parent != None:
       try:
-        os.mkdir(self.path())
+        self.make_directory()
       except:
         logging.error("Failed creating directory " + self.path())
         return
 
-    packer = PackerStream.PackerIStream(self.backup, self.get_digest(),
-      self.get_level())
-    for (node_type, node_name, node_stat, node_digest, node_level) in\
-      self.read_directory_entries(packer):
-      if node_type == NODE_TYPE_DIR:
-        node = Directory(self.backup, self, node_name)
-      elif node_type == NODE_TYPE_FILE:
-        node = File(self.backup, self, node_name)
-      elif node_type == NODE_TYPE_SYMLINK:
-        node = Symlink(self.backup, self, node_name)
-      else:
-        raise Exception("Unknown node type [%s]"%node_type)
-      node.set_stats(node_stat)
-      node.set_digest(node_digest)
-      node.set_level(node_level)
+    for node in self.list_child_nodes():
       node.restore(ctx)
     try:
       self.restore_stats()
@@ -701,6 +740,15 @@ class Directory(Node):
       traceback.print_exc()
       return
 
+  def make_directory(self):
+    # A directory that exists already, e.g., from an earlier restore, is
+    # restored into. The files, links and symlinks in the way of the restored
+    # ones are replaced.
+    if os.path.isdir(self.path()) and not os.path.islink(self.path()):
+      logging.info("Directory %s exists" % self.path())
+      return
+    os.mkdir(self.path())
+
   def list_files(self):
     print "D", base64.b64encode(self.digest)[:8]+'...', self.path()
     packer = PackerStream.PackerIStream(self.backup, self.get_digest(),
@@ -749,6 +797,25 @@ class Directory(Node):
   def get_child_node_names(self):
     return self.children_nodes_data.keys()
 
+  def list_child_nodes(self):
+    """Yield the nodes of the directory entries, with their stats, digests
+    and levels set"""
+    packer = PackerStream.PackerIStream(self.backup, self.get_digest(),
+      self.get_level())
+    for (node_type, node_name, node_stat, node_digest, node_level) in\
+      self.read_directory_entries(packer):
+      if node_type == NODE_TYPE_DIR:
+        node = Directory(self.backup, self, node_name)
+      elif node_type == NODE_TYPE_FILE:
+        node = File(self.backup, self, node_name)
+      elif node_type == NODE_TYPE_SYMLINK:
+        node = Symlink(self.backup, self, node_name)
+      else:
+        raise Exception("Unknown node type [%s]"%node_type)
+      node.set_stats(node_stat)
+      node.set_digest(node_digest)
+      node.set_level(node_level)
+      yield node
   def read_directory_entries(self, file):
     while True:
       node_type = Format.read_int(file)
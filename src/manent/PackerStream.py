@@ -3,6 +3,7 @@
 #    License: see LICENSE.txt
 #
 
+import base64
 import cStringIO as StringIO
 
 import Container
@@ -96,16 +97,57 @@ class PackerDigestLister:
 
 class PackerIStream(StreamAdapter.IStreamAdapter):
   """
-  This istream reads its data from a stream of containers
+  This istream reads its data from a stream of containers.
+
+  If prefetch is given, the digests are listed that many blocks ahead of the
+  one being read, and passed to backup.prefetch_blocks, which can start
+  loading their containers in the background.
   """
-  def __init__(self, backup, digest, level):
+  def __init__(self, backup, digest, level, prefetch=0):
     StreamAdapter.IStreamAdapter.__init__(self)
     
     self.backup = backup
     self.digest_lister = PackerDigestLister(self.backup, digest, level)
+    self.prefetch = prefetch
+    # The digests that were listed and prefetched, but not read yet
+    self.prefetched_digests = []
+  def next_digest(self):
+    if self.prefetch == 0:
+      return self.digest_lister.next()
+    new_digests = []
+    for digest in self.digest_lister:
+      new_digests.append(digest)
+      if len(self.prefetched_digests) + len(new_digests) > self.prefetch:
+        break
+    if new_digests:
+      self.backup.prefetch_blocks(new_digests)
+      self.prefetched_digests += new_digests
+    if not self.prefetched_digests:
+      raise StopIteration
+    return self.prefetched_digests.pop(0)
   def read_block(self):
     try:
-      digest = self.digest_lister.next()
+      digest = self.next_digest()
       return self.backup.load_block(digest)
     except StopIteration:
       return ""
+  def iter_blocks(self, verify=False):
+    """Yield the rest of the data in the blocks as they are stored. This is
+    much faster than reading the stream in small pieces. If verify is set,
+    the data of each block is checked against its digest."""
+    if self.buf is not None:
+      # Data left over from a read
+      data = self.buf.read()
+      self.buf = None
+      if len(data) > 0:
+        yield data
+    while True:
+      try:
+        digest = self.next_digest()
+      except StopIteration:
+        return
+      data = self.backup.load_block(digest)
+      if verify and Digest.dataDigest(data) != digest:
+        raise Exception("Critical error: Bad digest of block %s" %
+            base64.b64encode(digest))
+      yield data
@@ -0,0 +1,266 @@
+#
+#    Copyright (C) 2008 Alex Gontmakher <gsasha@gmail.com>
+#    License: see LICENSE.txt
+#
+
+import base64
+import logging
+import os
+import traceback
+
+import Nodes
+import PackerStream
+import utils.ThreadPool as ThreadPool
+
+# The number of threads writing the restored files
+DEFAULT_WRITERS = 4
+
+def _create_file(path):
+  # Runs in the writers pool. An existing file is truncated, so that nothing
+  # is left of it past the restored data.
+  open(path, "wb").close()
+def _write_file(path, offset, data):
+  # Runs in the writers pool. The file was created before any of its blocks
+  # is written, so the writes can be done in any order.
+  fd = os.open(path, os.O_WRONLY | getattr(os, "O_BINARY", 0))
+  try:
+    os.lseek(fd, offset, 0)
+    while data:
+      data = data[os.write(fd, data):]
+  finally:
+    os.close(fd)
+
+class ScatterListener:
+  """Requests the given blocks from a container, and hands each one to the
+  planner as it's loaded"""
+  def __init__(self, planner, digests):
+    self.planner = planner
+    self.digests = set(digests)
+  def is_requested(self, digest, code):
+    return digest in self.digests
+  def loaded(self, digest, code, data):
+    if digest in self.digests:
+      self.digests.remove(digest)
+      self.planner.scatter(digest, data)
+
+class RestorePlanner:
+  """Restores a tree, loading every container it needs only once.
+
+  Restoring the files one after another loads a container for every block
+  that is not in the block cache, so a container whose blocks are needed by
+  many files can be loaded many times. Instead, the restore is done in
+  phases:
+  1. The directories are walked, creating the directories and empty files,
+     and the digests of the data of every file are collected. This needs
+     only the metadata, which is cached locally.
+  2. The data blocks are grouped by the container they are to be loaded
+     from. The sizes of the blocks are read from the container headers, and
+     give the offset of every block in its files.
+  3. Every container is loaded once, and each of its blocks is written to all
+     the places it appears in.
+  4. The hard links and the symlinks are created, and the stats are restored,
+     the children of a directory before the directory itself.
+
+  All the directories are created before any file. The files are then written
+  by a pool of writer threads, while the containers are loaded by this
+  thread.
+  """
+  def __init__(self, backup, storage_manager, num_writers=DEFAULT_WRITERS):
+    self.backup = backup
+    self.storage_manager = storage_manager
+    self.writers_pool = ThreadPool.ThreadPool(num_writers)
+    self.max_pending_writes = 2 * max(1, num_writers)
+    self.pending_writes = []
+    # The files and symlinks, with the digests of their data
+    self.files = []
+    self.symlinks = []
+    # The files that are hard links to files restored before them
+    self.hlinks = []
+    # The nodes in the order their stats are to be restored
+    self.stat_nodes = []
+    # digest -> [(file index, offset)]
+    self.placements = {}
+    # The data of the symlinks, by the index in self.symlinks
+    self.symlink_data = {}
+    self.num_containers = 0
+
+  def restore(self, root, ctx):
+    try:
+      self.restore_tree(root, ctx)
+    finally:
+      self.writers_pool.close()
+  def restore_tree(self, root, ctx):
+    logging.info("Restoring %s: collecting the files" % root.path())
+    self.walk(root, ctx)
+    # All the files must exist before their blocks are written
+    self.wait_writes()
+    needed = set()
+    for node, digests in self.files + self.symlinks:
+      needed.update(digests)
+    logging.info("Restoring %s: %d files, %d blocks" %
+        (root.path(), len(self.files), len(needed)))
+    groups = self.storage_manager.group_blocks_by_container(needed)
+    for storage, container, digests in self.plan(groups):
+      self.load_container(storage, container, digests)
+    logging.info("Restoring %s: loaded %d containers" %
+        (root.path(), self.num_containers))
+    self.finish(ctx)
+
+  def walk(self, directory, ctx):
+    if directory.parent is not None:
+      try:
+        directory.make_directory()
+      except:
+        # As in Directory.restore, the subtree is skipped
+        logging.error("Failed creating directory " + directory.path())
+        return
+    for node in directory.list_child_nodes():
+      if node.get_type() == Nodes.NODE_TYPE_DIR:
+        self.walk(node, ctx)
+        continue
+      if node.get_type() == Nodes.NODE_TYPE_FILE:
+        # The linked file might not be written yet, so the links are created
+        # at the end
+        if node.restore_hlink(ctx, dryrun=True):
+          self.hlinks.append(node)
+          continue
+        if ctx.incremental and node.is_restored(ctx):
+          logging.info("File %s is unchanged" % node.path())
+          continue
+        node.clear_target()
+        digests = self.list_digests(node)
+        self.submit_write(_create_file, node.path())
+        self.files.append((node, digests))
+        self.stat_nodes.append(node)
+      else:
+        # The symlinks are created at the end, once their data is loaded
+        self.symlinks.append((node, self.list_digests(node)))
+    self.stat_nodes.append(directory)
+  def list_digests(self, node):
+    return list(PackerStream.PackerDigestLister(self.backup,
+      node.get_digest(), node.get_level()))
+
+  def plan(self, groups):
+    """Compute the offsets of all the blocks in their files. Returns the
+    (storage, container, digests) to load the blocks from, with the headers
+    of the containers loaded. The blocks of a container whose header fails
+    to load are loaded from their other sources."""
+    sizes = {}
+    loads = []
+    failed = set()
+    groups = list(groups)
+    while groups:
+      storage, sequence_id, container_idx, digests = groups.pop(0)
+      try:
+        container = storage.get_container(sequence_id, container_idx)
+        sizes.update(container.get_block_sizes())
+      except:
+        traceback.print_exc()
+        logging.warning("Failed to load the header of container %d from "
+            "storage %d, trying the other sources of its blocks" %
+            (container_idx, storage.get_index()))
+        storage.record_load_failure()
+        failed.add((storage.get_index(), sequence_id, container_idx))
+        groups += self.regroup(digests, failed)
+        continue
+      loads.append((storage, container, digests))
+    self.placements = {}
+    for i in range(len(self.files)):
+      node, digests = self.files[i]
+      offset = 0
+      for digest in digests:
+        self.placements.setdefault(digest, []).append((i, offset))
+        offset += sizes[digest]
+    for i in range(len(self.symlinks)):
+      node, digests = self.symlinks[i]
+      for digest in digests:
+        # Symlinks are short, so their data is kept in memory
+        self.placements.setdefault(digest, []).append((-1 - i, None))
+    return loads
+  def regroup(self, digests, failed):
+    """Group the given blocks by the container they are best loaded from,
+    other than the failed ones"""
+    groups = {}
+    for digest in digests:
+      for storage, sequence_id, container_idx in (
+          self.storage_manager.get_block_sources(digest)):
+        key = (storage.get_index(), sequence_id, container_idx)
+        if key not in failed:
+          break
+      else:
+        raise Exception("No container to load block %s from" %
+            base64.b64encode(digest))
+      if not groups.has_key(key):
+        groups[key] = (storage, sequence_id, container_idx, [])
+      groups[key][3].append(digest)
+    return [groups[key] for key in sorted(groups.keys())]
+  def load_container(self, storage, container, digests):
+    logging.debug("Loading %d blocks from container %s:%d" %
+        (len(digests), base64.urlsafe_b64encode(container.get_sequence_id()),
+          container.get_index()))
+    self.num_containers += 1
+    listener = ScatterListener(self, digests)
+    try:
+      container.load_blocks(listener)
+    except:
+      traceback.print_exc()
+      logging.warning("Failed to load container %d, loading its blocks "
+          "one by one" % container.get_index())
+      storage.record_load_failure()
+    # Whatever was not loaded from the container is loaded from the other
+    # storages that have it.
+    for digest in list(listener.digests):
+      self.scatter(digest, self.backup.load_block(digest))
+  def scatter(self, digest, data):
+    for index, offset in self.placements[digest]:
+      if index < 0:
+        self.symlink_data.setdefault(-1 - index, {})[digest] = data
+        continue
+      node, digests = self.files[index]
+      self.write(node.path(), offset, data)
+  def write(self, path, offset, data):
+    self.submit_write(_write_file, path, offset, data)
+  def submit_write(self, func, *args):
+    self.pending_writes.append(self.writers_pool.submit(func, *args))
+    # Don't keep too much data waiting for busy writers
+    self.wait_writes(self.max_pending_writes)
+  def wait_writes(self, max_pending=0):
+    while len(self.pending_writes) > max_pending:
+      self.pending_writes.pop(0).result()
+
+  def finish(self, ctx):
+    self.wait_writes()
+    for node in self.hlinks:
+      node.restore_hlink(ctx)
+    for i in range(len(self.symlinks)):
+      node, digests = self.symlinks[i]
+      if node.restore_hlink(ctx):
+        continue
+      data = self.symlink_data.get(i, {})
+      link = "".join([data[digest] for digest in digests])
+      if ctx.incremental and node.is_restored(link):
+        continue
+      node.clear_target()
+      try:
+        os.symlink(link, node.path())
+        node.restore_stats(restore_chmod=False, restore_utime=False)
+      except:
+        logging.info("Failed restoring symlink %s to %s" %
+            (node.path(), link))
+    # The stats of the files are restored by the writers. The stats of a
+    # directory are restored after all of its contents.
+    tasks = []
+    for node in self.stat_nodes:
+      if node.get_type() == Nodes.NODE_TYPE_FILE:
+        tasks.append(self.writers_pool.submit(self.restore_stats, node))
+    for task in tasks:
+      task.result()
+    for node in self.stat_nodes:
+      if node.get_type() == Nodes.NODE_TYPE_DIR:
+        self.restore_stats(node)
+  def restore_stats(self, node):
+    try:
+      node.restore_stats()
+    except:
+      logging.error("Failed restoring stats for " + node.path())
+      traceback.print_exc()
@@ -6,22 +6,89 @@
 import base64
 import cStringIO as StringIO
 import logging
+import math
+import multiprocessing
 import os
 import re
 import shutil
 import tempfile
+import threading
 import time
-import traceback
 
 import Config
 import Container
+import ContainerCache
+import utils.BandwidthLimiter as BandwidthLimiter
+import utils.FileIO as FileIO
 import utils.IntegerEncodings as IE
 import utils.RemoteFSHandler as RemoteFSHandler
+import utils.ThreadPool as ThreadPool
 import Reporting
 
 CONTAINER_EXT = "mf"
 CONTAINER_EXT_TMP = "mf-tmp"
 
+# Size of the containers, unless configured otherwise. With adaptive sizing,
+# the size is kept within the limits.
+DEFAULT_CONTAINER_SIZE = 16 << 20
+MIN_CONTAINER_SIZE = 1 << 20
+MAX_CONTAINER_SIZE = 512 << 20
+
+def parse_size(size_str):
+  """Parse a size given in bytes, possibly with a K, M or G suffix"""
+  multipliers = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+  suffix = size_str[-1:].upper()
+  if multipliers.has_key(suffix):
+    return int(size_str[:-1]) * multipliers[suffix]
+  return int(size_str)
+
+def parse_bandwidth_schedule(spec):
+  """Parse a bandwidth limit, in bytes per second. The limit is either a
+  single rate, or a comma separated list of rates for the times of day, such
+  as "08:00-19:00=100K,1M". A rate without the time applies outside of the
+  given times. The rate can be "unlimited"."""
+  def parse_rate(rate_str):
+    if rate_str == "unlimited":
+      return None
+    return parse_size(rate_str)
+  def parse_time(time_str):
+    hours, minutes = time_str.split(":")
+    return int(hours) * 60 + int(minutes)
+  periods = []
+  default_rate = None
+  for entry in spec.split(","):
+    entry = entry.strip()
+    if "=" in entry:
+      times, rate_str = entry.split("=")
+      start, end = times.split("-")
+      periods.append((parse_time(start), parse_time(end), parse_rate(rate_str)))
+    else:
+      default_rate = parse_rate(entry)
+  return BandwidthLimiter.BandwidthSchedule(periods, default_rate)
+
+# The default size limit of the local cache of downloaded containers
+DEFAULT_CONTAINER_CACHE_SIZE = 256 << 20
+# Once so many ranges of the body of a container were downloaded, the whole
+# body is downloaded into the cache, so that its next ranges are read locally.
+CACHED_RANGE_MISSES = 2
+
+# The listing of the remote container files is redone if the last one is
+# older than this, in seconds. Until then, only the new containers of the
+# known sequences are looked for.
+DEFAULT_LISTING_MAX_AGE = 60 * 60
+# A sequence can have holes of up to 3 indices before a summary container,
+# so the search for the new containers of a sequence stops only after so many
+# missing indices in a row.
+PROBE_GAP = 4
+
+# The weight of a new measurement in the running averages of the latency and
+# the throughput of loading from a storage.
+LOAD_STATS_WEIGHT = 0.3
+
+# Data read on demand from the start of a container file is fetched in pieces
+# of at least this size. Most headers fit in one piece.
+HEADER_FETCH_SIZE = 64 << 10
+
 def _instantiate(storage_type, storage_params):
   if storage_type == "directory":
     return DirectoryStorage(storage_params)
@@ -49,7 +116,8 @@ def create_storage(db_manager, txn_manager, index, params,
   storage.configure(params, new_block_handler)
   return storage
 
-def load_storage(db_manager, txn_manager, index, new_block_handler):
+def load_storage(db_manager, txn_manager, index, new_block_handler,
+    full_listing=False):
   logging.debug("Opening storage database %s:%s" %
       ("config.db", "storage.%d" % index))
   config_db = db_manager.get_database_btree("config.db",
@@ -57,6 +125,8 @@ def load_storage(db_manager, txn_manager, index, new_block_handler):
   storage_type = config_db["TYPE"]
   storage_params = StorageParams(index, db_manager, txn_manager, config_db)
   storage = _instantiate(storage_type, storage_params)
+  if full_listing:
+    storage.request_full_listing()
   storage.load_configuration(new_block_handler)
   return storage
 
@@ -87,13 +157,36 @@ class Storage:
     self.headers_loaded_total = 0
     self.headers_loaded_from_summary = 0
     self.headers_loaded_from_storage = 0
+    # Sizes of the containers being uploaded, by (sequence_id, index)
+    self.upload_container_sizes = {}
 
     self.report_manager = Reporting.DummyReportManager()
+    self.compression_pool = None
+    self.upload_pool = None
+    self.download_pool = None
+    self.adapted_container_size = None
+    # Running averages of the time to read a container header and of the
+    # throughput of loading blocks, or None if they were not measured yet.
+    self.load_latency = None
+    self.load_throughput = None
+    self.load_failed = False
+    # The first container of each sequence this storage has. Only a mirror
+    # storage starts in the middle of a sequence.
+    self.sequence_first_container = {}
 
   def set_report_manager(self, report_manager):
     self.report_manager = report_manager
 
   def close(self):
+    if self.compression_pool is not None:
+      self.compression_pool.close()
+      self.compression_pool = None
+    if self.upload_pool is not None:
+      self.upload_pool.close()
+      self.upload_pool = None
+    if self.download_pool is not None:
+      self.download_pool.close()
+      self.download_pool = None
     self.loaded_headers_db.close()
     self.loaded_headers_db = None
     self.config_db.close()
@@ -109,12 +202,46 @@ class Storage:
         "storage.container.upload.%s.%d.size" %
         (base64.b64encode(sequence_id), index),
         "%d" % total_size)
+    self.upload_container_sizes[(sequence_id, index)] = total_size
 
   def report_upload_container_done(self, sequence_id, index, time):
     self.report_manager.set(
         "storage.container.upload.%s.%d.time" %
         (base64.b64encode(sequence_id), index),
         "%f" % time)
+    self.adapt_container_size(
+        self.upload_container_sizes.pop((sequence_id, index)), time)
+  #
+  # Container sizing
+  #
+  def container_size(self):
+    # The size is configured as 'container_size'. If 'container_upload_time'
+    # is configured, the size adapts to the measured upload speed, so that a
+    # container takes about that many seconds to upload.
+    if self.config.has_key('container_upload_time'):
+      if self.adapted_container_size is not None:
+        return self.adapted_container_size
+      if self.config_db.has_key("adaptive_container_size"):
+        return int(self.config_db["adaptive_container_size"])
+    if self.config.has_key('container_size'):
+      return parse_size(self.config['container_size'])
+    return DEFAULT_CONTAINER_SIZE
+  def adapt_container_size(self, size, upload_time):
+    if not self.config.has_key('container_upload_time'):
+      return
+    if size == 0 or upload_time <= 0:
+      return
+    target_time = float(self.config['container_upload_time'])
+    ideal_size = size / upload_time * target_time
+    # Move half the way (on the logarithmic scale), so that a single slow or
+    # fast upload doesn't swing the size too much.
+    new_size = int(math.sqrt(self.container_size() * ideal_size))
+    new_size = max(MIN_CONTAINER_SIZE, min(MAX_CONTAINER_SIZE, new_size))
+    logging.debug("Container of %d bytes uploaded in %f seconds, "
+        "setting container size to %d" % (size, upload_time, new_size))
+    # The uploads run in the background, so the size is saved to the database
+    # only on flush.
+    self.adapted_container_size = new_size
   #
   # Loading
   #
@@ -143,6 +270,55 @@ class Storage:
     return None
   def get_index(self):
     return self.index
+  def get_compression_workers(self):
+    # The number of threads that compress and decompress container bodies.
+    # Zero means that this is done by the thread that adds or loads the
+    # blocks.
+    if self.config.has_key('compression_workers'):
+      return int(self.config['compression_workers'])
+    return multiprocessing.cpu_count()
+  def get_upload_workers(self):
+    # The number of threads that upload containers in the background.
+    if self.config.has_key('upload_workers'):
+      return int(self.config['upload_workers'])
+    return 1
+  def get_max_pending_uploads(self):
+    # The number of containers that can be written before waiting for their
+    # uploads to finish. The database is committed only after that wait.
+    if self.config.has_key('max_pending_uploads'):
+      return int(self.config['max_pending_uploads'])
+    return 4
+  def get_upload_pool(self):
+    if self.upload_pool is None:
+      self.upload_pool = ThreadPool.ThreadPool(self.get_upload_workers())
+    return self.upload_pool
+  def get_download_workers(self):
+    # The number of threads that download the new containers when the
+    # sequences are loaded.
+    if self.config.has_key('download_workers'):
+      return int(self.config['download_workers'])
+    return 4
+  def get_download_pool(self):
+    if self.download_pool is None:
+      self.download_pool = ThreadPool.ThreadPool(self.get_download_workers())
+    return self.download_pool
+  def get_compression(self):
+    # The compression of the container bodies is configured as
+    # "<algorithm>[:<level>]", where algorithm is bz2, zlib, lzma or store.
+    if self.config.has_key('compression'):
+      return Container.parse_compression(self.config['compression'])
+    return (Container.CODE_COMPRESSION_BZ2, 9)
+  def is_compression_adaptive(self):
+    # Adaptive compression stores the blocks that don't compress as they are,
+    # saving the time of compressing them. It is off unless configured.
+    if self.config.has_key('adaptive_compression'):
+      return self.config['adaptive_compression'] in ["true", "yes", "1"]
+    return False
+  def get_compression_pool(self):
+    if self.compression_pool is None:
+      self.compression_pool = ThreadPool.ThreadPool(
+          self.get_compression_workers())
+    return self.compression_pool
 
   # Data structure stored in a database for a specific storage:
   # active_sequence - the sequence to which new containers
@@ -151,6 +327,9 @@ class Storage:
   #     container in the given sequence. Used to determine which new
   #     containers have appeared for the sequence. Also, used to know if this
   #     sequence has been loaded already.
+  # reserved_container.$sequence - the index up to which the containers of
+  #     the active sequence can have been uploaded by this client without
+  #     being committed. See reserve_containers.
   def create_sequence(self, test_override_sequence_id=None):
     # If a sequence is created, rather than discovered, it can be done only
     # in order to make it active one.
@@ -173,7 +352,47 @@ class Storage:
   def get_active_sequence_id(self):
     return self.active_sequence_id
   def get_next_index(self):
-    return self.sequences[self.active_sequence_id].get_next_index()
+    return self.sequence_next_container[self.active_sequence_id]
+  def mirror_sequence(self, sequence_id, next_index):
+    # A mirror storage gets a copy of the containers that another storage
+    # writes to its active sequence, starting from next_index. The sequence
+    # is active here too, so that nobody else is expected to write to it.
+    assert self.active_sequence_id is None
+    logging.debug("Mirroring sequence %s from container %d" %
+        (base64.b64encode(sequence_id), next_index))
+    self.active_sequence_id = sequence_id
+    self.config_db[self._key("active_sequence")] = sequence_id
+    self.sequence_first_container[sequence_id] = next_index
+    self.config_db[self._key("first_container.%s" % sequence_id)] =\
+        str(next_index)
+    self.set_next_index(next_index)
+  def reserve_containers(self, reserved_index):
+    """Record that the containers of the active sequence up to reserved_index
+    can be uploaded before the next commit. If the backup is interrupted,
+    such containers are found on the storage although next_container was
+    rolled back. They are adopted rather than taken for the containers of
+    another client."""
+    self.config_db[self._key("reserved_container.%s" %
+      self.active_sequence_id)] = str(reserved_index)
+  def get_reserved_index(self):
+    KEY = self._key("reserved_container.%s" % self.active_sequence_id)
+    if self.config_db.has_key(KEY):
+      return int(self.config_db[KEY])
+    return self.sequence_next_container[self.active_sequence_id]
+  def set_lagging(self):
+    """Mark a mirror storage whose upload has failed. It stops getting new
+    containers, so that it keeps the ones below its next index, without
+    holes."""
+    self.config_db[self._key("lagging")] = "1"
+    self.report_manager.increment("storage.%d.lagging" % self.index, 1)
+  def is_lagging(self):
+    return self.config_db.has_key(self._key("lagging"))
+  def set_next_index(self, next_index):
+    # Used by mirror storages, which get the containers created by another
+    # storage.
+    self.sequence_next_container[self.active_sequence_id] = next_index
+    self.config_db[self._key("next_container.%s" % self.active_sequence_id)] =\
+        str(next_index)
   def load_sequences(self, new_block_handler):
     logging.debug("Loading sequences for storage %d" % self.index)
     # Load previously known sequences
@@ -185,21 +404,19 @@ class Storage:
     for key, value in self.config_db.iteritems_prefix(SEQ_PREFIX):
       seq_id = key[len(SEQ_PREFIX):]
       self.sequence_next_container[seq_id] = int(value)
+    FIRST_PREFIX = self._key("first_container.")
+    for key, value in self.config_db.iteritems_prefix(FIRST_PREFIX):
+      seq_id = key[len(FIRST_PREFIX):]
+      self.sequence_first_container[seq_id] = int(value)
+    if self.config_db.has_key(self._key("load_latency")):
+      self.load_latency = float(self.config_db[self._key("load_latency")])
+      self.load_throughput = float(
+          self.config_db[self._key("load_throughput")])
 
     # Load the data from the storage location
     sequence_new_containers = {}
     sequence_computed_next_container = {}
-    try:
-      container_files = self.list_container_files()
-    except:
-      logging.info("Failed to fetch the container files."
-          " Probably a network problem")
-      container_files = []
-    for name in container_files:
-      sequence_id, index, extension = decode_container_name(name)
-      if extension != CONTAINER_EXT:
-        # This is not a Manent container file.
-        continue
+    for sequence_id, index in self.find_new_containers():
       if not self.sequence_next_container.has_key(sequence_id):
         logging.info("Found new sequence %s " %
           base64.b64encode(sequence_id))
@@ -212,12 +429,25 @@ class Storage:
     for sequence_id, containers in sequence_new_containers.iteritems():
       if (sequence_id == self.active_sequence_id and
           containers != []):
-         # TODO(gsasha): Instead of crashing, abort this sequence and start a new one.
-         # We have seen that somebody else has added a container into sequence we're
-         # supposed to be writing exclusively.
-         raise Exception("Unexpected new containers %s in sequence %s",
-                         (", ".join([str(i) for i in containers]),
-                          base64.b64encode(sequence_id)))
+        if self.is_lagging():
+          # Only the containers below next_container follow each other on a
+          # lagging mirror. The ones uploaded after the failed one are ignored.
+          logging.info("Ignoring containers %s of lagging storage %d" %
+              (str(sorted(containers)), self.index))
+          del containers[:]
+        elif max(containers) < self.get_reserved_index():
+          # These were uploaded by a backup of ours that was interrupted
+          # before it committed.
+          logging.warning("Adopting containers %s of sequence %s, uploaded "
+              "by an interrupted backup" %
+              (str(sorted(containers)), base64.b64encode(sequence_id)))
+        else:
+          # TODO(gsasha): Instead of crashing, abort this sequence and start a new one.
+          # We have seen that somebody else has added a container into sequence we're
+          # supposed to be writing exclusively.
+          raise Exception("Unexpected new containers %s in sequence %s",
+                          (", ".join([str(i) for i in containers]),
+                           base64.b64encode(sequence_id)))
       containers.sort()
       logging.debug("New containers in sequence %s: %s" %
           (base64.urlsafe_b64encode(sequence_id), str(containers)))
@@ -323,40 +553,31 @@ class Storage:
         self.index)
     for sequence_id, containers in sequence_new_containers.iteritems():
       containers.sort()
-      for index in containers:
+      class BlockLoadHandler:
+        """Transfer all the incoming blocks to the given handler,
+        adding the sequence id to each of them."""
+        def __init__(self, sequence_id, container_idx, block_handler):
+          self.sequence_id = sequence_id
+          self.container_idx = container_idx
+          self.block_handler = block_handler
+        def is_requested(self, digest, code):
+          if self.block_handler.is_requested(
+              self.sequence_id, self.container_idx, digest, code):
+            return True
+          return False
+        def loaded(self, digest, code, data):
+          if self.block_handler.is_requested(
+              self.sequence_id, self.container_idx, digest, code):
+            self.block_handler.loaded(self.sequence_id, digest, code, data)
+      def create_handler(index):
         logging.info("Reading container %d for metadata blocks" % index)
-        container = self.get_container(sequence_id, index)
-        class BlockLoadHandler:
-          """Transfer all the incoming blocks to the given handler,
-          adding the sequence id to each of them."""
-          def __init__(self, sequence_id, container_idx, block_handler):
-            self.sequence_id = sequence_id
-            self.container_idx = container_idx
-            self.block_handler = block_handler
-          def is_requested(self, digest, code):
-            if self.block_handler.is_requested(
-                self.sequence_id, self.container_idx, digest, code):
-              return True
-            return False
-          def loaded(self, digest, code, data):
-            if self.block_handler.is_requested(
-                self.sequence_id, self.container_idx, digest, code):
-              self.block_handler.loaded(self.sequence_id, digest, code, data)
-        handler = BlockLoadHandler(sequence_id, index, new_block_handler)
         self.report_manager.increment(
             "storage.container.download.%s.%d.metadata.count" % (
               base64.b64encode(sequence_id),
               index),
             1)
-        start_time = time.time()
-
-        container.load_blocks(handler)
-
-        self.report_manager.append(
-            "storage.container.download.%s.%d.metadata.time" % (
-              base64.b64encode(sequence_id),
-              index),
-            time.time() - start_time)
+        return BlockLoadHandler(sequence_id, index, new_block_handler)
+      self.load_containers(sequence_id, containers, create_handler)
       self.txn_manager.checkpoint()
     # 3. Update the next_container information for all the sequences.
     logging.debug("Loading sequences for storage %d:"
@@ -368,9 +589,168 @@ class Storage:
       self.config_db["next_container." + sequence_id] = str(next_container)
     self.loaded_headers_db.truncate()
     self.txn_manager.commit()
+  def load_containers(self, sequence_id, indices, create_handler):
+    """Load the blocks of the given containers, with the handlers created by
+    create_handler(index).
+
+    The containers are downloaded by the download pool, several at a time.
+    Nevertheless, the handlers are called only from this thread, and see the
+    containers one after another in the given order: all the is_requested
+    calls for a container come before those for the next one, and the
+    loaded calls come in the order of the containers too.
+    """
+    pool = self.get_download_pool()
+    # Create the decompression pool before the workers need it
+    self.get_compression_pool()
+    window = max(1, pool.get_num_workers()) * 2
+    header_tasks = {}
+    body_tasks = []
+    def submit_header(index):
+      container = self.get_container(sequence_id, index)
+      # The piggybacked header is looked up here, the download of a header
+      # that was not piggybacked goes to the pool.
+      header_file = self.load_header_file(sequence_id, index)
+      header_tasks[index] = (container,
+          pool.submit(container.load_header, header_file))
+    def deliver_body():
+      index, handler, task, start_time = body_tasks.pop(0)
+      for digest, code, data in task.result():
+        handler.loaded(digest, code, data)
+      self.report_manager.append(
+          "storage.container.download.%s.%d.metadata.time" % (
+            base64.b64encode(sequence_id),
+            index),
+          time.time() - start_time)
+    for i in range(len(indices)):
+      for index in indices[i:i + window]:
+        if not header_tasks.has_key(index):
+          submit_header(index)
+      index = indices[i]
+      container, header_task = header_tasks.pop(index)
+      start_time = time.time()
+      header_task.result()
+      handler = create_handler(index)
+      requested = container.list_requested_blocks(handler)
+      collector = BlockCollector([digest for digest, code in requested])
+      def load_body(container, collector):
+        if collector.digests:
+          container.load_blocks(collector)
+        return collector.blocks
+      body_tasks.append((index, handler,
+        pool.submit(load_body, container, collector), start_time))
+      while len(body_tasks) > window:
+        deliver_body()
+    while len(body_tasks) > 0:
+      deliver_body()
+  def get_listing_max_age(self):
+    if self.config.has_key('listing_max_age'):
+      return float(self.config['listing_max_age'])
+    return DEFAULT_LISTING_MAX_AGE
+  def request_full_listing(self):
+    # Make the next load of the sequences list all the container files.
+    LISTING_KEY = self._key("listing_time")
+    if self.config_db.has_key(LISTING_KEY):
+      del self.config_db[LISTING_KEY]
+  def find_new_containers(self):
+    """Returns (sequence_id, index) for the containers that might be new.
+    Listing all the files of a storage can take long, so if the last
+    listing is recent enough, only the indices following the known
+    containers of each known sequence are checked. New sequences are found
+    by the next full listing."""
+    LISTING_KEY = self._key("listing_time")
+    now = time.time()
+    if (self.config_db.has_key(LISTING_KEY) and
+        now - float(self.config_db[LISTING_KEY]) < self.get_listing_max_age()):
+      try:
+        containers = self.probe_new_containers()
+      except Exception, e:
+        logging.warning("Failed to probe for new containers in storage %d,"
+            " listing them instead: %s" % (self.index, e))
+        containers = None
+      if containers is not None:
+        return containers
+    try:
+      container_files = self.list_container_files()
+    except:
+      logging.info("Failed to fetch the container files."
+          " Probably a network problem")
+      return []
+    self.config_db[LISTING_KEY] = str(now)
+    containers = []
+    for name in container_files:
+      sequence_id, index, extension = decode_container_name(name)
+      if extension != CONTAINER_EXT:
+        # This is not a Manent container file.
+        continue
+      containers.append((sequence_id, index))
+    return containers
+  def probe_new_containers(self):
+    # Returns None if the storage can't check a single container.
+    containers = []
+    for sequence_id, next_index in self.sequence_next_container.items():
+      index = next_index
+      missing = 0
+      while missing < PROBE_GAP:
+        exists = self.container_exists(sequence_id, index)
+        if exists is None:
+          return None
+        if exists:
+          containers.append((sequence_id, index))
+          missing = 0
+        else:
+          missing += 1
+        index += 1
+    return containers
+  def container_exists(self, sequence_id, index):
+    # Storages that can check for a single file return True or False.
+    return None
+
+  def has_container(self, sequence_id, index):
+    # Does this storage have the given container, as far as we know?
+    if not self.sequence_next_container.has_key(sequence_id):
+      return False
+    first_index = self.sequence_first_container.get(sequence_id, 0)
+    return first_index <= index < self.sequence_next_container[sequence_id]
+
+  #
+  # Load statistics, used to choose the storage to load a block from when
+  # it's found in several
+  #
+  def record_load(self, latency, size, load_time):
+    """Record a load of a container: the time it took to get its header, and
+    the time it took to load the given amount of block data after that"""
+    def average(old, new):
+      if old is None:
+        return new
+      return old + (new - old) * LOAD_STATS_WEIGHT
+    self.load_latency = average(self.load_latency, latency)
+    if size > 0:
+      throughput = size / max(load_time, 0.001)
+      self.load_throughput = average(self.load_throughput, throughput)
+    elif self.load_throughput is None:
+      self.load_throughput = 0.0
+    self.load_failed = False
+  def record_load_failure(self):
+    self.load_failed = True
+  def estimate_load_time(self, size):
+    """The expected time of loading size bytes of blocks from a container.
+    A storage that failed is used last. One that was never measured is tried
+    first, so that it gets measured."""
+    if self.load_failed:
+      return float("inf")
+    if self.load_latency is None:
+      return 0.0
+    if self.load_throughput > 0:
+      return self.load_latency + size / self.load_throughput
+    return self.load_latency
+
   def flush(self):
-    # TODO(gsasha): implement this
-    pass
+    if self.adapted_container_size is not None:
+      self.config_db["adaptive_container_size"] = str(
+          self.adapted_container_size)
+    if self.load_latency is not None:
+      self.config_db[self._key("load_latency")] = str(self.load_latency)
+      self.config_db[self._key("load_throughput")] = str(self.load_throughput)
   def info(self):
     pass
 
@@ -405,8 +785,27 @@ class Storage:
       return stream
     self.headers_loaded_from_storage += 1
     return None
+  def open_staging_file(self):
+    # A container body is written to a file in the staging area while it is
+    # dumped, so that it doesn't have to be held in memory.
+    return tempfile.TemporaryFile(dir=Config.paths.staging_area())
   def load_body_file(self, sequence_id, index):
     raise Exception("load_body_file is abstract")
+  def load_body_range(self, sequence_id, index, offset, size):
+    # Read a part of the container file. Storages that can read a part of a
+    # file without fetching all of it should override this.
+    body_file = self.load_body_file(sequence_id, index)
+    body_file.seek(offset)
+    return body_file.read(size)
+  def load_header_range(self, sequence_id, index):
+    # Storages that can read a part of the container file return a file that
+    # fetches only the parts of the container that are read from it, so that
+    # reading the header doesn't fetch the body. Other storages return None.
+    return None
+  def open_ranged_file(self, sequence_id, index):
+    def fetch_range(offset, size):
+      return self.load_body_range(sequence_id, index, offset, size)
+    return Container.RangedFile(fetch_range, 0, HEADER_FETCH_SIZE)
   def upload_container(self, sequence_id, index, header_file, body_file):
     raise Exception("upload_container is abstract")
   
@@ -437,6 +836,9 @@ class MemoryStorage(Storage):
     return self.container_size_
   def list_container_files(self):
     return self.get_cur_files().keys()
+  def container_exists(self, sequence_id, index):
+    return self.get_cur_files().has_key(
+        encode_container_name(sequence_id, index, CONTAINER_EXT))
   def open_header_file(self, sequence_id, index):
     return StringIO.StringIO()
   def open_body_file(self, sequence_id, index):
@@ -444,7 +846,7 @@ class MemoryStorage(Storage):
   def upload_container(self, sequence_id, index, header_file, body_file):
     assert sequence_id == self.active_sequence_id
     self.report_upload_container_start(sequence_id, index, 
-        len(header_file.getvalue() + len(body_file.getvalue())))
+        len(header_file.getvalue()) + len(body_file.getvalue()))
     file_name = encode_container_name(sequence_id, index, CONTAINER_EXT)
     self.get_cur_files()[file_name] = (header_file.getvalue() +
       body_file.getvalue())
@@ -452,6 +854,11 @@ class MemoryStorage(Storage):
   def load_body_file(self, sequence_id, index):
     body_file_name = encode_container_name(sequence_id, index, CONTAINER_EXT)
     return StringIO.StringIO(self.get_cur_files()[body_file_name])
+  def load_body_range(self, sequence_id, index, offset, size):
+    body_file_name = encode_container_name(sequence_id, index, CONTAINER_EXT)
+    return self.get_cur_files()[body_file_name][offset:offset + size]
+  def load_header_range(self, sequence_id, index):
+    return self.open_ranged_file(sequence_id, index)
 
 class FTPStorage(Storage):
   """
@@ -461,6 +868,13 @@ class FTPStorage(Storage):
     Storage.__init__(self, params)
     self.RemoteHandlerClass = RemoteHandlerClass
     self.fs_handler = None
+    # The handler is created by whichever thread needs it first: the main one
+    # or an upload worker.
+    self.fs_lock = threading.Lock()
+    self.container_cache = None
+    # The number of ranges downloaded from the body of every container, by
+    # file name
+    self.range_misses = {}
     #self.up_bw_limiter = BandwidthLimiter(15.0E3)
     #self.down_bw_limiter = BandwidthLimiter(10000.0E3)
   def configure(self, params, new_block_handler):
@@ -469,13 +883,27 @@ class FTPStorage(Storage):
     Storage.load_configuration(self, new_block_handler)
     #print "Loaded directory storage configuration", self.config
 
+  def close(self):
+    # Storage.close waits for the uploads, which may still use the handler.
+    Storage.close(self)
+    if self.fs_handler is not None:
+      self.fs_handler.close()
+      self.fs_handler = None
+
   def get_fs_handler(self):
-    if self.fs_handler is None:
-      self.fs_handler = self.RemoteHandlerClass(self.get_host(),
-        self.get_user(), self.get_password(), self.get_pkey_file(),
-        self.get_path())
+    self.fs_lock.acquire()
+    try:
+      if self.fs_handler is None:
+        self.fs_handler = self.RemoteHandlerClass(self.get_host(),
+          self.get_user(), self.get_password(), self.get_pkey_file(),
+          self.get_path())
+        self.fs_handler.set_transfer_options(*self.get_transfer_options())
+        self.set_bandwidth_limits(self.fs_handler)
+    finally:
+      self.fs_lock.release()
     self.fs_handler.set_progress_reporter(self.report_manager.find_reporter(
       "container.progress", 0))
+    self.fs_handler.set_report_manager(self.report_manager)
     return self.fs_handler
 
   def get_host(self):
@@ -497,14 +925,58 @@ class FTPStorage(Storage):
   def get_path(self):
     return self.config["path"]
 
-  def container_size(self):
-    return 16<<20
-  
+  def set_bandwidth_limits(self, handler):
+    # The transfers of all the storages go through the same scheduler. The
+    # limits of the storage are configured as 'upload_limit' and
+    # 'download_limit', see parse_bandwidth_schedule.
+    name = "storage.%d" % self.index
+    scheduler = BandwidthLimiter.scheduler
+    for direction in ["upload", "download"]:
+      key = direction + "_limit"
+      if self.config.has_key(key):
+        scheduler.set_limit(direction,
+            parse_bandwidth_schedule(self.config[key]), name)
+    handler.set_bandwidth_scheduler(scheduler, name)
+  def get_transfer_options(self):
+    # Returns (read_block_size, write_block_size, window_size, pipelining).
+    # The sizes are configured with an optional K, M or G suffix.
+    handler_class = self.RemoteHandlerClass
+    read_block_size = handler_class.READ_BLOCK_SIZE
+    if self.config.has_key('read_block_size'):
+      read_block_size = parse_size(self.config['read_block_size'])
+    write_block_size = handler_class.WRITE_BLOCK_SIZE
+    if self.config.has_key('write_block_size'):
+      write_block_size = parse_size(self.config['write_block_size'])
+    window_size = handler_class.WINDOW_SIZE
+    if self.config.has_key('window_size'):
+      window_size = parse_size(self.config['window_size'])
+    pipelining = True
+    if self.config.has_key('pipelining'):
+      pipelining = self.config['pipelining'] not in ["false", "no", "0"]
+    return (read_block_size, write_block_size, window_size, pipelining)
+
+  def get_container_cache_size(self):
+    # The downloaded containers are kept in the staging area, up to this
+    # total size. Zero disables the cache.
+    if self.config.has_key('container_cache_size'):
+      return parse_size(self.config['container_cache_size'])
+    return DEFAULT_CONTAINER_CACHE_SIZE
+  def get_container_cache(self):
+    if self.container_cache is None and self.get_container_cache_size() > 0:
+      self.container_cache = ContainerCache.ContainerCache(
+          os.path.join(Config.paths.staging_area(), "containers"),
+          self.get_container_cache_size())
+      self.container_cache.set_report_manager(self.report_manager)
+    return self.container_cache
+
   def list_container_files(self):
     logging.info("Scanning containers:")
     file_list = self.get_fs_handler().list_files()
     logging.info("listed files " + str(sorted(file_list)))
     return file_list
+  def container_exists(self, sequence_id, index):
+    return self.get_fs_handler().exists(
+        encode_container_name(sequence_id, index, CONTAINER_EXT))
 
   def open_header_file(self, sequence_id, index):
     logging.debug("Starting container header %s %d" %
@@ -513,16 +985,63 @@ class FTPStorage(Storage):
   def open_body_file(self, sequence_id, index):
     logging.debug("Starting container body %s %d" %
       (base64.urlsafe_b64encode(sequence_id), index))
-    return StringIO.StringIO()
+    return self.open_staging_file()
   
   def load_body_file(self, sequence_id, index):
     logging.debug("Loading container body %s %d" %
       (base64.urlsafe_b64encode(sequence_id), index))
     file_name = encode_container_name(sequence_id, index, CONTAINER_EXT)
+    cache = self.get_container_cache()
+    if cache is not None:
+      def download(filehandle):
+        self.get_fs_handler().download(filehandle, file_name)
+      return cache.load(file_name, download)
     filehandle = tempfile.TemporaryFile(dir=Config.paths.staging_area())
     self.get_fs_handler().download(filehandle, file_name)
     filehandle.seek(0)
     return filehandle
+  def load_body_range(self, sequence_id, index, offset, size):
+    logging.debug("Loading %d bytes at %d of container %s %d" %
+      (size, offset, base64.urlsafe_b64encode(sequence_id), index))
+    file_name = encode_container_name(sequence_id, index, CONTAINER_EXT)
+    data = self._read_cached_range(file_name, offset, size)
+    if data is not None:
+      return data
+    if self.get_container_cache() is not None:
+      # The misses of concurrent loads can be counted once, which only delays
+      # the download of the whole body.
+      misses = self.range_misses.get(file_name, 0) + 1
+      self.range_misses[file_name] = misses
+      if misses >= CACHED_RANGE_MISSES:
+        logging.debug("Caching the body of container %s %d" %
+          (base64.urlsafe_b64encode(sequence_id), index))
+        filehandle = self.load_body_file(sequence_id, index)
+        filehandle.seek(offset)
+        data = filehandle.read(size)
+        filehandle.close()
+        return data
+    return self.get_fs_handler().download_range(file_name, offset, size)
+  def load_header_range(self, sequence_id, index):
+    # Reading the header doesn't count as a miss of the body
+    file_name = encode_container_name(sequence_id, index, CONTAINER_EXT)
+    def fetch_range(offset, size):
+      data = self._read_cached_range(file_name, offset, size)
+      if data is not None:
+        return data
+      return self.get_fs_handler().download_range(file_name, offset, size)
+    return Container.RangedFile(fetch_range, 0, HEADER_FETCH_SIZE)
+  def _read_cached_range(self, file_name, offset, size):
+    """Returns the data of the range if the container is cached, or None"""
+    cache = self.get_container_cache()
+    if cache is None:
+      return None
+    filehandle = cache.get(file_name)
+    if filehandle is None:
+      return None
+    filehandle.seek(offset)
+    data = filehandle.read(size)
+    filehandle.close()
+    return data
   
   def upload_container(self, sequence_id, index, header_file, body_file):
     logging.info("Uploading container %s %d" %
@@ -531,30 +1050,22 @@ class FTPStorage(Storage):
     
     start_time = time.time()
 
-    # Copy header_file + body_file > tmpfile
-    tmpfile = tempfile.TemporaryFile(dir=Config.paths.staging_area())
-    total_size = 0
-    header_file.seek(0)
-    while True:
-      block = header_file.read(64 << 10)
-      if len(block) == 0: break
-      tmpfile.write(block)
-      total_size += len(block)
-    body_file.seek(0)
-    while True:
-      block = body_file.read(64 << 10)
-      if len(block) == 0: break
-      tmpfile.write(block)
-      total_size += len(block)
-
+    # The body is already in a staging file, so the header and the body are
+    # uploaded straight from their files. Their positions are not trusted for
+    # the size.
+    container_file = FileIO.ConcatenatedFile([header_file, body_file])
+    container_file.seek(0, 2)
+    total_size = container_file.tell()
     self.report_upload_container_start(sequence_id, index, total_size)
 
-    # Upload tmpfile to the remote location
+    # Upload to a temporary name and rename, so that a partial upload is never
+    # taken for a container
     tmp_file_name = encode_container_name(sequence_id, index, CONTAINER_EXT_TMP)
     file_name = encode_container_name(sequence_id, index, CONTAINER_EXT)
 
-    tmpfile.seek(0)
-    self.get_fs_handler().upload(tmpfile, tmp_file_name)
+    container_file.seek(0)
+    self.get_fs_handler().upload(container_file, tmp_file_name)
+    body_file.close()
     self.get_fs_handler().rename(tmp_file_name, file_name)
     self.get_fs_handler().chmod(file_name, 0440)
 
@@ -575,11 +1086,11 @@ class DirectoryStorage(Storage):
     #print "Loaded directory storage configuration", self.config
   def get_path(self):
     return self.config["path"]
-  def container_size(self):
-    #return 4<<20
-    return 16<<20
   def list_container_files(self):
     return os.listdir(self.get_path())
+  def container_exists(self, sequence_id, index):
+    return os.path.exists(os.path.join(self.get_path(),
+      encode_container_name(sequence_id, index, CONTAINER_EXT)))
   def open_header_file(self, sequence_id, index):
     logging.debug("Starting container header %s %d" %
       (base64.urlsafe_b64encode(sequence_id), index))
@@ -587,7 +1098,7 @@ class DirectoryStorage(Storage):
   def open_body_file(self, sequence_id, index):
     logging.debug("Starting container body %s %d" %
       (base64.urlsafe_b64encode(sequence_id), index))
-    return StringIO.StringIO()
+    return self.open_staging_file()
   def upload_container(self, sequence_id, index, header_file, body_file):
     # Write the header file to summary header
     assert sequence_id == self.active_sequence_id
@@ -618,6 +1129,7 @@ class DirectoryStorage(Storage):
       if len(block) == 0: break
       file_stream.write(block)
     file_stream.close()
+    body_file.close()
     # Rename the tmp file to permanent one
     shutil.move(file_path_tmp, file_path)
     # Remove the write permission off the permanent files
@@ -631,6 +1143,17 @@ class DirectoryStorage(Storage):
     file_name = encode_container_name(sequence_id, index, CONTAINER_EXT)
     file_path = os.path.join(self.get_path(), file_name)
     return open(file_path, "rb")
+  def load_body_range(self, sequence_id, index, offset, size):
+    file_name = encode_container_name(sequence_id, index, CONTAINER_EXT)
+    file_path = os.path.join(self.get_path(), file_name)
+    body_file = open(file_path, "rb")
+    try:
+      body_file.seek(offset)
+      return body_file.read(size)
+    finally:
+      body_file.close()
+  def load_header_range(self, sequence_id, index):
+    return self.open_ranged_file(sequence_id, index)
 
 import smtplib
 import email.Encoders as Encoders
@@ -767,14 +1290,25 @@ class OpticalStorage(Storage):
   def container_size(self):
     return CONTAINER_TYPES[self.containerType]
 
+class BlockCollector:
+  """Keeps the given blocks of a container as they are loaded"""
+  def __init__(self, digests):
+    self.digests = set(digests)
+    self.blocks = []
+  def is_requested(self, digest, code):
+    return digest in self.digests
+  def loaded(self, digest, code, data):
+    self.blocks.append((digest, code, data))
+
 # Utility functions
 def encode_container_name(sequence_id, index, extension):
   return "%s.%s.%s" % (base64.urlsafe_b64encode(sequence_id),
       IE.ascii_encode_int_varlen(index), extension)
 
+CONTAINER_NAME_RE = re.compile("([^.]+).([^.]+).([^.]+)", re.UNICODE)
+
 def decode_container_name(name):
-  name_re = re.compile("([^.]+).([^.]+).([^.]+)", re.UNICODE)
-  match = name_re.match(name)
+  match = CONTAINER_NAME_RE.match(name)
   if not match:
     print "Warning: File %s is not a manent container." % name.encode('utf8')
     return (None, None, None)
@@ -6,6 +6,7 @@
 import base64
 import logging
 import cStringIO as StringIO
+import threading
 import time
 
 import BlockManager
@@ -18,6 +19,13 @@ import utils.IntegerEncodings as IE
 
 PREFIX = "STORAGE_MANAGER."
 
+# Amount of data loaded together with a requested block
+LOAD_READAHEAD_SIZE = 1 << 20
+# Only the readahead is loaded from a container while the data requested from
+# it is below this fraction of its body. Otherwise, the container is likely
+# to be read through, and its whole body is loaded at once.
+SPARSE_LOAD_FRACTION = 1. / 8
+
 logger_sm = logging.getLogger("manent.storage_manager")
 
 #--------------------------------------------------------
@@ -33,6 +41,64 @@ def _decode_block_info(encoded):
   seq_idx = IE.binary_read_int_varlen(io)
   container_idx = IE.binary_read_int_varlen(io)
   return (seq_idx, container_idx)
+# A block can be stored in several containers. All their infos are kept one
+# after another.
+def _decode_block_locations(encoded):
+  io = StringIO.StringIO(encoded)
+  locations = []
+  while io.tell() < len(encoded):
+    seq_idx = IE.binary_read_int_varlen(io)
+    container_idx = IE.binary_read_int_varlen(io)
+    locations.append((seq_idx, container_idx))
+  return locations
+class _PrefetchRequest:
+  """The blocks to be prefetched from a container. More blocks can be added
+  until the worker starts loading the body."""
+  def __init__(self, digest):
+    self.lock = threading.Lock()
+    self.digests = [digest]
+    self.started = False
+  def add(self, digest):
+    # Returns False if it's too late, and the block must be requested again
+    self.lock.acquire()
+    try:
+      if self.started:
+        return False
+      self.digests.append(digest)
+      return True
+    finally:
+      self.lock.release()
+  def start(self):
+    self.lock.acquire()
+    try:
+      self.started = True
+      return list(self.digests)
+    finally:
+      self.lock.release()
+def _prefetch_container(container, header_file, request):
+  # Runs in a download pool, so it must not touch the databases. Returns the
+  # loaded blocks, and the times it took to load the header and the body.
+  # The readahead of every requested block is loaded.
+  start_time = time.time()
+  container.load_header(header_file)
+  header_time = time.time()
+  readahead = set()
+  for digest in request.start():
+    readahead.update(container.list_blocks_from(digest, LOAD_READAHEAD_SIZE))
+  collector = Storage.BlockCollector(readahead)
+  container.load_blocks(collector)
+  return collector.blocks, header_time - start_time, time.time() - header_time
+
+class _SizeCountingListener:
+  """Passes the blocks on to the given listener, counting their size"""
+  def __init__(self, listener):
+    self.listener = listener
+    self.size = 0
+  def is_requested(self, digest, code):
+    return self.listener.is_requested(digest, code)
+  def loaded(self, digest, code, data):
+    self.size += len(data)
+    self.listener.loaded(digest, code, data)
 
 class StorageManager:
   """Handles the moving of blocks to and from storages.
@@ -102,6 +168,14 @@ class StorageManager:
       self.seq_to_index[sequence_id] = (storage_idx, sequence_idx)
       self.index_to_seq[sequence_idx] = (storage_idx, sequence_id)
     self.block_listeners = []
+    # The (storage, request, task) of the containers being loaded ahead of
+    # time, by (storage idx, sequence id, container idx), and the container of
+    # every block being prefetched.
+    self.prefetch_tasks = {}
+    self.prefetch_containers = {}
+    # The amount of data requested from every container loaded, by
+    # (storage idx, sequence id, container idx).
+    self.requested_sizes = {}
   def set_report_manager(self, report_manager):
     self.report_manager = report_manager
     self.num_new_blocks_reporter = report_manager.find_reporter(
@@ -109,11 +183,14 @@ class StorageManager:
     self.size_new_blocks_reporter = report_manager.find_reporter(
         "scan.counts.size_new_blocks", 0)
   def close(self):
+    self.prefetch_tasks = {}
+    self.prefetch_containers = {}
+    self.requested_sizes = {}
+    self.block_sequencer.close()
     for index, storage in self.storages.iteritems():
       storage.close()
     self.block_container_db.close()
     self.config_db.close()
-    self.block_sequencer.close()
     self.block_manager.close()
   class BlockScanningListener:
     """This listener is used for loading blocks in new containers."""
@@ -126,10 +203,9 @@ class StorageManager:
         self.storage_manager.register_sequence(self.storage_idx, sequence_id)
       storage_idx, sequence_idx = self.storage_manager.seq_to_index[sequence_id]
       # Record to which container does this block belong.
-      encoded = _encode_block_info(sequence_idx, container_idx)
-      if not self.storage_manager.block_container_db.has_key(digest):
-        if BlockManager.is_indexed(code):
-          self.storage_manager.block_container_db[digest] = encoded
+      if BlockManager.is_indexed(code):
+        self.storage_manager.add_block_location(digest,
+            sequence_idx, container_idx)
       # Check if we want the data of this block.
       return BlockManager.is_cached(code)
     def loaded(self, sequence_id, digest, code, data):
@@ -192,27 +268,37 @@ class StorageManager:
     storage.set_report_manager(self.report_manager)
     self.storages[storage_idx] = storage
     return storage_idx
-  def load_storages(self):
+  def load_storages(self, full_listing=False):
     #
     # All storages except for the specified one are inactive, i.e., base.
     # Inactive storages can be used to pull data blocks from, and must
     # be updated on each invocation, since somebody else might be adding
     # blocks there
     #
+    # With full_listing, all the container files of the storages are listed,
+    # even if they were listed recently. This finds the new sequences.
+    #
     logging.debug("StorageManager loading storages")
     self.storages = {}
     self.active_storage_idx = None
+    self.mirror_storage_idxs = []
     for storage_idx in self.get_storage_idxs():
       logging.debug("StorageManager loading storage %d" % storage_idx)
       handler = self.create_block_listener(storage_idx)
       storage = Storage.load_storage(self.db_manager, self.txn_manager,
-        storage_idx, handler)
+        storage_idx, handler, full_listing)
       storage.set_report_manager(self.report_manager)
       self.storages[storage_idx] = storage
       if storage.is_active():
         logging.debug("Storage is active")
         seq_id = storage.get_active_sequence_id()
-        self.active_storage_idx, seq_idx = self.seq_to_index[seq_id]
+        active_storage_idx, seq_idx = self.seq_to_index[seq_id]
+        if active_storage_idx == storage_idx:
+          self.active_storage_idx = storage_idx
+        else:
+          # The sequence belongs to another storage, this one mirrors it
+          logging.debug("Storage mirrors storage %d" % active_storage_idx)
+          self.mirror_storage_idxs.append(storage_idx)
 
   def get_storage_idxs(self):
     KEY = self._key("storage_idxs")
@@ -241,6 +327,46 @@ class StorageManager:
     seq_id = storage.create_sequence()
     self.register_sequence(storage_index, seq_id)
     self.active_storage_idx = storage_index
+  def make_mirror_storage(self, storage_index):
+    # A mirror storage gets a copy of every container written to the active
+    # storage from now on. The containers are uploaded to the storages
+    # concurrently, each storage with its own upload queue.
+    if self.active_storage_idx is None:
+      raise Exception("Mirroring requires an active storage")
+    if (storage_index == self.active_storage_idx or
+        storage_index in self.mirror_storage_idxs):
+      raise Exception("Storage %d is already written to" % storage_index)
+    active_storage = self.storages[self.active_storage_idx]
+    storage = self.storages[storage_index]
+    # The containers are copied as they are, so they can be read only with the
+    # key of the active storage.
+    if storage.get_encryption_key() != active_storage.get_encryption_key():
+      raise Exception("Mirror storage must have the encryption key"
+          " of the active storage")
+    storage.mirror_sequence(active_storage.get_active_sequence_id(),
+        active_storage.get_next_index())
+    self.mirror_storage_idxs.append(storage_index)
+  def reserve_containers(self, num_extra):
+    # Reserve the indices of the containers that can be uploaded to the active
+    # storage before the next commit: as many as can be pending, and num_extra
+    # more. See Storage.reserve_containers.
+    # The mirrors get the same containers, under the same indices.
+    storage = self.storages[self.active_storage_idx]
+    reserved_index = (storage.get_next_index() +
+        storage.get_max_pending_uploads() + num_extra)
+    storage.reserve_containers(reserved_index)
+    for mirror in self.get_mirror_storages():
+      mirror.reserve_containers(reserved_index)
+  def has_reserved_container(self):
+    # Can the next container be created without a new reservation?
+    storage = self.storages[self.active_storage_idx]
+    return storage.get_next_index() < storage.get_reserved_index()
+  def get_mirror_storage_indices(self):
+    return self.mirror_storage_idxs
+  def get_mirror_storages(self):
+    # The lagging mirrors get no new containers
+    return [self.storages[idx] for idx in self.mirror_storage_idxs
+        if not self.storages[idx].is_lagging()]
   def get_active_sequence_id(self):
     storage = self.storages[self.active_storage_idx]
     return storage.get_active_sequence_id()
@@ -252,7 +378,8 @@ class StorageManager:
   def add_block(self, digest, code, data):
     self.block_manager.add_block(digest, code, data)
 
-    if self.block_container_db.has_key(digest):
+    if (self.block_container_db.has_key(digest) or
+        self.block_sequencer.has_pending_block(digest)):
       return False
 
     self.num_new_blocks_reporter.increment(1)
@@ -261,44 +388,160 @@ class StorageManager:
         (base64.b64encode(digest), Container.code_name(code), len(data)))
     self.block_sequencer.add_block(digest, code, data)
     return True
+  def add_block_location(self, digest, sequence_idx, container_idx):
+    encoded = _encode_block_info(sequence_idx, container_idx)
+    if not self.block_container_db.has_key(digest):
+      self.block_container_db[digest] = encoded
+      return
+    locations = self.block_container_db[digest]
+    if (sequence_idx, container_idx) in _decode_block_locations(locations):
+      return
+    self.block_container_db[digest] = locations + encoded
+  def get_block_sources(self, digest):
+    """Returns the (storage, sequence_id, container_idx) of all the
+    containers that have the block, the one expected to load fastest first.
+    The containers of a sequence can be found in the storage that created it
+    and in its mirrors."""
+    sources = []
+    for sequence_idx, container_idx in _decode_block_locations(
+        self.block_container_db[digest]):
+      storage_idx, sequence_id = self.index_to_seq[sequence_idx]
+      for index, storage in self.storages.iteritems():
+        if (index == storage_idx or
+            storage.has_container(sequence_id, container_idx)):
+          sources.append((storage.estimate_load_time(LOAD_READAHEAD_SIZE),
+            len(sources), (storage, sequence_id, container_idx)))
+    sources.sort()
+    return [source for cost, i, source in sources]
+  def group_blocks_by_container(self, digests):
+    """Group the given blocks by the container they are best loaded from.
+    Returns a list of (storage, sequence_id, container_idx, digests), in the
+    order of the containers."""
+    groups = {}
+    for digest in digests:
+      storage, sequence_id, container_idx = self.get_block_sources(digest)[0]
+      key = (storage.get_index(), sequence_id, container_idx)
+      if not groups.has_key(key):
+        groups[key] = (storage, sequence_id, container_idx, [])
+      groups[key][3].append(digest)
+    return [groups[key] for key in sorted(groups.keys())]
+  def prefetch_blocks(self, digests):
+    """Start loading the containers of the given blocks in the download pools
+    of their storages, so that the blocks are ready by the time they are
+    loaded. The loaded blocks are handed to the block manager by
+    load_block, in this thread."""
+    for digest in digests:
+      if (self.block_manager.has_block(digest) or
+          self.prefetch_containers.has_key(digest)):
+        continue
+      storage, sequence_id, container_idx = self.get_block_sources(digest)[0]
+      key = (storage.get_index(), sequence_id, container_idx)
+      tasks = self.prefetch_tasks.setdefault(key, [])
+      # The block is added to the pending request for its container, unless
+      # the container is being loaded already
+      if tasks == [] or not tasks[-1][1].add(digest):
+        logging.debug("Prefetching block %s from %d:%s:%d" %
+            (base64.b64encode(digest), storage.get_index(),
+            base64.urlsafe_b64encode(sequence_id), container_idx))
+        container = storage.get_container(sequence_id, container_idx)
+        header_file = storage.load_header_file(sequence_id, container_idx)
+        # Create the decompression pool before the workers need it
+        storage.get_compression_pool()
+        request = _PrefetchRequest(digest)
+        tasks.append((storage, request, storage.get_download_pool().submit(
+          _prefetch_container, container, header_file, request)))
+      self.prefetch_containers[digest] = key
+  def _finish_prefetch(self, key):
+    tasks = self.prefetch_tasks.pop(key)
+    for digest, container_key in self.prefetch_containers.items():
+      if container_key == key:
+        del self.prefetch_containers[digest]
+    for storage, request, task in tasks:
+      try:
+        blocks, header_time, body_time = task.result()
+      except Exception, e:
+        # The blocks will be loaded again from any of their sources
+        logging.warning("Failed to prefetch container %d from storage %d: %s"
+            % (key[2], storage.get_index(), e))
+        storage.record_load_failure()
+        continue
+      self.block_manager.increment_epoch()
+      size = 0
+      for digest, code, data in blocks:
+        size += len(data)
+        if self.block_manager.is_requested(digest, code):
+          self.block_manager.loaded(digest, code, data)
+      storage.record_load(header_time, size, body_time)
   def load_block(self, digest):
     logging.debug("SM loading block " + base64.b64encode(digest))
+    if (not self.block_manager.has_block(digest) and
+        self.prefetch_containers.has_key(digest)):
+      self._finish_prefetch(self.prefetch_containers[digest])
     if not self.block_manager.has_block(digest):
       logging.debug("loading blocks for" + base64.b64encode(digest))
 
-      sequence_idx, container_idx = _decode_block_info(
-        self.block_container_db[digest])
-      storage_idx, sequence_id = self.index_to_seq[sequence_idx]
-      storage = self.storages[storage_idx]
-
-      logging.debug("Digest %s is in %d:%s:%d" %
-          (base64.b64encode(digest), sequence_idx,
-          base64.urlsafe_b64encode(sequence_id), container_idx))
+      sources = self.get_block_sources(digest)
+      for i in range(len(sources)):
+        storage, sequence_id, container_idx = sources[i]
+        try:
+          self._load_container_blocks(digest, storage, sequence_id,
+              container_idx)
+          break
+        except:
+          if i == len(sources) - 1:
+            raise
+          logging.warning("Failed to load block %s from storage %d, "
+              "trying another one" %
+              (base64.b64encode(digest), storage.get_index()))
+          storage.record_load_failure()
+    return self.block_manager.load_block(digest)
+  def _load_container_blocks(self, digest, storage, sequence_id,
+      container_idx):
+    logging.debug("Digest %s is in %d:%s:%d" %
+        (base64.b64encode(digest), storage.get_index(),
+        base64.urlsafe_b64encode(sequence_id), container_idx))
 
-      self.report_manager.increment(
-          "storage.container.download.%s.%d.data.digest" % (
-            base64.b64encode(sequence_id),
-            container_idx),
-          1)
-      start_time = time.time()
+    self.report_manager.increment(
+        "storage.container.download.%s.%d.data.digest" % (
+          base64.b64encode(sequence_id),
+          container_idx),
+        1)
+    start_time = time.time()
 
-      container = storage.get_container(sequence_id, container_idx)
-      self.block_manager.increment_epoch()
-      container.load_blocks(self.block_manager.get_listener())
+    container = storage.get_container(sequence_id, container_idx)
+    self.block_manager.increment_epoch()
+    # Load the requested block and the ones that follow it, since these are
+    # likely to be requested next. If the storage can read parts of the
+    # container, the rest of it is not fetched, unless so much of the
+    # container has been requested already that it's likely to be needed
+    # whole.
+    readahead = container.list_blocks_from(digest, LOAD_READAHEAD_SIZE)
+    block_sizes = container.get_block_sizes()
+    key = (storage.get_index(), sequence_id, container_idx)
+    requested_size = self.requested_sizes.get(key, 0) + sum(
+        [block_sizes[block_digest] for block_digest in readahead])
+    self.requested_sizes[key] = requested_size
+    header_time = time.time()
+    if requested_size < sum(block_sizes.values()) * SPARSE_LOAD_FRACTION:
+      listener = self.block_manager.get_listener(readahead)
+    else:
+      logging.debug("Loading all of container %d" % container_idx)
+      listener = self.block_manager.get_listener()
+    listener = _SizeCountingListener(listener)
+    container.load_blocks(listener)
+    end_time = time.time()
+    storage.record_load(header_time - start_time, listener.size,
+        end_time - header_time)
 
-      self.report_manager.append(
-          "storage.container.download.%s.%d.data.time" % (
-            base64.b64encode(sequence_id),
-            container_idx),
-          time.time() - start_time)
-    return self.block_manager.load_block(digest)
+    self.report_manager.append(
+        "storage.container.download.%s.%d.data.time" % (
+          base64.b64encode(sequence_id),
+          container_idx),
+        end_time - start_time)
   def load_blocks_for(self, digest, handler):
     # This method exists only for testing.
     logging.debug("SM loading blocks for " + base64.b64encode(digest))
-    sequence_idx, container_idx = _decode_block_info(
-        self.block_container_db[digest])
-    storage_idx, sequence_id = self.index_to_seq[sequence_idx]
-    storage = self.storages[storage_idx]
+    storage, sequence_id, container_idx = self.get_block_sources(digest)[0]
     container = storage.get_container(sequence_id, container_idx)
     container.load_blocks(handler)
 
@@ -314,11 +557,11 @@ class StorageManager:
     storage = self.storages[self.get_active_storage_index()]
     return storage.create_container()
   def container_written(self, container):
-    # Update the container in the blocks db
+    # Update the container in the blocks db. The caller commits once all the
+    # containers written together are registered.
     container_idx = container.get_index()
     storage_idx, seq_idx = self.seq_to_index[container.get_sequence_id()]
-    encoded = _encode_block_info(seq_idx, container_idx)
     for digest, code in container.list_blocks():
-      self.block_container_db[digest] = encoded
+      if BlockManager.is_indexed(code):
+        self.add_block_location(digest, seq_idx, container_idx)
     self.block_manager.increment_epoch()
-    self.txn_manager.commit()
@@ -3,6 +3,7 @@
 #    License: see LICENSE.txt
 #
 
+import threading
 import time
 
 class BandwidthMonitor:
@@ -123,6 +124,126 @@ class BandwidthLimiter:
 	def get_measured_speed(self):
 		return self.measured_speed
 
+class TokenBucket:
+	"""Hands out bandwidth at the given rate, in bytes per second. A rate of
+	None means no limit.
+
+	The bucket fills up to one second worth of data while idle. A transfer
+	takes its size out of the bucket even if there is not enough in it, and
+	waits until the bucket would have filled up to that. Concurrent transfers
+	thus wait in turn, and together don't exceed the rate.
+	"""
+	def __init__(self, rate=None, clock=time.time):
+		self.clock = clock
+		self.lock = threading.Lock()
+		self.rate = rate
+		self.tokens = 0.0
+		self.last_time = clock()
+	def get_rate(self):
+		return self.rate
+	def set_rate(self, rate):
+		self.lock.acquire()
+		try:
+			self._fill()
+			self.rate = rate
+		finally:
+			self.lock.release()
+	def reserve(self, size):
+		"""Take size bytes out of the bucket. Returns the number of seconds
+		the caller must wait before transferring them."""
+		self.lock.acquire()
+		try:
+			self._fill()
+			if self.rate is None:
+				return 0.0
+			self.tokens -= size
+			if self.tokens >= 0:
+				return 0.0
+			return -self.tokens / self.rate
+		finally:
+			self.lock.release()
+	def _fill(self):
+		now = self.clock()
+		if self.rate is None:
+			self.tokens = 0.0
+		else:
+			self.tokens = min(float(self.rate),
+				self.tokens + (now - self.last_time) * self.rate)
+		self.last_time = now
+
+class BandwidthSchedule:
+	"""A rate limit that depends on the time of day.
+
+	periods is a list of (start, end, rate), with start and end given in
+	minutes since midnight. A period whose end is before its start goes on
+	past midnight. Outside of the periods, default_rate applies. A rate of
+	None means no limit.
+	"""
+	def __init__(self, periods, default_rate=None):
+		self.periods = periods
+		self.default_rate = default_rate
+	def rate_at(self, now):
+		local_time = time.localtime(now)
+		minute = local_time.tm_hour * 60 + local_time.tm_min
+		for start, end, rate in self.periods:
+			if start <= end:
+				if start <= minute < end:
+					return rate
+			elif minute >= start or minute < end:
+				return rate
+		return self.default_rate
+
+class BandwidthScheduler:
+	"""Shares the bandwidth between all the transfers. Each direction
+	("upload" or "download") has a limit on the total of all the storages,
+	and each storage can have its own limits on top of it."""
+	def __init__(self, clock=time.time, sleep=time.sleep):
+		self.clock = clock
+		self.sleep = sleep
+		self.lock = threading.Lock()
+		# (direction, storage name or None) -> (schedule, bucket)
+		self.limits = {}
+	def set_limit(self, direction, schedule, name=None):
+		"""Limit the given direction of the given storage, or of all the
+		storages if name is None. A schedule of None removes the limit."""
+		self.lock.acquire()
+		try:
+			if schedule is None:
+				if self.limits.has_key((direction, name)):
+					del self.limits[(direction, name)]
+				return
+			bucket = TokenBucket(None, self.clock)
+			self.limits[(direction, name)] = (schedule, bucket)
+		finally:
+			self.lock.release()
+	def throttle(self, direction, size, name=None):
+		"""Wait until size bytes can be transferred in the given direction
+		by the given storage"""
+		delay = 0.0
+		now = self.clock()
+		for limit in self._get_limits(direction, name):
+			schedule, bucket = limit
+			rate = schedule.rate_at(now)
+			if rate != bucket.get_rate():
+				bucket.set_rate(rate)
+			delay = max(delay, bucket.reserve(size))
+		if delay > 0:
+			self.sleep(delay)
+	def is_limited(self, direction, name=None):
+		now = self.clock()
+		for schedule, bucket in self._get_limits(direction, name):
+			if schedule.rate_at(now) is not None:
+				return True
+		return False
+	def _get_limits(self, direction, name):
+		keys = [(direction, None)]
+		if name is not None:
+			keys.append((direction, name))
+		return [self.limits[key] for key in keys if self.limits.has_key(key)]
+
+# The scheduler shared by all the storages
+scheduler = BandwidthScheduler()
+
 #b = BandwidthLimiter(500000000000000.0)
 #while(1):
 	#b.packet(1024)
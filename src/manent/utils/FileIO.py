@@ -1,4 +1,5 @@
 import sys
+import threading
 
 #---------------------------------
 # Utility method that reads a file as a sequence
@@ -12,6 +13,118 @@ def read_blocks(file, blocksize):
 		yield block
 	raise StopIteration
 
+#--------------------------------------------------------------------
+# Reads several files one after the other, as if they were one file.
+# A read never spans two files, so it can return less than requested
+# before the end of the data.
+#--------------------------------------------------------------------
+class ConcatenatedFile:
+	def __init__(self, files):
+		self.files = files
+		self.current = 0
+	def read(self, size=-1):
+		while self.current < len(self.files):
+			data = self.files[self.current].read(size)
+			if len(data) > 0:
+				return data
+			self.current += 1
+		return ""
+	def seek(self, offset, whence=0):
+		# The files after the one that holds the offset are rewound, so that
+		# they are read from the start.
+		sizes = self._sizes()
+		if whence == 1:
+			offset += self.tell()
+		elif whence == 2:
+			offset += sum(sizes)
+		position = 0
+		self.current = len(self.files)
+		for i in range(len(self.files)):
+			if self.current == len(self.files) and offset < position + sizes[i]:
+				self.current = i
+			if i >= self.current:
+				self.files[i].seek(max(0, offset - position))
+			position += sizes[i]
+	def tell(self):
+		sizes = self._sizes()
+		if self.current == len(self.files):
+			return sum(sizes)
+		return sum(sizes[:self.current]) + self.files[self.current].tell()
+	def _sizes(self):
+		sizes = []
+		for file in self.files:
+			position = file.tell()
+			file.seek(0, 2)
+			sizes.append(file.tell())
+			file.seek(position)
+		return sizes
+
+#--------------------------------------------------------------------
+# Lets several readers, possibly in different threads, read the same
+# file, each at its own position. The file is closed when all the views
+# opened on it are closed.
+#--------------------------------------------------------------------
+class SharedFile:
+	def __init__(self, file):
+		self.file = file
+		self.lock = threading.Lock()
+		self.num_open = 0
+	def open(self):
+		# The view starts at the current position of the file, so that its
+		# tell() reports the size of a file that has just been written.
+		self.lock.acquire()
+		try:
+			self.num_open += 1
+			return SharedFileView(self, self.file.tell())
+		finally:
+			self.lock.release()
+	def _read(self, position, size):
+		self.lock.acquire()
+		try:
+			self.file.seek(position)
+			return self.file.read(size)
+		finally:
+			self.lock.release()
+	def _size(self):
+		self.lock.acquire()
+		try:
+			self.file.seek(0, 2)
+			return self.file.tell()
+		finally:
+			self.lock.release()
+	def _close(self):
+		self.lock.acquire()
+		try:
+			self.num_open -= 1
+			if self.num_open == 0:
+				self.file.close()
+		finally:
+			self.lock.release()
+
+class SharedFileView:
+	def __init__(self, shared, position):
+		self.shared = shared
+		self.position = position
+		self.closed = False
+	def read(self, size=-1):
+		data = self.shared._read(self.position, size)
+		self.position += len(data)
+		return data
+	def seek(self, offset, whence=0):
+		if whence == 1:
+			offset += self.position
+		elif whence == 2:
+			offset += self.shared._size()
+		self.position = offset
+	def tell(self):
+		return self.position
+	def getvalue(self):
+		return self.shared._read(0, -1)
+	def close(self):
+		if not self.closed:
+			self.closed = True
+			self.shared._close()
+
 #--------------------------------------------------------------------
 # Support for file reading and writing with reporting and specified
 # speed
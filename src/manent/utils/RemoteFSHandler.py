@@ -3,38 +3,138 @@
 #    License: see LICENSE.txt
 #
 
+import errno
 import FileIO
 import ftplib
 import logging
 import paramiko
 import os, os.path
+import threading
 import time
 import traceback
 
 #----------------------------------------------------
 # Decorator that implements retrying
 #----------------------------------------------------
+MAX_RETRY_DELAY = 60.0
+
 def retry_decorator(retries, message):
+  """Run the operation on a connection checked out of the handler's pool.
+  The connection is returned to the pool when the operation succeeds, and
+  dropped when it fails, so that the retry starts on a fresh one. The delay
+  between the attempts grows exponentially from the handler's retry_delay."""
   def impl(func):
     def retrier(self, *args, **kwargs):
       logging.debug("calling %s with params %s ..." % (
         message, str(args) + str(kwargs)))
       start = time.time()
       for i in range(retries):
+        if i > 0:
+          time.sleep(min(self.retry_delay * (2 ** (i - 1)), MAX_RETRY_DELAY))
+        connection = None
         try:
-          self.connect()
-          result = func(self, *args, **kwargs)
+          connection = self.pool.checkout()
+          result = func(self, connection, *args, **kwargs)
+          self.pool.checkin(connection)
           logging.debug("%2.3f seconds" % (time.time() - start))
           return result
         except:
           traceback.print_exc()
-          self.cleanup_connection()
+          if connection is not None:
+            self.pool.discard(connection)
       else:
-        raise "Failed to %s for %d times. Giving up" % (message,
-                                                        retries)
+        raise Exception("Failed to %s for %d times. Giving up" %
+            (message, retries))
     return retrier
   return impl
 
+class Transfer:
+  """State of an upload or a download that is carried over the retries.
+  An attempt after the first one resumes from the data already transferred,
+  instead of starting from scratch."""
+  def __init__(self, remote_name):
+    self.remote_name = remote_name
+    self.attempts = 0
+    self.resumed_bytes = 0
+  def start_attempt(self):
+    """Returns True if this attempt is a retry"""
+    self.attempts += 1
+    return self.attempts > 1
+  def resume(self, offset):
+    self.resumed_bytes += offset
+
+def split_host_port(host, default_port):
+  """Split a "host[:port]" specification"""
+  if ":" in host:
+    host, port = host.rsplit(":", 1)
+    return host, int(port)
+  return host, default_port
+
+#----------------------------------------------------
+# Pool of long-lived connections
+#----------------------------------------------------
+class ConnectionPool:
+  """Keeps the connections to a remote site open between the operations.
+
+  Every operation checks out a connection of its own, so concurrent
+  operations work on separate connections. A connection that has been idle
+  for longer than IDLE_CHECK_TIME seconds is checked before being reused, and
+  is replaced by a new one if it's dead.
+  """
+  IDLE_CHECK_TIME = 30
+  def __init__(self, connect, disconnect, is_alive, max_idle=4):
+    self.connect = connect
+    self.disconnect = disconnect
+    self.is_alive = is_alive
+    self.max_idle = max_idle
+    self.lock = threading.Lock()
+    # Stack of (connection, time it was checked in)
+    self.idle = []
+  def checkout(self):
+    while True:
+      self.lock.acquire()
+      try:
+        if len(self.idle) == 0:
+          break
+        connection, last_used = self.idle.pop()
+      finally:
+        self.lock.release()
+      if time.time() - last_used < self.IDLE_CHECK_TIME:
+        return connection
+      try:
+        if self.is_alive(connection):
+          return connection
+      except:
+        pass
+      logging.info("Dropping a dead connection")
+      self.discard(connection)
+    return self.connect()
+  def checkin(self, connection):
+    self.lock.acquire()
+    try:
+      if len(self.idle) < self.max_idle:
+        self.idle.append((connection, time.time()))
+        return
+    finally:
+      self.lock.release()
+    self.discard(connection)
+  def discard(self, connection):
+    try:
+      self.disconnect(connection)
+    except:
+      traceback.print_exc()
+  def get_num_idle(self):
+    return len(self.idle)
+  def close(self):
+    self.lock.acquire()
+    try:
+      idle = self.idle
+      self.idle = []
+    finally:
+      self.lock.release()
+    for connection, last_used in idle:
+      self.discard(connection)
+
 #-----------------------------------------------------------
 # Remote network access classes
 #-----------------------------------------------------------
@@ -42,62 +142,214 @@ class RemoteFSHandler:
   """
   This class defines the interface that all the remote FS handlers
   must implement.
+  The handlers can be used from several threads at once.
+
+  Uploads and downloads are resumable: the implementations of _upload and
+  _download continue a retried transfer from where the previous attempt
+  stopped.
+
+  Data is read and written in blocks of read_block_size and write_block_size.
+  If pipelining is on, the protocols that wait for a reply on every request
+  keep several requests in flight, so that a transfer is not limited to one
+  block per round trip.
+
+  If a bandwidth scheduler is set, every block transferred takes its share
+  of the bandwidth from it, under the name of the handler's storage.
   """
+  RETRY_DELAY = 1.0
+  READ_BLOCK_SIZE = 256 << 10
+  WRITE_BLOCK_SIZE = 256 << 10
+  WINDOW_SIZE = 8 << 20
   def __init__(self):
     self.progress_reporter = None
+    self.report_manager = None
+    self.retry_delay = self.RETRY_DELAY
+    self.read_block_size = self.READ_BLOCK_SIZE
+    self.write_block_size = self.WRITE_BLOCK_SIZE
+    self.window_size = self.WINDOW_SIZE
+    self.pipelining = True
+    self.bandwidth_scheduler = None
+    self.bandwidth_name = None
+    self.pool = ConnectionPool(self.connect, self.disconnect, self.is_alive)
   def set_progress_reporter(self, reporter):
     self.progress_reporter = reporter
+  def set_report_manager(self, report_manager):
+    self.report_manager = report_manager
+  def set_transfer_options(self, read_block_size, write_block_size,
+      window_size, pipelining):
+    # Connections that are already open keep their window size.
+    self.read_block_size = read_block_size
+    self.write_block_size = write_block_size
+    self.window_size = window_size
+    self.pipelining = pipelining
+  def set_bandwidth_scheduler(self, scheduler, name):
+    self.bandwidth_scheduler = scheduler
+    self.bandwidth_name = name
+  def throttle(self, direction, size):
+    if self.bandwidth_scheduler is not None:
+      self.bandwidth_scheduler.throttle(direction, size, self.bandwidth_name)
+  def is_bandwidth_limited(self, direction):
+    return (self.bandwidth_scheduler is not None and
+        self.bandwidth_scheduler.is_limited(direction, self.bandwidth_name))
+  def close(self):
+    self.pool.close()
   def list_files(self):
     pass
-  def upload(self, file, remote_name):
+  def exists(self, remote_name):
     pass
+  def upload(self, file, remote_name):
+    """Upload a seekable file"""
+    transfer = Transfer(remote_name)
+    try:
+      self._upload(transfer, file, remote_name)
+    finally:
+      self.report_transfer("upload", transfer)
   def download(self, file, remote_name):
+    transfer = Transfer(remote_name)
+    try:
+      self._download(transfer, file, file.tell(), remote_name)
+    finally:
+      self.report_transfer("download", transfer)
+  def download_range(self, remote_name, offset, size):
     pass
+  def report_transfer(self, operation, transfer):
+    if self.report_manager is None or transfer.attempts <= 1:
+      return
+    prefix = "storage.remote.%s.%s" % (operation, transfer.remote_name)
+    self.report_manager.increment(prefix + ".retries", transfer.attempts - 1)
+    self.report_manager.increment(prefix + ".resumed_bytes",
+        transfer.resumed_bytes)
+  def _upload(self, transfer, file, remote_name):
+    pass
+  def _download(self, transfer, file, start, remote_name):
+    pass
+  # Connection management, used by the pool
+  def connect(self):
+    pass
+  def disconnect(self, connection):
+    pass
+  def is_alive(self, connection):
+    return True
 
 class FTPHandler(RemoteFSHandler):
   def __init__(self, host, username, password, pkey_file, path):
+    RemoteFSHandler.__init__(self)
     self.host = host
     self.path = path
     self.username = username
     self.password = password
     # For ftp, the pkey_file has no actual meaning.
     self.pkey_file = pkey_file
-    # Internal data
-    self.ftp = None
-  
+
   @retry_decorator(10, "list files")
-  def list_files(self):
-    return self.ftp.nlst()
-  
+  def list_files(self, ftp):
+    return ftp.nlst()
+
+  @retry_decorator(10, "check existence")
+  def exists(self, ftp, remote_name):
+    ftp.voidcmd("TYPE I")
+    try:
+      ftp.size(remote_name)
+      return True
+    except ftplib.error_perm:
+      return False
+
   @retry_decorator(10, "upload")
-  def upload(self, file, remote_name):
-    self.ftp.storbinary("STOR %s" % (remote_name), file)
-  
+  def _upload(self, ftp, transfer, file, remote_name):
+    offset = 0
+    if transfer.start_attempt():
+      offset = self.remote_size(ftp, remote_name)
+      file.seek(0, 2)
+      if offset > file.tell():
+        # Not what we have been uploading, start from scratch
+        offset = 0
+    file.seek(offset)
+    def sent(block):
+      self.throttle("upload", len(block))
+    if offset > 0:
+      transfer.resume(offset)
+      ftp.storbinary("APPE %s" % (remote_name), file, self.write_block_size,
+          sent)
+    else:
+      ftp.storbinary("STOR %s" % (remote_name), file, self.write_block_size,
+          sent)
+
   @retry_decorator(10, "download")
-  def download(self, file, remote_name):
-    self.ftp.retrbinary("RETR %s" % (remote_name), file.write, 100<<10)
+  def _download(self, ftp, transfer, file, start, remote_name):
+    # The data of the failed attempts is already in the file
+    offset = 0
+    if transfer.start_attempt():
+      file.seek(0, 2)
+      offset = file.tell() - start
+    file.seek(start + offset)
+    def received(block):
+      self.throttle("download", len(block))
+      file.write(block)
+    if offset > 0:
+      transfer.resume(offset)
+      ftp.retrbinary("RETR %s" % (remote_name), received,
+          self.read_block_size, rest=offset)
+    else:
+      ftp.retrbinary("RETR %s" % (remote_name), received,
+          self.read_block_size)
+
+  @retry_decorator(10, "download range")
+  def download_range(self, ftp, remote_name, offset, size):
+    # Start the transfer at the offset with REST, and drop the data connection
+    # as soon as we have what we need.
+    ftp.voidcmd("TYPE I")
+    conn = ftp.transfercmd("RETR %s" % (remote_name), rest=offset)
+    blocks = []
+    remaining = size
+    try:
+      while remaining > 0:
+        block = conn.recv(min(remaining, self.read_block_size))
+        if not block:
+          break
+        self.throttle("download", len(block))
+        blocks.append(block)
+        remaining -= len(block)
+    finally:
+      conn.close()
+    try:
+      ftp.voidresp()
+    except ftplib.error_temp:
+      # The server complains that we aborted the transfer
+      pass
+    return "".join(blocks)
 
   @retry_decorator(10, "rename")
-  def rename(self, old_name, new_name):
-    self.ftp.rename(old_name, new_name)
+  def rename(self, ftp, old_name, new_name):
+    ftp.rename(old_name, new_name)
 
   @retry_decorator(10, "chmod")
-  def chmod(self, file_name, mode):
+  def chmod(self, ftp, file_name, mode):
     # Python's FTP doesn't know how to do this
     pass
   # --------
   # Internal implementation
   # --------
+  def remote_size(self, ftp, remote_name):
+    ftp.voidcmd("TYPE I")
+    try:
+      return ftp.size(remote_name)
+    except ftplib.error_perm:
+      # The file doesn't exist yet
+      return 0
   def connect(self):
-    if self.ftp != None:
-      return
     print "Connecting to %s as %s" % (self.host, self.username)
-    self.ftp = ftplib.FTP(self.host, self.username, self.password)
-    self.ftp.set_pasv(False)
-    self.ftp.cwd(self.path)
+    ftp = ftplib.FTP()
+    ftp.connect(*split_host_port(self.host, ftplib.FTP_PORT))
+    ftp.login(self.username, self.password)
+    ftp.set_pasv(False)
+    ftp.cwd(self.path)
     print "Changing dir to", self.path
-  def cleanup_connection(self):
-    self.ftp = None
+    return ftp
+  def disconnect(self, ftp):
+    ftp.close()
+  def is_alive(self, ftp):
+    ftp.voidcmd("NOOP")
+    return True
 
 class SFTPHandler(RemoteFSHandler):
   def __init__(self, host, username, password, pkey_file, path):
@@ -108,82 +360,157 @@ class SFTPHandler(RemoteFSHandler):
     self.username = username
     self.password = password
     self.pkey_file = pkey_file
-    # Internal data
-    self.channel = None
-    self.transport = None
-  
+
   @retry_decorator(10, "list")
-  def list_files(self):
-    result = self.channel.listdir(self.path)
-    self.cleanup_connection()
-    return result
-  
+  def list_files(self, channel):
+    return channel.listdir(self.path)
+
+  @retry_decorator(10, "check existence")
+  def exists(self, channel, remote_name):
+    remote_path = os.path.join(self.path, remote_name)
+    remote_path = remote_path.replace("\\", "/")
+    try:
+      channel.stat(remote_path)
+      return True
+    except IOError, e:
+      if e.errno != errno.ENOENT:
+        raise
+      return False
+
   @retry_decorator(10, "upload")
-  def upload(self, file, remote_name):
+  def _upload(self, channel, transfer, file, remote_name):
     #print "Dummy uploading %s" % remote_name
     #return
     remote_path = os.path.join(self.path, remote_name)
     remote_path = remote_path.replace("\\", "/")
-    handle = self.channel.file(remote_path, "wb")
-    uploaded = 0
-    for block in FileIO.read_blocks(file, 128<<10):
+    offset = 0
+    if transfer.start_attempt():
+      offset = self.remote_size(channel, remote_path)
+      file.seek(0, 2)
+      if offset > file.tell():
+        # Not what we have been uploading, start from scratch
+        offset = 0
+    file.seek(offset)
+    if offset > 0:
+      transfer.resume(offset)
+      handle = channel.file(remote_path, "r+b")
+      handle.seek(offset)
+    else:
+      handle = channel.file(remote_path, "wb")
+    # With pipelining, the writes don't wait for their acknowledgements. An
+    # error of any of them is reported by close().
+    handle.set_pipelined(self.pipelining)
+    uploaded = offset
+    for block in FileIO.read_blocks(file, self.write_block_size):
       uploaded += len(block)
       logging.debug("Uploaded %d" % uploaded)
       if self.progress_reporter is not None:
         self.progress_reporter.set(uploaded)
+      self.throttle("upload", len(block))
       handle.write(block)
     handle.close()
-    self.cleanup_connection()
-    
+
   @retry_decorator(10, "download")
-  def download(self, file, remote_name):
+  def _download(self, channel, transfer, file, start, remote_name):
     remote_path = os.path.join(self.path, remote_name)
     remote_path = remote_path.replace("\\", "/")
-    handle = self.channel.file(remote_path, "rb")
-    downloaded = 0
-    for block in FileIO.read_blocks(handle, 16<<10):
+    # The data of the failed attempts is already in the file
+    offset = 0
+    if transfer.start_attempt():
+      file.seek(0, 2)
+      offset = file.tell() - start
+      transfer.resume(offset)
+    file.seek(start + offset)
+    handle = channel.file(remote_path, "rb")
+    handle.seek(offset)
+    if self.pipelining and not self.is_bandwidth_limited("download"):
+      # Request all the rest of the file at once. The data is collected in
+      # the background and handed out by read(). This is not done if the
+      # download is limited, since the data would arrive at full speed.
+      handle.prefetch()
+    downloaded = offset
+    for block in FileIO.read_blocks(handle, self.read_block_size):
       downloaded += len(block)
       logging.debug("Downloaded %d" % downloaded)
       if self.progress_reporter is not None:
         self.progress_reporter.set(downloaded)
+      self.throttle("download", len(block))
       file.write(block)
     handle.close()
-    self.cleanup_connection()
-  
+
+  @retry_decorator(10, "download range")
+  def download_range(self, channel, remote_name, offset, size):
+    remote_path = os.path.join(self.path, remote_name)
+    remote_path = remote_path.replace("\\", "/")
+    handle = channel.file(remote_path, "rb")
+    if self.pipelining:
+      # readv sends the requests for all the pieces of the range at once.
+      # The range must not extend beyond the end of the file.
+      size = max(0, min(size, handle.stat().st_size - offset))
+      self.throttle("download", size)
+      data = "".join(handle.readv([(offset, size)]))
+      handle.close()
+      return data
+    handle.seek(offset)
+    blocks = []
+    remaining = size
+    while remaining > 0:
+      block = handle.read(min(remaining, self.read_block_size))
+      if block == "":
+        break
+      self.throttle("download", len(block))
+      blocks.append(block)
+      remaining -= len(block)
+    handle.close()
+    return "".join(blocks)
+
   @retry_decorator(10, "rename")
-  def rename(self, old_name, new_name):
+  def rename(self, channel, old_name, new_name):
     old_path = os.path.join(self.path, old_name)
     old_path = old_path.replace("\\", "/")
     new_path = os.path.join(self.path, new_name)
     new_path = new_path.replace("\\", "/")
-    self.channel.rename(old_path, new_path)
-    self.cleanup_connection()
-  
+    channel.rename(old_path, new_path)
+
   @retry_decorator(10, "chmod")
-  def chmod(self, remote_name, mode):
+  def chmod(self, channel, remote_name, mode):
     remote_path = os.path.join(self.path, remote_name)
     remote_path = remote_path.replace("\\", "/")
-    self.channel.chmod(remote_path, mode)
-    self.cleanup_connection()
+    channel.chmod(remote_path, mode)
   #
   # Internal implementation
   #
+  def remote_size(self, channel, remote_path):
+    try:
+      return channel.stat(remote_path).st_size
+    except IOError:
+      # The file doesn't exist yet
+      return 0
   def connect(self):
-    if self.channel is not None:
-      return
+    # Every connection has a transport of its own, so that concurrent
+    # transfers don't share the encryption of a single one.
     if self.pkey_file is not None:
       privatekeyfile = os.path.expanduser(self.pkey_file)
       mykey = paramiko.RSAKey.from_private_key_file(privatekeyfile)
     else:
       mykey = None
-    self.transport = paramiko.Transport((self.host, 22))
-    self.transport.connect(username=self.username, password=self.password,
-        pkey=mykey)
-    self.channel = paramiko.SFTPClient.from_transport(self.transport)
-  def cleanup_connection(self):
-    if self.channel is not None:
-      self.channel.close()
-    if self.transport is not None:
-      self.transport.close()
-    self.transport = None
-    self.channel = None
+    transport = paramiko.Transport(split_host_port(self.host, 22),
+        default_window_size=self.window_size)
+    try:
+      transport.connect(username=self.username, password=self.password,
+          pkey=mykey)
+      return paramiko.SFTPClient.from_transport(transport,
+          window_size=self.window_size)
+    except:
+      transport.close()
+      raise
+  def disconnect(self, channel):
+    transport = channel.get_channel().get_transport()
+    channel.close()
+    transport.close()
+  def is_alive(self, channel):
+    if not channel.get_channel().get_transport().is_active():
+      return False
+    # A round trip to the server shows that the session is still usable.
+    channel.normalize(".")
+    return True
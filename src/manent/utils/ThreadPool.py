@@ -0,0 +1,71 @@
+#
+#    Copyright (C) 2008 Alex Gontmakher <gsasha@gmail.com>
+#    License: see LICENSE.txt
+#
+
+import Queue
+import sys
+import threading
+
+class Task:
+  """A unit of work submitted to a ThreadPool.
+  The caller keeps the task and asks for its result when it needs it.
+  An exception raised by the work is re-raised in the caller from result()."""
+  def __init__(self, func, args):
+    self.func = func
+    self.args = args
+    self.done = threading.Event()
+    self.value = None
+    self.exc_info = None
+  def run(self):
+    try:
+      self.value = self.func(*self.args)
+    except:
+      self.exc_info = sys.exc_info()
+    self.done.set()
+  def is_done(self):
+    return self.done.isSet()
+  def result(self):
+    self.done.wait()
+    if self.exc_info is not None:
+      raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+    return self.value
+
+class ThreadPool:
+  """A fixed set of worker threads that execute submitted tasks.
+
+  The work is expected to spend its time in code that releases the
+  interpreter lock (compression, encryption, network and disk I/O).
+  A pool with no workers executes every task synchronously in submit(), which
+  gives the same results as a real pool without any threads involved.
+  """
+  def __init__(self, num_workers):
+    self.num_workers = num_workers
+    self.queue = Queue.Queue()
+    self.workers = []
+    for i in range(num_workers):
+      worker = threading.Thread(target=self._work)
+      worker.setDaemon(True)
+      worker.start()
+      self.workers.append(worker)
+  def get_num_workers(self):
+    return self.num_workers
+  def submit(self, func, *args):
+    task = Task(func, args)
+    if self.num_workers == 0:
+      task.run()
+    else:
+      self.queue.put(task)
+    return task
+  def close(self):
+    for worker in self.workers:
+      self.queue.put(None)
+    for worker in self.workers:
+      worker.join()
+    self.workers = []
+  def _work(self):
+    while True:
+      task = self.queue.get()
+      if task is None:
+        return
+      task.run()
@@ -0,0 +1,187 @@
+#
+#    Copyright (C) 2008 Alex Gontmakher <gsasha@gmail.com>
+#    License: see LICENSE.txt
+#
+
+# Benchmarks of container dumping and loading. These are not unit tests: they
+# print the measured throughput and are meant to be run by hand:
+#   python testsuite/BenchContainer.py
+
+import cStringIO as StringIO
+import multiprocessing
+import os
+import random
+import sys
+import time
+
+# Point to the code location so that it is found when unit tests
+# are executed. We assume that sys.path[0] is the path to the module
+# itself. This allows the test to be executed directly by testoob.
+sys.path.append(os.path.join(sys.path[0], ".."))
+
+import manent.Container as Container
+import manent.utils.Digest as Digest
+import manent.utils.ThreadPool as ThreadPool
+
+BLOCK_SIZE = 256 * 1024
+
+def generate_blocks(total_size):
+  """Generate blocks of moderately compressible, text-like data"""
+  words = ["manent", "backup", "container", "block", "digest", "storage",
+      "increment", "sequence", "header", "compression", "encryption"]
+  rand = random.Random(1)
+  blocks = []
+  for i in range(total_size / BLOCK_SIZE):
+    text = " ".join([rand.choice(words) + str(rand.randint(0, 999))
+      for w in range(BLOCK_SIZE / 8)])
+    blocks.append(text[:BLOCK_SIZE])
+  return blocks
+
+def dump_blocks(blocks, compression_pool,
+    algorithm=Container.CODE_COMPRESSION_BZ2, encrypt=True):
+  """Dump the blocks the way Container does: restart the compression group
+  every MAX_COMPRESSED_DATA bytes"""
+  outfile = StringIO.StringIO()
+  dumper = Container.DataDumper(outfile, compression_pool)
+  if encrypt:
+    dumper.start_encryption(Container.CODE_ENCRYPTION_ARC4,
+        Digest.dataDigest("seed"), "password")
+  dumper.start_compression(algorithm)
+  compressed_data = 0
+  for block in blocks:
+    if compressed_data > Container.MAX_COMPRESSED_DATA:
+      dumper.stop_compression()
+      dumper.start_compression(algorithm)
+      compressed_data = 0
+    dumper.add_block(Digest.dataDigest(block), Container.CODE_DATA, block)
+    compressed_data += len(block)
+  dumper.stop_compression()
+  if encrypt:
+    dumper.stop_encryption()
+  return outfile.getvalue(), dumper.get_blocks()
+
+def bench_compression_workers(total_size=32 << 20):
+  """Report how the dumping throughput scales with the number of
+  compression workers"""
+  blocks = generate_blocks(total_size)
+  print "Dumping %d MB, %d cpus" % (total_size >> 20,
+      multiprocessing.cpu_count())
+  reference = None
+  base_speed = None
+  workers_list = [0, 1, 2, 4, 8]
+  if multiprocessing.cpu_count() not in workers_list:
+    workers_list.append(multiprocessing.cpu_count())
+  for workers in workers_list:
+    pool = ThreadPool.ThreadPool(workers)
+    start = time.time()
+    result = dump_blocks(blocks, pool)
+    elapsed = time.time() - start
+    pool.close()
+    if reference is None:
+      reference = result
+    assert result == reference, "Output differs for %d workers" % workers
+    speed = total_size / elapsed / (1 << 20)
+    if base_speed is None:
+      base_speed = speed
+    print "  compression workers:%2d  %7.2f MB/s  x%.2f" % (
+        workers, speed, speed / base_speed)
+
+def bench_codecs(total_size=8 << 20):
+  """Report the throughput and the ratio of every compression codec on text
+  and on incompressible data"""
+  data_sets = [("text", generate_blocks(total_size)),
+      ("random", [os.urandom(BLOCK_SIZE)
+        for i in range(total_size / BLOCK_SIZE)])]
+  specs = ["bz2:9", "bz2:1", "zlib:6", "zlib:1"]
+  if Container.lzma is not None:
+    specs += ["lzma:6", "lzma:0"]
+  for name, blocks in data_sets:
+    print "Compressing %d MB of %s data" % (total_size >> 20, name)
+    for spec in specs:
+      code, level = Container.parse_compression(spec)
+      start = time.time()
+      compressed = Container.compress_group(code, level, blocks)
+      elapsed = time.time() - start
+      print "  %-7s %7.2f MB/s  ratio %.3f" % (spec,
+          total_size / elapsed / (1 << 20),
+          float(len(compressed)) / total_size)
+    start = time.time()
+    compressible = [Container.is_compressible(block) for block in blocks]
+    elapsed = time.time() - start
+    print "  sampling %6.2f MB/s  %d of %d blocks compressible" % (
+        total_size / elapsed / (1 << 20), sum(compressible), len(blocks))
+
+class CountingListener:
+  def __init__(self):
+    self.size = 0
+  def is_requested(self, digest, code):
+    return True
+  def loaded(self, digest, code, data):
+    self.size += len(data)
+
+def concatenating_load(data, blocks):
+  """Load the blocks of an unencrypted dump by appending to a string and
+  reslicing the uncompressed buffer for every chunk, the way DataDumpLoader
+  used to. Serves as the reference for bench_load."""
+  infile = StringIO.StringIO(data)
+  loaded_size = 0
+  for (digest, size, code) in blocks:
+    if Container.is_compression_code(code):
+      uncompressor = Container.new_decompressor(code)
+      uncompressed_buf = ""
+    elif code == Container.CODE_COMPRESSION_END:
+      infile.read(uncompress_bytes)
+    elif Container.is_user_code(code):
+      block = ""
+      while len(block) < size:
+        if len(uncompressed_buf) > 0:
+          portion = min(size - len(block), len(uncompressed_buf))
+          block += uncompressed_buf[:portion]
+          uncompressed_buf = uncompressed_buf[portion:]
+        else:
+          toread = min(8192, uncompress_bytes)
+          uncompress_bytes -= toread
+          uncompressed_buf = uncompressor.decompress(infile.read(toread))
+      loaded_size += len(block)
+    if Container.is_compression_code(code):
+      for (s_digest, s_size, s_code) in blocks[blocks.index(
+          (digest, size, code)):]:
+        if s_code == Container.CODE_COMPRESSION_END:
+          uncompress_bytes = s_size
+          break
+  return loaded_size
+
+def bench_load(total_size=32 << 20):
+  """Report the throughput of loading all the blocks of a dump, compared to
+  assembling the blocks by string concatenation"""
+  blocks = generate_blocks(total_size)
+  print "Loading %d MB" % (total_size >> 20)
+  for algorithm in [Container.CODE_COMPRESSION_GZIP,
+      Container.CODE_COMPRESSION_BZ2]:
+    data, table = dump_blocks(blocks, None, algorithm, encrypt=False)
+    # Take the best of several runs, the first one is usually disturbed.
+    times = []
+    reference_times = []
+    for run in range(3):
+      start = time.time()
+      listener = CountingListener()
+      loader = Container.DataDumpLoader(StringIO.StringIO(data), table, None)
+      loader.load_blocks(listener)
+      times.append(time.time() - start)
+      assert listener.size == total_size
+
+      start = time.time()
+      loaded_size = concatenating_load(data, table)
+      reference_times.append(time.time() - start)
+      assert loaded_size == total_size
+    elapsed = min(times)
+    reference_elapsed = min(reference_times)
+    print "  %s loader %7.2f MB/s  concatenation %7.2f MB/s" % (
+        Container.code_name(algorithm),
+        total_size / elapsed / (1 << 20),
+        total_size / reference_elapsed / (1 << 20))
+
+if __name__ == "__main__":
+  bench_compression_workers()
+  bench_codecs()
+  bench_load()
@@ -0,0 +1,89 @@
+#
+#    Copyright (C) 2008 Alex Gontmakher <gsasha@gmail.com>
+#    License: see LICENSE.txt
+#
+
+# Benchmark of restoring a file from the packer stream. This is not a unit
+# test: it prints the measured throughput and is meant to be run by hand:
+#   python testsuite/BenchPacker.py [size in MB]
+
+import os
+import sys
+import time
+
+# Point to the code location so that it is found when unit tests
+# are executed. We assume that sys.path[0] is the path to the module
+# itself. This allows the test to be executed directly by testoob.
+sys.path.append(os.path.join(sys.path[0], ".."))
+
+import manent.Container as Container
+import manent.PackerStream as PackerStream
+import manent.utils.Digest as Digest
+import manent.utils.FileIO as FileIO
+
+BLOCK_SIZE = 256 * 1024
+# The synthetic file repeats this many different blocks
+NUM_UNIQUE_BLOCKS = 64
+# The stream reads are slow, so they are measured on a part of the file only
+MAX_STREAM_READ_SIZE = 256 << 20
+
+class MemoryBackup:
+  def __init__(self):
+    self.blocks = {}
+  def get_block_size(self):
+    return BLOCK_SIZE
+  def add_block(self, digest, code, data):
+    new = not self.blocks.has_key(digest)
+    self.blocks[digest] = data
+    return new
+  def load_block(self, digest):
+    return self.blocks[digest]
+
+def pack_file(backup, total_size):
+  """Store a synthetic file of the given size and return its digest and
+  level"""
+  blocks = [os.urandom(BLOCK_SIZE) for i in range(NUM_UNIQUE_BLOCKS)]
+  packer = PackerStream.PackerOStream(backup, Container.CODE_DATA)
+  for i in range(total_size / BLOCK_SIZE):
+    packer.write(blocks[i % NUM_UNIQUE_BLOCKS])
+  return packer.get_digest(), packer.get_level()
+
+def restore(packer, out, size, method):
+  restored = 0
+  if method == "stream":
+    for data in FileIO.read_blocks(packer, Digest.dataDigestSize()):
+      out.write(data)
+      restored += len(data)
+      if restored >= size:
+        break
+  else:
+    for data in packer.iter_blocks(verify=(method == "verify")):
+      out.write(data)
+      restored += len(data)
+  return restored
+
+def bench_restore(total_size=2 << 30):
+  """Report the throughput of restoring a file by reading the stream in
+  digest-sized pieces, as was done before, and by iterating the blocks"""
+  backup = MemoryBackup()
+  print "Packing a %d MB file" % (total_size >> 20)
+  digest, level = pack_file(backup, total_size)
+  out = open(os.devnull, "wb")
+  for method, description in [
+      ("stream", "32 byte reads"),
+      ("blocks", "block iterator"),
+      ("verify", "block iterator, verified")]:
+    packer = PackerStream.PackerIStream(backup, digest, level)
+    start = time.time()
+    restored = restore(packer, out, min(total_size, MAX_STREAM_READ_SIZE),
+        method)
+    elapsed = time.time() - start
+    print "  %-26s %5d MB in %6.2f s: %8.2f MB/s" % (description,
+        restored >> 20, elapsed, restored / elapsed / (1 << 20))
+  out.close()
+
+if __name__ == "__main__":
+  if len(sys.argv) > 1:
+    bench_restore(int(sys.argv[1]) << 20)
+  else:
+    bench_restore()
@@ -0,0 +1,73 @@
+#
+#    Copyright (C) 2008 Alex Gontmakher <gsasha@gmail.com>
+#    License: see LICENSE.txt
+#
+
+# Benchmark of the SFTP transfers over a link with a long round trip time.
+# This is not a unit test: it prints the measured throughput and is meant to
+# be run by hand:
+#   python testsuite/BenchRemoteFSHandler.py
+
+import cStringIO as StringIO
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+# Point to the code location so that it is found when unit tests
+# are executed. We assume that sys.path[0] is the path to the module
+# itself. This allows the test to be executed directly by testoob.
+sys.path.append(os.path.join(sys.path[0], ".."))
+
+import manent.utils.RemoteFSHandler as RemoteFSHandler
+import MockSFTPServer
+
+def bench_sftp(total_size=4 << 20, round_trip=0.02):
+  """Report the upload, download and range download throughput with and
+  without pipelining"""
+  root_dir = tempfile.mkdtemp()
+  try:
+    server = MockSFTPServer.MockSFTPServer(root_dir, round_trip / 2)
+    data = os.urandom(total_size)
+    print "Transferring %d MB, round trip %d ms" % (total_size >> 20,
+        round_trip * 1000)
+    # The first configuration is the synchronous transfer that was used
+    # before pipelining.
+    for name, read_block_size, write_block_size, pipelining in [
+        ("synchronous 16K/128K", 16 << 10, 128 << 10, False),
+        ("synchronous", 256 << 10, 256 << 10, False),
+        ("pipelined", 256 << 10, 256 << 10, True)]:
+      handler = RemoteFSHandler.SFTPHandler(server.get_host(),
+          MockSFTPServer.USER, MockSFTPServer.PASSWORD, None, "/")
+      handler.set_transfer_options(read_block_size, write_block_size,
+          RemoteFSHandler.RemoteFSHandler.WINDOW_SIZE, pipelining)
+      # Open the connection before measuring
+      handler.list_files()
+
+      start = time.time()
+      handler.upload(StringIO.StringIO(data), "file")
+      upload_time = time.time() - start
+
+      start = time.time()
+      downloaded = StringIO.StringIO()
+      handler.download(downloaded, "file")
+      download_time = time.time() - start
+      assert downloaded.getvalue() == data
+
+      start = time.time()
+      range_data = handler.download_range("file", 1000, total_size / 4)
+      range_time = time.time() - start
+      assert range_data == data[1000:1000 + total_size / 4]
+      handler.close()
+
+      print ("  %-21s upload %6.2f MB/s  download %6.2f MB/s"
+          "  range %6.2f MB/s" % (name,
+          total_size / upload_time / (1 << 20),
+          total_size / download_time / (1 << 20),
+          total_size / 4 / range_time / (1 << 20)))
+  finally:
+    shutil.rmtree(root_dir)
+
+if __name__ == "__main__":
+  bench_sftp()
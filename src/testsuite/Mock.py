@@ -18,6 +18,7 @@ sys.path.append(os.path.join(sys.path[0], ".."))
 import manent.Container as Container
 import manent.Nodes as Nodes
 import manent.Reporting as Reporting
+import manent.utils.ThreadPool as ThreadPool
 
 class MockContainerConfig:
   def blockSize(self):
@@ -57,6 +58,8 @@ class MockBlockCtx:
 class MockHlinkCtx:
   def __init__(self):
     self.inodes_db = {}
+    self.incremental = False
+    self.compare_data = False
   
 class MockChangeCtx:
   def __init__(self):
@@ -107,9 +110,11 @@ class MockScanCtx(MockBlockCtx, MockHlinkCtx, MockChangeCtx):
     pass
 
 class MockRestoreCtx(MockBlockCtx, MockHlinkCtx):
-  def __init__(self,backup):
+  def __init__(self, backup, incremental=False, compare_data=False):
     MockBlockCtx.__init__(self, backup)
     MockHlinkCtx.__init__(self)
+    self.incremental = incremental
+    self.compare_data = compare_data
 
 class MockRepository:
   def __init__(self):
@@ -172,6 +177,8 @@ class MockBackup:
     self.repository.add_block(digest, code, data)
   def load_block(self, digest):
     return self.repository.load_block(digest)
+  def prefetch_blocks(self, digests):
+    pass
   def get_block_code(self, digest):
     return self.repository.block_code(digest)
 
@@ -188,9 +195,18 @@ class MockStorage:
     self.max_container_size = Container.MAX_COMPRESSED_DATA + 1024 * 1024
 
     self.cur_index = 0
+    # The number of bytes read through load_body_range
+    self.body_range_bytes = 0
+    self.ranged_loading = True
+    self.compression = (Container.CODE_COMPRESSION_BZ2, 9)
+    self.adaptive_compression = False
+    self.upload_pool = ThreadPool.ThreadPool(0)
+    self.max_pending_uploads = 1
 
   def set_piggybacking_headers(self, h):
     self.piggybacking_headers = h
+  def set_ranged_loading(self, r):
+    self.ranged_loading = r
 
   def get_container(self, index):
     # We can load header file or body file only after it was written, i.e.,
@@ -201,6 +217,16 @@ class MockStorage:
 
   def get_encryption_key(self):
     return self.password
+  def get_compression_pool(self):
+    return None
+  def get_compression(self):
+    return self.compression
+  def is_compression_adaptive(self):
+    return self.adaptive_compression
+  def get_upload_pool(self):
+    return self.upload_pool
+  def get_max_pending_uploads(self):
+    return self.max_pending_uploads
 
   def load_header_file(self, sequence_id, index):
     if self.piggybacking_headers:
@@ -224,6 +250,17 @@ class MockStorage:
 
     assert hs + bs == len(container.getvalue())
     return container
+  def load_header_range(self, sequence_id, index):
+    if not self.ranged_loading:
+      return None
+    def fetch_range(offset, size):
+      return self.load_body_range(sequence_id, index, offset, size)
+    return Container.RangedFile(fetch_range, 0, 1024)
+  def load_body_range(self, sequence_id, index, offset, size):
+    header, body, container = self.containers[index]
+    data = container.getvalue()[offset:offset + size]
+    self.body_range_bytes += len(data)
+    return data
   def get_label(self):
     return "mukakaka"
   
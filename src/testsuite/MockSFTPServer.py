@@ -0,0 +1,190 @@
+#
+#    Copyright (C) 2008 Alex Gontmakher <gsasha@gmail.com>
+#    License: see LICENSE.txt
+#
+
+# A local SFTP server that serves a directory, for testing and benchmarking
+# the SFTP handler. Optionally, the connections to it go through a proxy that
+# delays the data in both directions, to simulate a distant server.
+
+import heapq
+import os
+import socket
+import threading
+import time
+import warnings
+
+warnings.filterwarnings("ignore", module="paramiko")
+warnings.filterwarnings("ignore", category=DeprecationWarning)
+import paramiko
+
+USER = "manent"
+PASSWORD = "manent"
+
+class StubServer(paramiko.ServerInterface):
+  def check_auth_password(self, username, password):
+    if username == USER and password == PASSWORD:
+      return paramiko.AUTH_SUCCESSFUL
+    return paramiko.AUTH_FAILED
+  def get_allowed_auths(self, username):
+    return "password"
+  def check_channel_request(self, kind, chanid):
+    return paramiko.OPEN_SUCCEEDED
+
+class StubSFTPHandle(paramiko.SFTPHandle):
+  def stat(self):
+    try:
+      return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+    except OSError, e:
+      return paramiko.SFTPServer.convert_errno(e.errno)
+
+class StubSFTPServer(paramiko.SFTPServerInterface):
+  """Serves the files in the root directory given to the server"""
+  ROOT = None
+  def _local_path(self, path):
+    return os.path.join(self.ROOT, os.path.basename(path))
+  def list_folder(self, path):
+    try:
+      result = []
+      for name in os.listdir(self.ROOT):
+        attr = paramiko.SFTPAttributes.from_stat(
+            os.stat(os.path.join(self.ROOT, name)))
+        attr.filename = name
+        result.append(attr)
+      return result
+    except OSError, e:
+      return paramiko.SFTPServer.convert_errno(e.errno)
+  def stat(self, path):
+    try:
+      return paramiko.SFTPAttributes.from_stat(os.stat(self._local_path(path)))
+    except OSError, e:
+      return paramiko.SFTPServer.convert_errno(e.errno)
+  lstat = stat
+  def open(self, path, flags, attr):
+    path = self._local_path(path)
+    try:
+      fd = os.open(path, flags | getattr(os, "O_BINARY", 0), 0644)
+    except OSError, e:
+      return paramiko.SFTPServer.convert_errno(e.errno)
+    if flags & os.O_WRONLY:
+      mode = "wb"
+    elif flags & os.O_RDWR:
+      mode = "r+b"
+    else:
+      mode = "rb"
+    handle = StubSFTPHandle(flags)
+    handle.filename = path
+    handle.readfile = os.fdopen(fd, mode)
+    handle.writefile = handle.readfile
+    return handle
+  def rename(self, oldpath, newpath):
+    try:
+      os.rename(self._local_path(oldpath), self._local_path(newpath))
+    except OSError, e:
+      return paramiko.SFTPServer.convert_errno(e.errno)
+    return paramiko.SFTP_OK
+  def chattr(self, path, attr):
+    return paramiko.SFTP_OK
+  def canonicalize(self, path):
+    return "/" + os.path.basename(path)
+
+class DelayingProxy:
+  """Forwards connections to the given port, delivering every piece of data
+  the given delay after it was received. The pieces are delayed
+  independently, so that the proxy behaves like a link with a long round
+  trip time and not like a slow one."""
+  def __init__(self, target_port, delay):
+    self.target_port = target_port
+    self.delay = delay
+    self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.listener.bind(("127.0.0.1", 0))
+    self.listener.listen(16)
+    self.port = self.listener.getsockname()[1]
+    _start_thread(self._accept)
+  def _accept(self):
+    while True:
+      client, address = self.listener.accept()
+      server = socket.create_connection(("127.0.0.1", self.target_port))
+      for source, dest in [(client, server), (server, client)]:
+        queue = DelayQueue()
+        _start_thread(self._receive, source, queue)
+        _start_thread(self._send, dest, queue)
+  def _receive(self, source, queue):
+    while True:
+      try:
+        data = source.recv(64 << 10)
+      except socket.error:
+        data = ""
+      queue.put(time.time() + self.delay, data)
+      if data == "":
+        return
+  def _send(self, dest, queue):
+    while True:
+      data = queue.get()
+      try:
+        if data == "":
+          dest.shutdown(socket.SHUT_WR)
+          return
+        dest.sendall(data)
+      except socket.error:
+        return
+
+class DelayQueue:
+  """Hands out the items at their due times, in the order of the times"""
+  def __init__(self):
+    self.items = []
+    self.sequence = 0
+    self.condition = threading.Condition()
+  def put(self, due_time, item):
+    self.condition.acquire()
+    heapq.heappush(self.items, (due_time, self.sequence, item))
+    self.sequence += 1
+    self.condition.notify()
+    self.condition.release()
+  def get(self):
+    self.condition.acquire()
+    try:
+      while True:
+        if len(self.items) > 0:
+          wait = self.items[0][0] - time.time()
+          if wait <= 0:
+            return heapq.heappop(self.items)[2]
+          self.condition.wait(wait)
+        else:
+          self.condition.wait()
+    finally:
+      self.condition.release()
+
+class MockSFTPServer:
+  """Serves the files of root_dir over SFTP at "127.0.0.1:<port>". If delay
+  is given, that is the one way latency added to the connections."""
+  host_key = None
+  def __init__(self, root_dir, delay=0):
+    if MockSFTPServer.host_key is None:
+      MockSFTPServer.host_key = paramiko.RSAKey.generate(1024)
+    class Server(StubSFTPServer):
+      ROOT = root_dir
+    self.sftp_server_class = Server
+    self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.listener.bind(("127.0.0.1", 0))
+    self.listener.listen(16)
+    self.port = self.listener.getsockname()[1]
+    _start_thread(self._accept)
+    if delay > 0:
+      self.port = DelayingProxy(self.port, delay).port
+  def get_host(self):
+    return "127.0.0.1:%d" % self.port
+  def _accept(self):
+    while True:
+      sock, address = self.listener.accept()
+      transport = paramiko.Transport(sock)
+      transport.add_server_key(self.host_key)
+      transport.set_subsystem_handler("sftp", paramiko.SFTPServer,
+          self.sftp_server_class)
+      transport.start_server(server=StubServer())
+
+def _start_thread(target, *args):
+  thread = threading.Thread(target=target, args=args)
+  thread.setDaemon(True)
+  thread.start()
+  return thread
@@ -0,0 +1,82 @@
+#
+#    Copyright (C) 2008 Alex Gontmakher <gsasha@gmail.com>
+#    License: see LICENSE.txt
+#
+
+import os
+import sys
+import time
+import unittest
+
+# Point to the code location so that it is found when unit tests
+# are executed. We assume that sys.path[0] is the path to the module
+# itself. This allows the test to be executed directly by testoob.
+sys.path.append(os.path.join(sys.path[0], ".."))
+
+import manent.Storage as Storage
+import manent.utils.BandwidthLimiter as BandwidthLimiter
+
+class MockClock:
+  """Time that passes only when somebody sleeps"""
+  def __init__(self, start):
+    self.now = start
+    self.slept = 0.0
+  def time(self):
+    return self.now
+  def sleep(self, delay):
+    self.now += delay
+    self.slept += delay
+
+def local_time(hour, minute):
+  return time.mktime((2009, 1, 5, hour, minute, 0, 0, 0, -1))
+
+class TestBandwidthLimiter(unittest.TestCase):
+  def test_token_bucket(self):
+    clock = MockClock(1000.0)
+    bucket = BandwidthLimiter.TokenBucket(1000, clock.time)
+    # The bucket starts empty, and transfers wait in turn
+    self.assertAlmostEqual(0.5, bucket.reserve(500))
+    self.assertAlmostEqual(1.5, bucket.reserve(1000))
+    clock.now += 1.5
+    self.assertAlmostEqual(0.0, bucket.reserve(0))
+    # An idle bucket fills up only to a second worth of data
+    clock.now += 10
+    self.assertAlmostEqual(0.0, bucket.reserve(1000))
+    self.assertAlmostEqual(0.1, bucket.reserve(100))
+    bucket.set_rate(None)
+    self.assertEqual(0.0, bucket.reserve(1 << 30))
+  def test_schedule(self):
+    schedule = Storage.parse_bandwidth_schedule(
+        "08:00-19:00=100K, 22:30-06:00=unlimited, 1M")
+    self.assertEqual(100 << 10, schedule.rate_at(local_time(8, 0)))
+    self.assertEqual(100 << 10, schedule.rate_at(local_time(18, 59)))
+    self.assertEqual(1 << 20, schedule.rate_at(local_time(19, 0)))
+    self.assertEqual(None, schedule.rate_at(local_time(23, 0)))
+    self.assertEqual(None, schedule.rate_at(local_time(5, 59)))
+    self.assertEqual(1 << 20, schedule.rate_at(local_time(6, 0)))
+    self.assertEqual(None, Storage.parse_bandwidth_schedule(
+      "unlimited").rate_at(local_time(12, 0)))
+  def test_scheduler(self):
+    # Check that a transfer is limited both by the total limit of its
+    # direction and by the limit of its storage
+    clock = MockClock(local_time(12, 0))
+    scheduler = BandwidthLimiter.BandwidthScheduler(clock.time, clock.sleep)
+    scheduler.set_limit("upload", Storage.parse_bandwidth_schedule("2K"))
+    scheduler.set_limit("upload",
+        Storage.parse_bandwidth_schedule("10:00-14:00=1K,unlimited"), "slow")
+    self.assert_(scheduler.is_limited("upload", "fast"))
+    self.assertFalse(scheduler.is_limited("download", "fast"))
+    scheduler.throttle("upload", 4 << 10, "fast")
+    self.assertAlmostEqual(2.0, clock.slept)
+    scheduler.throttle("upload", 4 << 10, "slow")
+    self.assertAlmostEqual(6.0, clock.slept)
+    scheduler.throttle("download", 1 << 30, "slow")
+    self.assertAlmostEqual(6.0, clock.slept)
+    # The storage limit applies only during the day
+    clock.now = local_time(20, 0)
+    scheduler.throttle("upload", 2 << 10, "slow")
+    scheduler.throttle("upload", 2 << 10, "slow")
+    self.assertAlmostEqual(7.0, clock.slept)
+    scheduler.set_limit("upload", None)
+    scheduler.throttle("upload", 1 << 30, "slow")
+    self.assertAlmostEqual(7.0, clock.slept)
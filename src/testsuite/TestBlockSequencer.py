@@ -19,6 +19,7 @@ import manent.Config as Config
 import manent.Container as Container
 import manent.Database as Database
 import manent.utils.Digest as Digest
+import manent.utils.ThreadPool as ThreadPool
 import Mock
 
 # For the purposes of this testing, we don't care that storage manager
@@ -32,6 +33,7 @@ class MockStorageManager:
     self.num_load_block_requests = 0
     self.num_blocks_loaded = 0
     self.storage = Mock.MockStorage(password="kakamaika")
+    self.written_containers = []
   def close(self):
     pass
   def add_block(self, digest, code, data):
@@ -43,10 +45,16 @@ class MockStorageManager:
     return self.storage.create_container()
   def get_container(self, index):
     return self.storage.get_container(index)
-  def container_written(self, container):
-    # Do nothing - unlike real StorageManager, we don't register the blocks
-    # anywhere.
+  def get_mirror_storages(self):
+    return []
+  def reserve_containers(self, num_extra):
     pass
+  def has_reserved_container(self):
+    return True
+  def container_written(self, container):
+    # Unlike real StorageManager, we don't register the blocks anywhere, only
+    # remember which containers were reported.
+    self.written_containers.append(container.get_index())
 
 class TestBlockSequencer(unittest.TestCase):
   def setUp(self):
@@ -175,3 +183,32 @@ class TestBlockSequencer(unittest.TestCase):
     self.assertEquals(3, ch.num_piggyback_headers)
 
 
+
+  def test_background_upload(self):
+    # Check that containers uploaded in the background are all reported to
+    # the storage manager after they are uploaded, by the time flush() ends.
+    storage = self.storage_manager.storage
+    storage.max_container_size = 512 * 1024
+    storage.upload_pool = ThreadPool.ThreadPool(2)
+    storage.max_pending_uploads = 3
+    bs = BlockSequencer.BlockSequencer(
+        self.env, self.txn, self.storage_manager, self.block_manager)
+    digests = []
+    for i in range(1000):
+      block = os.urandom(2000) + str(i)
+      digest = Digest.dataDigest(block)
+      digests.append(digest)
+      bs.add_block(digest, Container.CODE_DATA, block)
+      # A container is reported only after its upload has finished.
+      for index in self.storage_manager.written_containers:
+        header, body, container = storage.containers[index]
+        self.assertEquals(None, header)
+    bs.flush()
+    storage.upload_pool.close()
+    self.assert_(3 < bs.num_containers_created)
+    written = self.storage_manager.written_containers
+    self.assertEquals(bs.num_containers_created, len(set(written)))
+    self.assertEquals(bs.num_containers_created, len(written))
+    for digest in digests:
+      self.failIf(bs.has_pending_block(digest))
+    bs.close()
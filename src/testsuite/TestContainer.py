@@ -22,6 +22,7 @@ import manent.Container as Container
 import manent.Database as Database
 import manent.Storage as Storage
 import manent.utils.Digest as Digest
+import manent.utils.ThreadPool as ThreadPool
 import Mock
 
 #random.seed(23423)
@@ -122,6 +123,119 @@ class TestContainer(unittest.TestCase):
 
     self.failUnless(handler.check())
 
+  def test_data_dumper_compress_levels(self):
+    # Test that every codec, at every level, loads back the data it dumped.
+    for spec in ["bz2", "bz2:1", "zlib", "zlib:1", "zlib:9", "lzma", "lzma:0"]:
+      if spec.startswith("lzma") and Container.lzma is None:
+        continue
+      code, level = Container.parse_compression(spec)
+      handler = MockHandler()
+      outfile = StringIO.StringIO()
+      dumper = Container.DataDumper(outfile)
+      dumper.start_compression(code, level)
+      for d in DATA:
+        digest = Digest.dataDigest(d)
+        dumper.add_block(digest, Container.CODE_DATA, d)
+        handler.add_expected(digest, Container.CODE_DATA, d)
+      dumper.stop_compression()
+
+      infile = StringIO.StringIO(outfile.getvalue())
+      undumper = Container.DataDumpLoader(infile, dumper.get_blocks(),
+          password=None)
+      undumper.load_blocks(handler)
+      self.failUnless(handler.check())
+
+  def test_parse_compression(self):
+    self.assertEqual((Container.CODE_COMPRESSION_BZ2, 9),
+        Container.parse_compression("bz2"))
+    self.assertEqual((Container.CODE_COMPRESSION_GZIP, 1),
+        Container.parse_compression("zlib:1"))
+    self.assertEqual(None, Container.parse_compression("store"))
+    self.assertRaises(Exception, Container.parse_compression, "zip")
+
+  def test_data_dumper_compress_pool(self):
+    # Test that compressing the groups in a pool produces exactly the same
+    # output as compressing them inline.
+    seed = Digest.dataDigest("1")
+    pool = ThreadPool.ThreadPool(3)
+    outputs = []
+    for compression_pool in [None, pool]:
+      handler = MockHandler()
+      outfile = StringIO.StringIO()
+      dumper = Container.DataDumper(outfile, compression_pool)
+      dumper.start_encryption(Container.CODE_ENCRYPTION_ARC4, seed,
+        "kakamaika")
+      for group in range(10):
+        dumper.start_compression(Container.CODE_COMPRESSION_BZ2)
+        for i in range(group):
+          d = "group %d block %d " % (group, i) * (100 * i)
+          digest = Digest.dataDigest(d)
+          dumper.add_block(digest, Container.CODE_DATA, d)
+          handler.add_expected(digest, Container.CODE_DATA, d)
+        dumper.stop_compression()
+        d = "uncompressed %d" % group
+        dumper.add_block(Digest.dataDigest(d), Container.CODE_DATA, d)
+        handler.add_expected(Digest.dataDigest(d), Container.CODE_DATA, d)
+      dumper.stop_encryption()
+      blocks = dumper.get_blocks()
+      outputs.append((outfile.getvalue(), blocks))
+
+      infile = StringIO.StringIO(outfile.getvalue())
+      undumper = Container.DataDumpLoader(infile, blocks,
+        password="kakamaika")
+      undumper.load_blocks(handler)
+      self.failUnless(handler.check())
+    pool.close()
+    self.assertEqual(outputs[0], outputs[1])
+
+  def test_data_dumper_decompress_pool(self):
+    # Test that loading with a decompression pool delivers the same blocks in
+    # the same order as loading without it.
+    class OrderHandler:
+      def __init__(self, requested):
+        self.requested = requested
+        self.loaded_blocks = []
+      def is_requested(self, digest, code):
+        return self.requested.has_key(digest)
+      def loaded(self, digest, code, data):
+        self.loaded_blocks.append((digest, code, data))
+    outfile = StringIO.StringIO()
+    dumper = Container.DataDumper(outfile)
+    requested = {}
+    for section in range(6):
+      if section % 2 == 0:
+        dumper.start_encryption(Container.CODE_ENCRYPTION_ARC4,
+          Digest.dataDigest(str(section)), "kakamaika")
+      for group in range(5):
+        if group != 2:
+          dumper.start_compression(random.choice([
+            Container.CODE_COMPRESSION_BZ2, Container.CODE_COMPRESSION_GZIP]))
+        for i in range(group + 1):
+          d = "section %d group %d block %d" % (section, group, i) * (i + 1)
+          digest = Digest.dataDigest(d)
+          dumper.add_block(digest, Container.CODE_DATA, d)
+          # Leave some groups and sections without any requested blocks
+          if section != 3 and group != 4 and random.randint(0, 2) != 0:
+            requested[digest] = 1
+        if group != 2:
+          dumper.stop_compression()
+      if section % 2 == 0:
+        dumper.stop_encryption()
+    blocks = dumper.get_blocks()
+
+    pool = ThreadPool.ThreadPool(3)
+    results = []
+    for decompression_pool in [None, pool]:
+      handler = OrderHandler(requested)
+      infile = StringIO.StringIO(outfile.getvalue())
+      undumper = Container.DataDumpLoader(infile, blocks,
+        password="kakamaika", decompression_pool=decompression_pool)
+      undumper.load_blocks(handler)
+      results.append(handler.loaded_blocks)
+    pool.close()
+    self.assertEqual(len(requested), len(results[0]))
+    self.assertEqual(results[0], results[1])
+
   def test_data_dumper_encrypt(self):
     # Test data dumper when encryption is enabled
     handler = MockHandler()
@@ -146,6 +260,46 @@ class TestContainer(unittest.TestCase):
 
     self.failUnless(handler.check())
 
+  def test_data_dumper_encrypt_seek(self):
+    # Test that the loader does not read the parts of aes-ctr encrypted data
+    # that it doesn't need.
+    class ReadCountingFile:
+      def __init__(self, data):
+        self.file = StringIO.StringIO(data)
+        self.bytes_read = 0
+      def read(self, size):
+        data = self.file.read(size)
+        self.bytes_read += len(data)
+        return data
+      def seek(self, offset, whence=0):
+        self.file.seek(offset, whence)
+      def tell(self):
+        return self.file.tell()
+    outfile = StringIO.StringIO()
+    dumper = Container.DataDumper(outfile)
+    dumper.start_encryption(Container.CODE_ENCRYPTION_AES_CTR,
+      Digest.dataDigest("1"), "kakamaika")
+    for group in range(20):
+      dumper.start_compression(Container.CODE_COMPRESSION_BZ2)
+      for i in range(10):
+        d = os.urandom(1000)
+        dumper.add_block(Digest.dataDigest(d), Container.CODE_DATA, d)
+      dumper.stop_compression()
+    last_data = "last block"
+    dumper.add_block(Digest.dataDigest(last_data), Container.CODE_DATA,
+      last_data)
+    dumper.stop_encryption()
+
+    handler = MockHandler()
+    handler.add_expected(Digest.dataDigest(last_data), Container.CODE_DATA,
+      last_data)
+    infile = ReadCountingFile(outfile.getvalue())
+    undumper = Container.DataDumpLoader(infile, dumper.get_blocks(),
+      password="kakamaika")
+    undumper.load_blocks(handler)
+    self.failUnless(handler.check())
+    self.assertEqual(len(last_data), infile.bytes_read)
+
   def test_data_dumper_stress(self):
     # Test with really lots of randomly generated data
     handler = MockHandler()
@@ -219,8 +373,9 @@ class TestContainer(unittest.TestCase):
         encryption_active = random.randint(1,100)
         #print "  Starting encryption for %d rounds"
         seed = os.urandom(Digest.dataDigestSize())
-        dumper.start_encryption(Container.CODE_ENCRYPTION_ARC4, seed,
-          "kakamaika")
+        algorithm = random.choice([Container.CODE_ENCRYPTION_ARC4,
+          Container.CODE_ENCRYPTION_AES_CTR])
+        dumper.start_encryption(algorithm, seed, "kakamaika")
         
       elif action==2:
         # Try to start compression
@@ -229,8 +384,12 @@ class TestContainer(unittest.TestCase):
         compression_active = random.randint(1,100)
         if encryption_active != None:
           compression_active = min(compression_active, encryption_active)
-        algorithm = random.choice([Container.CODE_COMPRESSION_BZ2])
-        dumper.start_compression(algorithm)
+        algorithms = [Container.CODE_COMPRESSION_BZ2,
+            Container.CODE_COMPRESSION_GZIP]
+        if Container.lzma is not None:
+          algorithms.append(Container.CODE_COMPRESSION_LZMA)
+        dumper.start_compression(random.choice(algorithms),
+            random.choice([None, 1]))
 
     if compression_active is not None:
       dumper.stop_compression()
@@ -266,6 +425,152 @@ class TestContainer(unittest.TestCase):
     container.load_blocks(handler)
     self.failUnless(handler.check())
     
+  def test_container_adaptive_compression(self):
+    # Test that with adaptive compression, blocks that don't compress are
+    # stored out of the compression groups, and all the blocks load back.
+    self.storage.adaptive_compression = True
+    handler = MockHandler()
+    container = self.storage.create_container()
+    incompressible = []
+    for i in range(12):
+      if i % 3 == 0:
+        d = os.urandom(64 * 1024)
+        incompressible.append(Digest.dataDigest(d))
+      else:
+        d = ("text block %d " % i) * 5000
+      container.add_block(Digest.dataDigest(d), Container.CODE_DATA, d)
+      handler.add_expected(Digest.dataDigest(d), Container.CODE_DATA, d)
+    self.storage.finalize_container(container)
+    index = container.index
+
+    container = self.storage.get_container(index)
+    container.load_blocks(handler)
+    self.failUnless(handler.check())
+
+    in_compression = False
+    for digest, size, code in container._load_body_blocks():
+      if Container.is_compression_code(code):
+        in_compression = True
+      elif code == Container.CODE_COMPRESSION_END:
+        in_compression = False
+      elif digest in incompressible:
+        self.failIf(in_compression)
+      elif code == Container.CODE_DATA:
+        self.failUnless(in_compression)
+
+  def test_container_min_compression_group(self):
+    # Test that an incompressible block doesn't close a compression group that
+    # is still small, but does close a big enough one.
+    self.storage.adaptive_compression = True
+    handler = MockHandler()
+    container = self.storage.create_container()
+    small = "small text block " * 100
+    big = "big text block " * 10000
+    incompressible = [os.urandom(32 * 1024), os.urandom(32 * 1024)]
+    for d in [small, incompressible[0], big, incompressible[1]]:
+      container.add_block(Digest.dataDigest(d), Container.CODE_DATA, d)
+      handler.add_expected(Digest.dataDigest(d), Container.CODE_DATA, d)
+    self.storage.finalize_container(container)
+    index = container.index
+
+    container = self.storage.get_container(index)
+    container.load_blocks(handler)
+    self.failUnless(handler.check())
+
+    in_compression = {}
+    compression = False
+    for digest, size, code in container._load_body_blocks():
+      if Container.is_compression_code(code):
+        compression = True
+      elif code == Container.CODE_COMPRESSION_END:
+        compression = False
+      else:
+        in_compression[digest] = compression
+    self.failUnless(in_compression[Digest.dataDigest(incompressible[0])])
+    self.failIf(in_compression[Digest.dataDigest(incompressible[1])])
+
+  def test_locate_block(self):
+    # Test that the blocks can be read from the places given by locate_block
+    # directly, both in and out of compression groups.
+    storage = Mock.MockStorage("")
+    storage.adaptive_compression = True
+    container = storage.create_container()
+    blocks = []
+    for i in range(20):
+      if i % 4 == 0:
+        d = os.urandom(32 * 1024)
+      else:
+        d = ("text block %d " % i) * 3000
+      container.add_block(Digest.dataDigest(d), Container.CODE_DATA, d)
+      blocks.append(d)
+    storage.finalize_container(container)
+    index = container.index
+
+    container = storage.get_container(index)
+    body_blocks = container._load_body_blocks()
+    self.assertEqual(Container.compute_block_offsets(body_blocks),
+        container.loaded_block_offsets)
+    header, body, container_file = storage.containers[index]
+    body_str = container_file.getvalue()[container.loaded_header_size:]
+    for d in blocks:
+      offset, size, block_offset, block_size, code = container.locate_block(
+          Digest.dataDigest(d))
+      data = body_str[offset:offset + size]
+      if code is not None:
+        data = Container.new_decompressor(code).decompress(data)
+      self.assertEqual(d, data[block_offset:block_offset + block_size])
+    self.assertEqual(None, container.locate_block(Digest.dataDigest("none")))
+
+  def test_container_store(self):
+    # Test a container whose body is stored without compression
+    self.storage.compression = None
+    handler = MockHandler()
+    container = self.storage.create_container()
+    for d in DATA:
+      container.add_block(Digest.dataDigest(d), Container.CODE_DATA, d)
+      handler.add_expected(Digest.dataDigest(d), Container.CODE_DATA, d)
+    self.storage.finalize_container(container)
+
+    container = self.storage.get_container(container.index)
+    container.load_blocks(handler)
+    self.failUnless(handler.check())
+    for digest, size, code in container._load_body_blocks():
+      self.failIf(Container.is_compression_code(code))
+
+  def test_container_without_ranged_loading(self):
+    # Test that a container is loaded from the whole container file if the
+    # storage can't read parts of it.
+    self.storage.set_piggybacking_headers(False)
+    self.storage.set_ranged_loading(False)
+    handler = MockHandler()
+    container = self.storage.create_container()
+    for d in DATA:
+      container.add_block(Digest.dataDigest(d), Container.CODE_DATA, d)
+      handler.add_expected(Digest.dataDigest(d), Container.CODE_DATA, d)
+    self.storage.finalize_container(container)
+    index = container.index
+
+    container = self.storage.get_container(index)
+    container.load_blocks(handler)
+    self.failUnless(handler.check())
+    self.assertEqual(0, self.storage.body_range_bytes)
+
+  def test_container_header_only(self):
+    # Test that reading the header of a container doesn't read its body.
+    self.storage.set_piggybacking_headers(False)
+    container = self.storage.create_container()
+    for i in range(64):
+      d = os.urandom(4096)
+      container.add_block(Digest.dataDigest(d), Container.CODE_DATA, d)
+    self.storage.finalize_container(container)
+    index = container.index
+
+    handler = MockHandler()
+    container = self.storage.get_container(index)
+    container.load_blocks(handler)
+    self.failUnless(handler.check())
+    self.assert_(self.storage.body_range_bytes < 16 * 1024)
+
   def test_container_with_piggybacking(self):
     # Test that container is created correctly.
     # See that the container is created, stored and reloaded back,
@@ -285,6 +590,68 @@ class TestContainer(unittest.TestCase):
     container.load_blocks(handler)
     self.failUnless(handler.check())
     
+  def test_container_ranged_load(self):
+    # Test that when the header is known, only the parts of the body that hold
+    # the requested blocks are fetched.
+    self.storage.set_piggybacking_headers(True)
+    container = self.storage.create_container()
+    blocks = []
+    for i in range(256):
+      d = os.urandom(4096)
+      container.add_block(Digest.dataDigest(d), Container.CODE_DATA, d)
+      blocks.append(d)
+    self.storage.finalize_container(container)
+    index = container.index
+
+    handler = MockHandler()
+    wanted = blocks[100]
+    handler.add_expected(Digest.dataDigest(wanted), Container.CODE_DATA,
+      wanted)
+    container = self.storage.get_container(index)
+    container.load_blocks(handler)
+    self.failUnless(handler.check())
+    self.assert_(self.storage.body_range_bytes > 0)
+    self.assert_(self.storage.body_range_bytes <
+        Container.MAX_COMPRESSED_DATA + 64 * 1024)
+
+  def test_list_blocks_from(self):
+    # Test that the blocks following a given one are listed up to the size
+    # limit.
+    container = self.storage.create_container()
+    digests = []
+    for i in range(10):
+      d = "block %d" % i + " " * 100
+      container.add_block(Digest.dataDigest(d), Container.CODE_DATA, d)
+      digests.append(Digest.dataDigest(d))
+    self.storage.finalize_container(container)
+    container = self.storage.get_container(container.index)
+    self.assertEqual(digests[3:6], container.list_blocks_from(digests[3], 350))
+    self.assertEqual(digests[8:], container.list_blocks_from(digests[8], 1000))
+
+  def test_ranged_file(self):
+    # Test that RangedFile returns the right data both from the prefetched
+    # ranges and from the ranges it has to fetch on demand.
+    data = os.urandom(10000)
+    fetched = []
+    def fetch_range(offset, size):
+      fetched.append((offset, size))
+      return data[offset:offset + size]
+    ranged_file = Container.RangedFile(fetch_range, 100)
+    ranged_file.prefetch([(1000, 500), (3000, 10)])
+    self.assertEqual(data[100:200], ranged_file.read(100))
+    ranged_file.seek(1100)
+    self.assertEqual(data[1100:1200], ranged_file.read(100))
+    ranged_file.seek(900)
+    self.assertEqual(data[900:3100], ranged_file.read(2200))
+    self.assertEqual(3100, ranged_file.tell())
+    ranged_file.seek(9000)
+    self.assertEqual(data[9000:], ranged_file.read(2000))
+    # Data that was already fetched is not fetched again
+    ranged_file.seek(1000)
+    num_fetched = len(fetched)
+    self.assertEqual(data[1000:1500], ranged_file.read(500))
+    self.assertEqual(num_fetched, len(fetched))
+
   def test_piggyback_headers_small_headers(self):
     # Test that if we are piggybacking small headers, all of them will be
     # inserted into the container.
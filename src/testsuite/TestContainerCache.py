@@ -0,0 +1,68 @@
+#
+#    Copyright (C) 2008 Alex Gontmakher <gsasha@gmail.com>
+#    License: see LICENSE.txt
+#
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+# Point to the code location so that it is found when unit tests
+# are executed. We assume that sys.path[0] is the path to the module
+# itself. This allows the test to be executed directly by testoob.
+sys.path.append(os.path.join(sys.path[0], ".."))
+
+import manent.Config as Config
+import manent.ContainerCache as ContainerCache
+
+class TestContainerCache(unittest.TestCase):
+  def setUp(self):
+    self.path = tempfile.mkdtemp(".cache", "manent.", Config.paths.temp_area())
+    self.downloads = []
+  def tearDown(self):
+    shutil.rmtree(self.path)
+    Config.paths.clean_temp_area()
+  def downloader(self, name, size):
+    def download(file):
+      self.downloads.append(name)
+      file.write(name[0] * size)
+    return download
+  def test_cached(self):
+    # Check that a container is downloaded only the first time it is loaded
+    cache = ContainerCache.ContainerCache(self.path, 1000)
+    self.assertEquals(None, cache.get("a"))
+    for i in range(3):
+      file = cache.load("a", self.downloader("a", 100))
+      self.assertEquals("a" * 100, file.read())
+      file.close()
+    self.assertEquals(["a"], self.downloads)
+    self.assertEquals(100, cache.get_size())
+    # The cache persists between the instances
+    cache = ContainerCache.ContainerCache(self.path, 1000)
+    self.assertNotEqual(None, cache.get("a"))
+  def test_failed_download(self):
+    # Check that a failed download leaves nothing in the cache
+    cache = ContainerCache.ContainerCache(self.path, 1000)
+    def download(file):
+      file.write("partial")
+      raise IOError("Connection broken")
+    self.assertRaises(IOError, cache.load, "a", download)
+    self.assertEquals(None, cache.get("a"))
+    self.assertEquals([], os.listdir(self.path))
+  def test_lru_eviction(self):
+    # Check that the least recently used containers are evicted when the
+    # cache exceeds its size
+    cache = ContainerCache.ContainerCache(self.path, 300)
+    now = time.time()
+    for i, name in enumerate(["a", "b", "c"]):
+      cache.load(name, self.downloader(name, 100)).close()
+      os.utime(os.path.join(self.path, name), (now - 100 + i, now - 100 + i))
+    # Using "a" makes "b" the least recently used one
+    cache.get("a").close()
+    cache.load("d", self.downloader("d", 100)).close()
+    self.assertEquals(None, cache.get("b"))
+    self.assertEquals(300, cache.get_size())
+    self.assertEquals(["a", "c", "d"], sorted(os.listdir(self.path)))
@@ -223,6 +223,43 @@ class TestNodes(unittest.TestCase):
 
     self.failUnless(self.fsc.test_files(file_data))
 
+  def test_incremental_restore(self):
+    # Test that restoring into an existing tree rewrites only the files that
+    # differ from the restored ones
+    backup = Mock.MockBackup(self.fsc.get_home())
+    ctx = backup.start_increment("for restoring")
+
+    file_data = {u"file1" : FSC.FSCFile("kuku"),
+        u"dir1": {u"file2" : FSC.FSCFile("kuku"),
+      u"file3" : FSC.FSCFile("bebe")}}
+    self.fsc.reset()
+    self.fsc.add_files(file_data)
+
+    basedir = Nodes.Directory(backup, None, self.fsc.get_home())
+    ep = EP.ExclusionProcessor(self.fsc.get_home())
+    basedir.scan(ctx, None, ep)
+
+    # Change one file, keeping its stats, and remove another one
+    file2 = os.path.join(self.fsc.get_home(), u"dir1", u"file2")
+    mtime = os.stat(file2).st_mtime
+    f = open(file2, "wb")
+    f.write("kiki")
+    f.close()
+    os.utime(file2, (mtime, mtime))
+    os.unlink(os.path.join(self.fsc.get_home(), u"file1"))
+
+    restore_ctx = backup.start_restore(0)
+    restore_ctx.incremental = True
+    basedir.restore(restore_ctx)
+    self.assertEqual("kiki", open(file2).read())
+    self.assertEqual("kuku",
+        open(os.path.join(self.fsc.get_home(), u"file1")).read())
+
+    restore_ctx = backup.start_restore(0)
+    restore_ctx.incremental = True
+    restore_ctx.compare_data = True
+    basedir.restore(restore_ctx)
+    self.failUnless(self.fsc.test_files(file_data))
   def test_directory_unicode(self):
     # Test that unicode directories are scanned and restored correctly
     backup = Mock.MockBackup(self.fsc.get_home())
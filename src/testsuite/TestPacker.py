@@ -23,6 +23,7 @@ class MockBackup:
 	def __init__(self):
 		self.blocks_db = {}
 		self.block_code_db = {}
+		self.prefetched_digests = []
 	def get_block_size(self):
 		# Use a relatively small block size to test going deep into hierarchy
 		return 256
@@ -33,6 +34,8 @@ class MockBackup:
 	def load_block(self, digest):
 		#print "Loading block digest=", base64.b64encode(digest)
 		return self.blocks_db[digest]
+	def prefetch_blocks(self, digests):
+		self.prefetched_digests += digests
 	def get_block_code(self, digest):
 		return self.block_code_db[digest]
 
@@ -76,6 +79,49 @@ class TestPacker(unittest.TestCase):
 			self.assertEqual(istream.read(1), '')
 
 			size *= 2
+	def test_iter_blocks(self):
+		# Test that iterating over the blocks gives the data of the stream,
+		# also after a part of it has been read
+		backup = MockBackup()
+		data = os.urandom(100000)
+		ostream = PackerStream.PackerOStream(backup, Container.CODE_DATA)
+		ostream.write(data)
+		digest = ostream.get_digest()
+		level = ostream.get_level()
+		istream = PackerStream.PackerIStream(backup, digest, level)
+		blocks = list(istream.iter_blocks(verify=True))
+		self.assertEqual(data, "".join(blocks))
+		self.assertEqual(backup.get_block_size(), len(blocks[0]))
+		istream = PackerStream.PackerIStream(backup, digest, level)
+		self.assertEqual(data[:1000], istream.read(1000))
+		self.assertEqual(data[1000:], "".join(istream.iter_blocks()))
+		# A corrupted block is detected only if verifying
+		block_digest = [d for d, block in backup.blocks_db.iteritems()
+				if block == blocks[3]][0]
+		backup.blocks_db[block_digest] = "x" * len(blocks[3])
+		istream = PackerStream.PackerIStream(backup, digest, level)
+		self.assertEqual(len(data), len("".join(istream.iter_blocks())))
+		istream = PackerStream.PackerIStream(backup, digest, level)
+		self.assertRaises(Exception, list, istream.iter_blocks(verify=True))
+	def test_prefetch(self):
+		# Test that the blocks are prefetched the given number of blocks ahead
+		# of the one being read, and each one only once
+		backup = MockBackup()
+		data = os.urandom(10000)
+		ostream = PackerStream.PackerOStream(backup, Container.CODE_DATA)
+		ostream.write(data)
+		digest = ostream.get_digest()
+		level = ostream.get_level()
+		istream = PackerStream.PackerIStream(backup, digest, level, 5)
+		num_blocks = 0
+		for block in istream.iter_blocks():
+			num_blocks += 1
+			self.assertEqual(min(num_blocks + 5, 40),
+					len(backup.prefetched_digests))
+		self.assertEqual(data, "".join([backup.blocks_db[d]
+			for d in backup.prefetched_digests]))
+		istream = PackerStream.PackerIStream(backup, digest, level, 5)
+		self.assertEqual(data, istream.read())
 	def test_different_code(self):
 	  # Test that codes different from CODE_DATA work too
 		backup = MockBackup()
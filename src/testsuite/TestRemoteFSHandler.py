@@ -0,0 +1,223 @@
+#
+#    Copyright (C) 2008 Alex Gontmakher <gsasha@gmail.com>
+#    License: see LICENSE.txt
+#
+
+import cStringIO as StringIO
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+# Point to the code location so that it is found when unit tests
+# are executed. We assume that sys.path[0] is the path to the module
+# itself. This allows the test to be executed directly by testoob.
+sys.path.append(os.path.join(sys.path[0], ".."))
+
+import manent.Reporting as Reporting
+import manent.utils.BandwidthLimiter as BandwidthLimiter
+import manent.utils.FileIO as FileIO
+import manent.utils.RemoteFSHandler as RemoteFSHandler
+import MockSFTPServer
+
+class MockConnection:
+  def __init__(self, index):
+    self.index = index
+    self.alive = True
+    self.closed = False
+
+class MockHandler(RemoteFSHandler.RemoteFSHandler):
+  """A handler whose connections are plain objects, and whose operation
+  fails a given number of times"""
+  def __init__(self):
+    RemoteFSHandler.RemoteFSHandler.__init__(self)
+    self.retry_delay = 0
+    self.connections = []
+    self.failures = 0
+    self.remote_files = {}
+    # Every transfer attempt breaks after transferring so many bytes
+    self.break_after = None
+    self.remote_partial = ""
+  def connect(self):
+    connection = MockConnection(len(self.connections))
+    self.connections.append(connection)
+    return connection
+  def disconnect(self, connection):
+    connection.closed = True
+  def is_alive(self, connection):
+    return connection.alive
+  @RemoteFSHandler.retry_decorator(3, "operate")
+  def operate(self, connection):
+    if self.failures > 0:
+      self.failures -= 1
+      raise IOError("Connection broken")
+    return connection.index
+  @RemoteFSHandler.retry_decorator(10, "upload")
+  def _upload(self, connection, transfer, file, remote_name):
+    offset = 0
+    if transfer.start_attempt():
+      offset = len(self.remote_files.get(remote_name, ""))
+      transfer.resume(offset)
+    file.seek(offset)
+    data = self.remote_files.get(remote_name, "")[:offset]
+    try:
+      data += self._transfer(file)
+    finally:
+      self.remote_files[remote_name] = data + self.remote_partial
+      self.remote_partial = ""
+  @RemoteFSHandler.retry_decorator(10, "download")
+  def _download(self, connection, transfer, file, start, remote_name):
+    offset = 0
+    if transfer.start_attempt():
+      file.seek(0, 2)
+      offset = file.tell() - start
+      transfer.resume(offset)
+    file.seek(start + offset)
+    remote_file = StringIO.StringIO(self.remote_files[remote_name])
+    remote_file.seek(offset)
+    try:
+      file.write(self._transfer(remote_file))
+    finally:
+      file.write(self.remote_partial)
+      self.remote_partial = ""
+  def _transfer(self, file):
+    data = "".join(FileIO.read_blocks(file, 4096))
+    if self.break_after is not None and len(data) > self.break_after:
+      # Keep what has been transferred before the connection broke
+      self.remote_partial = data[:self.break_after]
+      raise IOError("Connection broken")
+    return data
+
+class TestRemoteFSHandler(unittest.TestCase):
+  def test_connection_reused(self):
+    # Check that consecutive operations run on the same connection
+    handler = MockHandler()
+    self.assertEquals(0, handler.operate())
+    self.assertEquals(0, handler.operate())
+    self.assertEquals(1, len(handler.connections))
+    handler.close()
+    self.assert_(handler.connections[0].closed)
+  def test_concurrent_checkout(self):
+    # Check that connections checked out at the same time are different, and
+    # that they are all kept for reuse.
+    handler = MockHandler()
+    pool = handler.pool
+    c1 = pool.checkout()
+    c2 = pool.checkout()
+    self.assertNotEqual(c1, c2)
+    pool.checkin(c1)
+    pool.checkin(c2)
+    self.assertEquals(2, pool.get_num_idle())
+    self.assertEquals(c2, pool.checkout())
+  def test_dead_connection_replaced(self):
+    # Check that an idle connection that died is not reused
+    handler = MockHandler()
+    handler.pool.IDLE_CHECK_TIME = 0
+    self.assertEquals(0, handler.operate())
+    handler.connections[0].alive = False
+    self.assertEquals(1, handler.operate())
+    self.assert_(handler.connections[0].closed)
+  def test_retry_reconnects(self):
+    # Check that a failed operation is retried on a new connection, and that
+    # the handler gives up after the given number of retries
+    handler = MockHandler()
+    handler.failures = 2
+    self.assertEquals(2, handler.operate())
+    self.assert_(handler.connections[0].closed)
+    self.assert_(handler.connections[1].closed)
+    handler.failures = 3
+    self.assertRaises(Exception, handler.operate)
+  def test_resumed_upload(self):
+    # Check that an upload that breaks is resumed from the data that has
+    # reached the server, and that the retries are reported
+    handler = MockHandler()
+    report_manager = Reporting.ReportManager()
+    handler.set_report_manager(report_manager)
+    handler.break_after = 1000
+    header = StringIO.StringIO("h" * 300)
+    body = StringIO.StringIO(os.urandom(3500))
+    handler.upload(FileIO.ConcatenatedFile([header, body]), "file")
+    self.assertEquals(header.getvalue() + body.getvalue(),
+        handler.remote_files["file"])
+    self.assertEquals(3, report_manager.find_reporter(
+      "storage.remote.upload.file.retries", 0).value)
+    self.assertEquals(1000 + 2000 + 3000, report_manager.find_reporter(
+      "storage.remote.upload.file.resumed_bytes", 0).value)
+  def test_resumed_download(self):
+    # Check that a download that breaks is resumed from the data that has
+    # been received
+    handler = MockHandler()
+    handler.remote_files["file"] = os.urandom(2500)
+    handler.break_after = 1000
+    file = StringIO.StringIO()
+    file.write("prefix")
+    handler.download(file, "file")
+    self.assertEquals("prefix" + handler.remote_files["file"],
+        file.getvalue())
+  def test_concatenated_file_seek(self):
+    files = [StringIO.StringIO("abc"), StringIO.StringIO(""),
+        StringIO.StringIO("defgh")]
+    concatenated = FileIO.ConcatenatedFile(files)
+    concatenated.seek(2)
+    self.assertEquals(2, concatenated.tell())
+    self.assertEquals("cdefgh", "".join(FileIO.read_blocks(concatenated, 2)))
+    self.assertEquals(8, concatenated.tell())
+    concatenated.seek(4)
+    self.assertEquals("efgh", "".join(FileIO.read_blocks(concatenated, 10)))
+    concatenated.seek(0, 2)
+    self.assertEquals(8, concatenated.tell())
+    self.assertEquals("", concatenated.read(10))
+  def test_sftp_transfers(self):
+    # Check the transfers of the SFTP handler against a local server, with
+    # and without pipelining
+    root_dir = tempfile.mkdtemp()
+    try:
+      server = MockSFTPServer.MockSFTPServer(root_dir)
+      handler = RemoteFSHandler.SFTPHandler(server.get_host(),
+          MockSFTPServer.USER, MockSFTPServer.PASSWORD, None, "/")
+      data = os.urandom(300000)
+      for pipelining in [True, False]:
+        handler.set_transfer_options(64 << 10, 48 << 10, 1 << 20, pipelining)
+        handler.upload(StringIO.StringIO(data), "file.tmp")
+        handler.rename("file.tmp", "file")
+        self.assertEquals(["file"], handler.list_files())
+        downloaded = StringIO.StringIO()
+        handler.download(downloaded, "file")
+        self.assertEquals(data, downloaded.getvalue())
+        self.assertEquals(data[1000:101000],
+            handler.download_range("file", 1000, 100000))
+        self.assertEquals(data[-10:],
+            handler.download_range("file", len(data) - 10, 1000))
+        os.unlink(os.path.join(root_dir, "file"))
+      handler.close()
+    finally:
+      shutil.rmtree(root_dir)
+  def test_sftp_bandwidth_limit(self):
+    # Check that every byte transferred by the SFTP handler is accounted by the
+    # bandwidth scheduler under the name of the handler
+    class RecordingScheduler(BandwidthLimiter.BandwidthScheduler):
+      def __init__(self):
+        BandwidthLimiter.BandwidthScheduler.__init__(self)
+        self.transferred = {}
+      def throttle(self, direction, size, name=None):
+        key = (direction, name)
+        self.transferred[key] = self.transferred.get(key, 0) + size
+    root_dir = tempfile.mkdtemp()
+    try:
+      server = MockSFTPServer.MockSFTPServer(root_dir)
+      handler = RemoteFSHandler.SFTPHandler(server.get_host(),
+          MockSFTPServer.USER, MockSFTPServer.PASSWORD, None, "/")
+      scheduler = RecordingScheduler()
+      scheduler.set_limit("download", BandwidthLimiter.BandwidthSchedule([],
+        1 << 30))
+      handler.set_bandwidth_scheduler(scheduler, "storage")
+      data = os.urandom(300000)
+      handler.upload(StringIO.StringIO(data), "file")
+      handler.download(StringIO.StringIO(), "file")
+      handler.download_range("file", 1000, 100000)
+      self.assertEquals({("upload", "storage"): len(data),
+        ("download", "storage"): len(data) + 100000}, scheduler.transferred)
+      handler.close()
+    finally:
+      shutil.rmtree(root_dir)
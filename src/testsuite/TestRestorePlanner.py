@@ -0,0 +1,229 @@
+#
+#    Copyright (C) 2008 Alex Gontmakher <gsasha@gmail.com>
+#    License: see LICENSE.txt
+#
+
+import os
+import os.path
+import sys
+import unittest
+
+# Point to the code location so that it is found when unit tests
+# are executed. We assume that sys.path[0] is the path to the module
+# itself. This allows the test to be executed directly by testoob.
+sys.path.append(os.path.join(sys.path[0], ".."))
+
+# manent imports
+import manent.Config as Config
+import manent.Database as Database
+import manent.ExclusionProcessor as EP
+import manent.Nodes as Nodes
+import manent.RestorePlanner as RestorePlanner
+import manent.Storage as Storage
+import manent.StorageManager as StorageManager
+
+# test util imports
+import UtilFilesystemCreator as FSC
+import Mock
+
+class StorageBackup(Mock.MockBackup):
+  """A mock backup that keeps its blocks in a real storage manager"""
+  def __init__(self, home, storage_manager):
+    Mock.MockBackup.__init__(self, home)
+    self.storage_manager = storage_manager
+  def add_block(self, digest, code, data):
+    self.storage_manager.add_block(digest, code, data)
+  def load_block(self, digest):
+    return self.storage_manager.load_block(digest)
+
+class TestRestorePlanner(unittest.TestCase):
+  def setUp(self):
+    self.fsc = FSC.FilesystemCreator()
+    self.env = Database.PrivateDatabaseManager()
+    self.txn = Database.TransactionHandler(self.env)
+  def tearDown(self):
+    Storage.MemoryStorage.files = {}
+    self.txn.abort()
+    self.env.close()
+    Config.paths.clean_temp_area()
+
+  def scan(self, mirror=False):
+    """Scan the tree into a storage, and into a mirror storage if asked to.
+    Returns the digest, the level and the stats of its root"""
+    storage_manager = StorageManager.StorageManager(self.env, self.txn)
+    storage_manager.load_storages()
+    storage_index = storage_manager.add_storage(
+      {'type': '__mock__', 'encryption_key': 'kuku', 'key': ''})
+    storage_manager.make_active_storage(storage_index)
+    if mirror:
+      mirror_index = storage_manager.add_storage(
+        {'type': '__mock__', 'encryption_key': 'kuku', 'key': 'mirror'})
+      storage_manager.make_mirror_storage(mirror_index)
+    backup = StorageBackup(self.fsc.get_home(), storage_manager)
+    ctx = backup.start_increment("for restoring")
+
+    basedir = Nodes.Directory(backup, None, self.fsc.get_home())
+    ep = EP.ExclusionProcessor(self.fsc.get_home())
+    basedir.scan(ctx, None, ep)
+    storage_manager.flush()
+    storage_manager.close()
+    return basedir.get_digest(), basedir.get_level(), basedir.get_stats()
+  def restore(self, root, num_writers, incremental=False, compare_data=False):
+    """Restore the scanned tree with a planner. Returns the planner"""
+    digest, level, stats = root
+    # Restore with a fresh storage manager, so that no data is in memory
+    storage_manager = StorageManager.StorageManager(self.env, self.txn)
+    storage_manager.load_storages()
+    backup = StorageBackup(self.fsc.get_home(), storage_manager)
+    restore_dir = Nodes.Directory(backup, None, self.fsc.get_home())
+    restore_dir.set_digest(digest)
+    restore_dir.set_level(level)
+    restore_dir.set_stats(stats)
+    planner = RestorePlanner.RestorePlanner(backup, storage_manager,
+        num_writers)
+    planner.restore(restore_dir,
+        Mock.MockRestoreCtx(backup, incremental, compare_data))
+    storage_manager.close()
+    return planner
+  def scan_and_restore(self, num_writers):
+    root = self.scan()
+    self.fsc.reset()
+    return self.restore(root, num_writers)
+
+  def test_restore(self):
+    # Test that a tree with repeated data is restored correctly, loading each
+    # of its containers only once
+    common = "kuku" * 1000
+    f1 = FSC.FSCFile(common)
+    file_data = {u"file1": f1, u"file2": FSC.FSCFile(common + "bebe"),
+        u"file3": f1, u"empty": FSC.FSCFile(""),
+        u"dir1": {u"file4": FSC.FSCFile("bebe" + common),
+          u"dir2": {u"file5": FSC.FSCFile(common)}}}
+    if FSC.supports_symbolic_links():
+      file_data[u"link"] = FSC.FSCSymlink(u"file1")
+    self.fsc.reset()
+    self.fsc.add_files(file_data)
+
+    planner = self.scan_and_restore(RestorePlanner.DEFAULT_WRITERS)
+    self.failUnless(self.fsc.test_files(file_data))
+    self.assertEqual(1, planner.num_containers)
+  def check_writers(self, num_writers):
+    # Check that the files are restored by the given number of writers, and
+    # that the stats of the directories are restored after their contents
+    file_data = {u"dir1": {}}
+    for i in range(20):
+      file_data[u"dir1"][u"file%d" % i] = FSC.FSCFile(os.urandom(3000 * i))
+    self.fsc.reset()
+    self.fsc.add_files(file_data)
+    dir_path = os.path.join(self.fsc.get_home(), u"dir1")
+    os.utime(os.path.join(dir_path, u"file1"), (1000000000, 1000000000))
+    os.utime(dir_path, (1100000000, 1100000000))
+    self.scan_and_restore(num_writers)
+    self.failUnless(self.fsc.test_files(file_data))
+    self.assertEqual(1000000000,
+        os.stat(os.path.join(dir_path, u"file1")).st_mtime)
+    self.assertEqual(1100000000, os.stat(dir_path).st_mtime)
+  def test_no_writers(self):
+    self.check_writers(0)
+  def test_writers(self):
+    self.check_writers(8)
+  def test_incremental(self):
+    # Test that an incremental restore rewrites only the files that differ
+    file_data = {u"file1": FSC.FSCFile("kuku"), u"file2": FSC.FSCFile("bebe"),
+        u"dir1": {u"file3": FSC.FSCFile("kiki")}}
+    self.fsc.reset()
+    self.fsc.add_files(file_data)
+    root = self.scan()
+    home = self.fsc.get_home()
+    # An unchanged file, a file with changed data but the same stats, and a
+    # missing file
+    witness = os.path.join(Config.paths.temp_area(), "witness")
+    os.link(os.path.join(home, u"file1"), witness)
+    file2 = os.path.join(home, u"file2")
+    mtime = os.stat(file2).st_mtime
+    f = open(file2, "wb")
+    f.write("baba")
+    f.close()
+    os.utime(file2, (mtime, mtime))
+    os.unlink(os.path.join(home, u"dir1", u"file3"))
+
+    planner = self.restore(root, RestorePlanner.DEFAULT_WRITERS,
+        incremental=True)
+    self.assertEqual("baba", open(file2).read())
+    self.assertEqual(1, len(planner.files))
+    self.failUnless(os.path.samefile(os.path.join(home, u"file1"), witness))
+
+    planner = self.restore(root, RestorePlanner.DEFAULT_WRITERS,
+        incremental=True, compare_data=True)
+    self.failUnless(self.fsc.test_files(file_data))
+    self.assertEqual(1, len(planner.files))
+    self.failUnless(os.path.samefile(os.path.join(home, u"file1"), witness))
+  def test_restore_over_longer_file(self):
+    # Test that a file restored over a longer one keeps nothing of it
+    file_data = {u"file1": FSC.FSCFile("kuku"),
+        u"file2": FSC.FSCFile("bebe" * 1000)}
+    self.fsc.reset()
+    self.fsc.add_files(file_data)
+    root = self.scan()
+    for name in [u"file1", u"file2"]:
+      f = open(os.path.join(self.fsc.get_home(), name), "wb")
+      f.write("X" * 10000)
+      f.close()
+    self.restore(root, RestorePlanner.DEFAULT_WRITERS)
+    self.failUnless(self.fsc.test_files(file_data))
+  def test_restore_over_existing_tree(self):
+    # Test that a tree restored over an existing one, not incrementally,
+    # replaces its files, hard links and symlinks
+    file_data = {u"dir1": {u"file1": FSC.FSCFile("kuku"),
+      u"file2": FSC.FSCFile("bebe")}}
+    if FSC.supports_symbolic_links():
+      file_data[u"dir1"][u"link"] = FSC.FSCSymlink(u"file1")
+    self.fsc.reset()
+    self.fsc.add_files(file_data)
+    if FSC.supports_hard_links():
+      self.fsc.link(u"dir1/file1", u"dir1/hlink")
+      file_data[u"dir1"][u"hlink"] = FSC.FSCFile("kuku")
+    root = self.scan()
+    dir_path = os.path.join(self.fsc.get_home(), u"dir1")
+    for name in os.listdir(dir_path):
+      os.unlink(os.path.join(dir_path, name))
+      f = open(os.path.join(dir_path, name), "wb")
+      f.write("X" * 10000)
+      f.close()
+    self.restore(root, RestorePlanner.DEFAULT_WRITERS)
+    self.failUnless(self.fsc.test_files(file_data))
+    if FSC.supports_hard_links():
+      self.failUnless(self.fsc.test_link(u"dir1/file1", u"dir1/hlink"))
+
+  def test_failed_container(self):
+    # Test that the blocks of a container that fails to load are loaded from
+    # another storage that has it
+    file_data = {u"file1": FSC.FSCFile("kuku" * 1000),
+        u"dir1": {u"file2": FSC.FSCFile("bebe" * 1000)}}
+    self.fsc.reset()
+    self.fsc.add_files(file_data)
+    root = self.scan(mirror=True)
+    self.fsc.reset()
+    Storage.MemoryStorage.files[''] = {}
+    self.restore(root, RestorePlanner.DEFAULT_WRITERS)
+    self.failUnless(self.fsc.test_files(file_data))
+  def test_failed_directory(self):
+    # Test that a directory that can't be created is skipped, with its
+    # contents, and the rest of the tree is restored
+    file_data = {u"file1": FSC.FSCFile("kuku"),
+        u"dir1": {u"file2": FSC.FSCFile("bebe")}}
+    self.fsc.reset()
+    self.fsc.add_files(file_data)
+    root = self.scan()
+    self.fsc.reset()
+    # A file is in the way of the directory
+    f = open(os.path.join(self.fsc.get_home(), u"dir1"), "wb")
+    f.close()
+    self.restore(root, RestorePlanner.DEFAULT_WRITERS)
+    self.assertEqual("kuku",
+        open(os.path.join(self.fsc.get_home(), u"file1")).read())
+    self.failUnless(os.path.isfile(os.path.join(self.fsc.get_home(), u"dir1")))
+
+suite_RestorePlanner = unittest.TestLoader().loadTestsFromTestCase(TestRestorePlanner)
+if __name__ == "__main__":
+  unittest.TextTestRunner(verbosity=2).run(suite_RestorePlanner)
@@ -23,6 +23,7 @@ import manent.Container as Container
 import manent.Database as Database
 import manent.Storage as Storage
 import manent.utils.Digest as Digest
+import MockSFTPServer
 
 class TestStorage(unittest.TestCase):
   def setUp(self):
@@ -170,6 +171,157 @@ class TestStorage(unittest.TestCase):
     data_blocks = [b for b in handler.blocks if b[1] == Container.CODE_DATA]
     self.assertEqual(block_digest, data_blocks[0][0])
     storage.close()
+  def test_container_body_staged(self):
+    # Test that the body of a container is written to a staging file while it
+    # is dumped, and that the uploaded container has its header and body.
+    self.reset_storage_params("a")
+    storage = Storage.DirectoryStorage(self.storage_params)
+    storage.configure(self.CONFIGURATION, None)
+    seq_id = storage.create_sequence()
+    container = storage.create_container()
+    body_file = container.body_file
+    for i in range(20):
+      block = os.urandom(64 * 1024)
+      container.add_block(Digest.dataDigest(block), Container.CODE_DATA, block)
+    container.finish_dump()
+    body_size = body_file.tell()
+    self.assert_(body_size >= 20 * 64 * 1024)
+    header_size = container.header_file.tell()
+    container.upload()
+    self.assert_(body_file.closed)
+    file_name = Storage.encode_container_name(seq_id, 0,
+        Storage.CONTAINER_EXT)
+    self.assertEqual(header_size + body_size,
+        os.path.getsize(os.path.join(self.scratch_path, file_name)))
+    storage.close()
+  def test_container_size_configured(self):
+    self.reset_storage_params("a")
+    storage = Storage.DirectoryStorage(self.storage_params)
+    storage.configure(self.CONFIGURATION, None)
+    self.assertEqual(Storage.DEFAULT_CONTAINER_SIZE, storage.container_size())
+    storage.close()
+
+    self.reset_storage_params("b")
+    storage = Storage.DirectoryStorage(self.storage_params)
+    configuration = dict(self.CONFIGURATION)
+    configuration["container_size"] = "64M"
+    storage.configure(configuration, None)
+    self.assertEqual(64 << 20, storage.container_size())
+    storage.close()
+  def test_compression_adaptive_configured(self):
+    # Test that adaptive compression is used only if configured
+    self.reset_storage_params("a")
+    storage = Storage.DirectoryStorage(self.storage_params)
+    storage.configure(self.CONFIGURATION, None)
+    self.failIf(storage.is_compression_adaptive())
+    storage.close()
+
+    self.reset_storage_params("b")
+    storage = Storage.DirectoryStorage(self.storage_params)
+    configuration = dict(self.CONFIGURATION)
+    configuration["adaptive_compression"] = "true"
+    storage.configure(configuration, None)
+    self.failUnless(storage.is_compression_adaptive())
+    storage.close()
+  def test_container_size_adaptive(self):
+    # Test that the container size follows the upload speed toward the
+    # target upload time, and that the tuned size is remembered.
+    self.reset_storage_params("a")
+    storage = Storage.DirectoryStorage(self.storage_params)
+    configuration = dict(self.CONFIGURATION)
+    configuration["container_upload_time"] = "10"
+    storage.configure(configuration, None)
+    seq_id = storage.create_sequence()
+    # Uploading at 4MB/s, 10 seconds is 40MB.
+    for i in range(20):
+      size = storage.container_size()
+      storage.report_upload_container_start(seq_id, i, size)
+      storage.report_upload_container_done(seq_id, i, size / float(4 << 20))
+    self.assert_(abs(storage.container_size() - (40 << 20)) < (1 << 20))
+    # A very fast link doesn't take the size beyond the limit
+    for i in range(20):
+      size = storage.container_size()
+      storage.report_upload_container_start(seq_id, i, size)
+      storage.report_upload_container_done(seq_id, i, 0.001)
+    self.assertEqual(Storage.MAX_CONTAINER_SIZE, storage.container_size())
+    storage.flush()
+    storage.close()
+
+    self.reset_storage_params("a")
+    storage = Storage.DirectoryStorage(self.storage_params)
+    storage.load_configuration(None)
+    self.assertEqual(Storage.MAX_CONTAINER_SIZE, storage.container_size())
+    storage.close()
+  def test_container_cache(self):
+    # Test that a container downloaded from a remote storage is kept in the
+    # cache, and that its ranges are then read from the cache.
+    server = MockSFTPServer.MockSFTPServer(self.scratch_path)
+    self.reset_storage_params("a")
+    storage = Storage.FTPStorage(self.storage_params,
+        Storage.RemoteFSHandler.SFTPHandler)
+    configuration = {"host": server.get_host(), "user": MockSFTPServer.USER,
+        "password": MockSFTPServer.PASSWORD, "path": "/",
+        "encryption_key": "kuku", "container_cache_size": "16M"}
+    storage.configure(configuration, None)
+    seq_id = storage.create_sequence()
+    container = storage.create_container()
+    block = os.urandom(64 * 1024)
+    container.add_block(Digest.dataDigest(block), Container.CODE_DATA, block)
+    container.finish_dump()
+    container.upload()
+    file_name = Storage.encode_container_name(seq_id, 0,
+        Storage.CONTAINER_EXT)
+    body = storage.load_body_file(seq_id, 0).read()
+    # Now that the container is cached, the remote file is not needed.
+    os.unlink(os.path.join(self.scratch_path, file_name))
+    self.assertEqual(body, storage.load_body_file(seq_id, 0).read())
+    self.assertEqual(body[100:1100],
+        storage.load_body_range(seq_id, 0, 100, 1000))
+    os.unlink(os.path.join(storage.get_container_cache().path, file_name))
+    storage.close()
+  def test_container_cache_ranges(self):
+    # Test that a container whose blocks are loaded repeatedly is downloaded
+    # into the cache, and that its next loads read it from the cache.
+    server = MockSFTPServer.MockSFTPServer(self.scratch_path)
+    self.reset_storage_params("a")
+    storage = Storage.FTPStorage(self.storage_params,
+        Storage.RemoteFSHandler.SFTPHandler)
+    configuration = {"host": server.get_host(), "user": MockSFTPServer.USER,
+        "password": MockSFTPServer.PASSWORD, "path": "/",
+        "encryption_key": "kuku", "container_cache_size": "16M",
+        "compression": "store"}
+    storage.configure(configuration, None)
+    seq_id = storage.create_sequence()
+    container = storage.create_container()
+    blocks = [os.urandom(64 * 1024) for i in range(4)]
+    for block in blocks:
+      container.add_block(Digest.dataDigest(block), Container.CODE_DATA, block)
+    container.finish_dump()
+    container.upload()
+    file_name = Storage.encode_container_name(seq_id, 0,
+        Storage.CONTAINER_EXT)
+    handler = storage.get_fs_handler()
+    ranges = []
+    def download_range(file_name, offset, size):
+      ranges.append((offset, size))
+      return handler.__class__.download_range(handler, file_name, offset, size)
+    handler.download_range = download_range
+    def load_block():
+      collector = Storage.BlockCollector([Digest.dataDigest(blocks[0])])
+      storage.get_container(seq_id, 0).load_blocks(collector)
+      self.assertEqual([blocks[0]], [data for (digest, code, data)
+        in collector.blocks])
+    for i in range(Storage.CACHED_RANGE_MISSES):
+      load_block()
+    cached_file = storage.get_container_cache().get(file_name)
+    self.failIf(cached_file is None)
+    cached_file.close()
+    # Now that the container is cached, it is not downloaded anymore.
+    num_ranges = len(ranges)
+    load_block()
+    self.assertEqual(num_ranges, len(ranges))
+    os.unlink(os.path.join(storage.get_container_cache().path, file_name))
+    storage.close()
   def test_new_containers_visible(self):
     # Test that the new containers appearing in all the sequences are visible
     # Create two storages at the same place
@@ -212,6 +364,9 @@ class TestStorage(unittest.TestCase):
         return False
       def loaded(self, digest, code, data):
         pass
+    # New sequences are found only by a full listing of the storage
+    storage1.request_full_listing()
+    storage2.request_full_listing()
     handler1 = Handler()
     storage1.load_sequences(handler1)
     self.assertEqual(c2s, sorted(handler1.containers))
@@ -220,6 +375,86 @@ class TestStorage(unittest.TestCase):
     self.assertEqual(c1s, sorted(handler2.containers))
     storage1.close()
     storage2.close()
+  def test_new_containers_loaded_in_order(self):
+    # Test that the new containers downloaded by several workers are passed
+    # to the block handler in order
+    self.reset_storage_params("a")
+    storage1 = Storage.DirectoryStorage(self.storage_params)
+    storage1.configure(self.CONFIGURATION, None)
+    seq_id1 = storage1.create_sequence()
+    blocks = []
+    for i in range(12):
+      c = storage1.create_container()
+      for j in range(3):
+        block = "block%d.%d" % (i, j) + os.urandom(1000)
+        blocks.append((i, block))
+        c.add_block(Digest.dataDigest(block), Container.CODE_DIR, block)
+      c.finish_dump()
+      c.upload()
+    storage1.close()
+    class Handler:
+      def __init__(self):
+        self.loaded_blocks = []
+      def is_requested(self, sequence_id, container_idx, digest, code):
+        return code == Container.CODE_DIR
+      def loaded(self, sequence_id, digest, code, data):
+        self.loaded_blocks.append(data)
+    self.reset_storage_params("b")
+    storage2 = Storage.DirectoryStorage(self.storage_params)
+    configuration = dict(self.CONFIGURATION)
+    configuration["download_workers"] = "3"
+    handler = Handler()
+    storage2.configure(configuration, handler)
+    # The summary containers are read first, the rest in order.
+    summary = [3, 7, 11]
+    expected = [block for (c, block) in blocks if c not in summary]
+    self.assertEqual(expected, handler.loaded_blocks[-len(expected):])
+    self.assertEqual(set([block for (c, block) in blocks]),
+        set(handler.loaded_blocks))
+    storage2.close()
+  def test_new_containers_probed(self):
+    # Test that after a recent listing, the new containers of a known
+    # sequence are found without listing the storage again
+    self.reset_storage_params("a")
+    storage1 = Storage.DirectoryStorage(self.storage_params)
+    storage1.configure(self.CONFIGURATION, None)
+    seq_id1 = storage1.create_sequence()
+    self.reset_storage_params("b")
+    storage2 = Storage.DirectoryStorage(self.storage_params)
+    storage2.configure(self.CONFIGURATION, None)
+    # Container 1 is skipped, as it happens before a summary container
+    for i in range(8):
+      c = storage1.create_container()
+      if i == 1:
+        continue
+      c.add_block(Digest.dataDigest("block%d" % i),
+          Container.CODE_DATA, "block%d" % i)
+      c.finish_dump()
+      c.upload()
+    class Handler:
+      def __init__(self):
+        self.containers = set()
+      def is_requested(self, sequence_id, container_idx, digest, code):
+        self.containers.add(container_idx)
+        return False
+    storage2.request_full_listing()
+    storage2.load_sequences(Handler())
+    self.assertEqual(8, storage2.sequence_next_container[seq_id1])
+    for i in range(8, 16):
+      c = storage1.create_container()
+      c.add_block(Digest.dataDigest("block%d" % i),
+          Container.CODE_DATA, "block%d" % i)
+      c.finish_dump()
+      c.upload()
+    def fail_listing():
+      raise Exception("The storage must not be listed")
+    storage2.list_container_files = fail_listing
+    handler = Handler()
+    storage2.load_sequences(handler)
+    self.assertEqual(16, storage2.sequence_next_container[seq_id1])
+    self.assertEqual(set(range(8, 16)), handler.containers)
+    storage1.close()
+    storage2.close()
   def test_new_containers_in_active_sequence_caught(self):
     # Test that if new containers appear unexpectedly in the active sequence,
     # it is actually discovered.
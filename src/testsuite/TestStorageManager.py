@@ -17,12 +17,14 @@ import unittest
 sys.path.append(os.path.join(sys.path[0], ".."))
 
 import manent.BlockManager as BlockManager
+import manent.CompletedNodesDB as CompletedNodesDB
 import manent.Config as Config
 import manent.Container as Container
 import manent.Database as Database
 import manent.Storage as Storage
 import manent.StorageManager as StorageManager
 import manent.utils.Digest as Digest
+import manent.utils.ThreadPool as ThreadPool
 
 class TestStorageManager(unittest.TestCase):
   def setUp(self):
@@ -170,6 +172,301 @@ class TestStorageManager(unittest.TestCase):
     self.assertEqual({(block_digest, Container.CODE_DATA): block},
       handler.blocks)
     storage_manager.close()
+  def test_full_listing(self):
+    # Test that a new sequence written by another client is found when the
+    # storages are loaded with a full listing, even if they were listed
+    # recently
+    storage_manager = StorageManager.StorageManager(self.env, self.txn)
+    storage_manager.load_storages()
+    storage_index = storage_manager.add_storage(
+      {'type': '__mock__', 'encryption_key': 'kuku', 'key': 'a'})
+    storage_manager.make_active_storage(storage_index)
+    storage_manager.close()
+    # Another client writes to the same storage
+    env = Database.PrivateDatabaseManager()
+    txn = Database.TransactionHandler(env)
+    other_manager = StorageManager.StorageManager(env, txn)
+    other_manager.load_storages()
+    other_index = other_manager.add_storage(
+      {'type': '__mock__', 'encryption_key': 'kuku', 'key': 'a'})
+    other_manager.make_active_storage(other_index)
+    block = "some strange text"
+    other_manager.add_block(Digest.dataDigest(block), Container.CODE_DATA,
+        block)
+    other_manager.flush()
+    sequence_id = other_manager.get_active_sequence_id()
+    other_manager.close()
+    txn.commit()
+    env.close()
+
+    storage_manager = StorageManager.StorageManager(self.env, self.txn)
+    storage_manager.load_storages()
+    self.failIf(storage_manager.seq_to_index.has_key(sequence_id))
+    storage_manager.close()
+    storage_manager = StorageManager.StorageManager(self.env, self.txn)
+    storage_manager.load_storages(full_listing=True)
+    self.failUnless(storage_manager.seq_to_index.has_key(sequence_id))
+    self.assertEqual(block,
+        storage_manager.load_block(Digest.dataDigest(block)))
+    storage_manager.close()
+  def test_mirror_storage(self):
+    # Test that the containers written to the active storage are copied to the
+    # mirror storage, also after the storage manager is reloaded
+    storage_manager = StorageManager.StorageManager(self.env, self.txn)
+    storage_manager.load_storages()
+    active_index = storage_manager.add_storage(
+      {'type': '__mock__', 'encryption_key': 'kuku', 'key': 'a'})
+    storage_manager.make_active_storage(active_index)
+    mirror_index = storage_manager.add_storage(
+      {'type': '__mock__', 'encryption_key': 'kuku', 'key': 'b'})
+    storage_manager.make_mirror_storage(mirror_index)
+    other_index = storage_manager.add_storage(
+      {'type': '__mock__', 'encryption_key': 'kiki', 'key': 'c'})
+    self.assertRaises(Exception,
+        storage_manager.make_mirror_storage, other_index)
+    block = "some strange text"
+    storage_manager.add_block(Digest.dataDigest(block), Container.CODE_DATA,
+        block)
+    storage_manager.flush()
+    self.assertNotEqual({}, Storage.MemoryStorage.files['a'])
+    self.assertEqual(Storage.MemoryStorage.files['a'],
+        Storage.MemoryStorage.files['b'])
+    storage_manager.close()
+
+    storage_manager = StorageManager.StorageManager(self.env, self.txn)
+    storage_manager.load_storages()
+    self.assertEqual(active_index, storage_manager.get_active_storage_index())
+    self.assertEqual([mirror_index],
+        storage_manager.get_mirror_storage_indices())
+    num_files = len(Storage.MemoryStorage.files['a'])
+    block = "some other strange text"
+    storage_manager.add_block(Digest.dataDigest(block), Container.CODE_DATA,
+        block)
+    storage_manager.flush()
+    self.assert_(len(Storage.MemoryStorage.files['a']) > num_files)
+    self.assertEqual(Storage.MemoryStorage.files['a'],
+        Storage.MemoryStorage.files['b'])
+    storage_manager.close()
+  def test_mirror_storage_failure(self):
+    # Test that a failed upload to a mirror doesn't fail the backup, and that
+    # the mirror doesn't get new containers after it
+    storage_manager = StorageManager.StorageManager(self.env, self.txn)
+    storage_manager.load_storages()
+    active_index = storage_manager.add_storage(
+      {'type': '__mock__', 'encryption_key': 'kuku', 'key': 'a'})
+    storage_manager.make_active_storage(active_index)
+    mirror_index = storage_manager.add_storage(
+      {'type': '__mock__', 'encryption_key': 'kuku', 'key': 'b'})
+    storage_manager.make_mirror_storage(mirror_index)
+    mirror = storage_manager.storages[mirror_index]
+    next_index = mirror.get_next_index()
+    def upload_container(sequence_id, index, header_file, body_file):
+      raise Exception("Upload failed")
+    mirror.upload_container = upload_container
+    block = "some strange text"
+    storage_manager.add_block(Digest.dataDigest(block), Container.CODE_DATA,
+        block)
+    storage_manager.flush()
+    self.failUnless(mirror.is_lagging())
+    self.assertEqual(next_index, mirror.get_next_index())
+    self.assertEqual([], storage_manager.get_mirror_storages())
+    del mirror.upload_container
+    storage_manager.close()
+
+    storage_manager = StorageManager.StorageManager(self.env, self.txn)
+    storage_manager.load_storages()
+    block = "some other strange text"
+    storage_manager.add_block(Digest.dataDigest(block), Container.CODE_DATA,
+        block)
+    storage_manager.flush()
+    self.assertNotEqual({}, Storage.MemoryStorage.files['a'])
+    self.assertEqual({}, Storage.MemoryStorage.files.get('b', {}))
+    self.assertEqual(block,
+        storage_manager.load_block(Digest.dataDigest(block)))
+    storage_manager.close()
+  def test_block_sources(self):
+    # Test that a block stored in several storages is loaded from the fastest
+    # one, and from another one when that one fails
+    storage_manager = StorageManager.StorageManager(self.env, self.txn)
+    storage_manager.load_storages()
+    active_index = storage_manager.add_storage(
+      {'type': '__mock__', 'encryption_key': 'kuku', 'key': 'a'})
+    storage_manager.make_active_storage(active_index)
+    mirror_index = storage_manager.add_storage(
+      {'type': '__mock__', 'encryption_key': 'kuku', 'key': 'b'})
+    storage_manager.make_mirror_storage(mirror_index)
+    block = "some strange text"
+    block_digest = Digest.dataDigest(block)
+    storage_manager.add_block(block_digest, Container.CODE_DATA, block)
+    storage_manager.flush()
+    storage_manager.close()
+
+    storage_manager = StorageManager.StorageManager(self.env, self.txn)
+    storage_manager.load_storages()
+    active_storage = storage_manager.storages[active_index]
+    mirror_storage = storage_manager.storages[mirror_index]
+    active_storage.record_load(1.0, 1 << 20, 10.0)
+    mirror_storage.record_load(0.01, 1 << 20, 0.1)
+    self.assertEqual([mirror_storage, active_storage],
+        [s for s, seq, idx in storage_manager.get_block_sources(block_digest)])
+    # Break the mirror storage
+    Storage.MemoryStorage.files['b'] = {}
+    self.assertEqual(block, storage_manager.load_block(block_digest))
+    self.assertEqual([active_storage, mirror_storage],
+        [s for s, seq, idx in storage_manager.get_block_sources(block_digest)])
+    storage_manager.close()
+  def test_prefetch_blocks(self):
+    # Test that a prefetched block is loaded by the download pool, and handed
+    # over when it is requested
+    storage_manager = StorageManager.StorageManager(self.env, self.txn)
+    storage_manager.load_storages()
+    storage_index = storage_manager.add_storage(
+      {'type': '__mock__', 'encryption_key': 'kuku', 'key': 'a'})
+    storage_manager.make_active_storage(storage_index)
+    blocks = ["block %d" % i for i in range(10)]
+    for block in blocks:
+      storage_manager.add_block(Digest.dataDigest(block), Container.CODE_DATA,
+          block)
+    storage_manager.flush()
+    storage_manager.close()
+
+    storage_manager = StorageManager.StorageManager(self.env, self.txn)
+    storage_manager.load_storages()
+    digests = [Digest.dataDigest(block) for block in blocks]
+    readahead_size = StorageManager.LOAD_READAHEAD_SIZE
+    # The readahead of every block is the block itself, so all the blocks
+    # must be requested from the container
+    StorageManager.LOAD_READAHEAD_SIZE = 1
+    try:
+      storage_manager.prefetch_blocks(digests)
+      # All the blocks are in the same container
+      self.assertEqual(1, len(storage_manager.prefetch_tasks))
+      for tasks in storage_manager.prefetch_tasks.values():
+        for storage, request, task in tasks:
+          task.result()
+    finally:
+      StorageManager.LOAD_READAHEAD_SIZE = readahead_size
+    # The storage is not needed anymore
+    Storage.MemoryStorage.files['a'] = {}
+    for block in blocks:
+      self.assertEqual(block,
+          storage_manager.load_block(Digest.dataDigest(block)))
+    self.assertEqual({}, storage_manager.prefetch_tasks)
+    self.assertEqual({}, storage_manager.prefetch_containers)
+    storage_manager.close()
+  def test_load_sparse_container(self):
+    # Test that only the readahead of a container is loaded while little of it
+    # is requested, and the whole body once much of it is
+    storage_manager = StorageManager.StorageManager(self.env, self.txn)
+    storage_manager.load_storages()
+    storage_index = storage_manager.add_storage(
+      {'type': '__mock__', 'encryption_key': 'kuku', 'key': 'a'})
+    storage_manager.make_active_storage(storage_index)
+    storage_manager.storages[storage_index].set_container_size(2 << 20)
+    blocks = [os.urandom(4096) for i in range(256)]
+    for block in blocks:
+      storage_manager.add_block(Digest.dataDigest(block), Container.CODE_DATA,
+          block)
+    storage_manager.flush()
+    storage_manager.close()
+
+    storage_manager = StorageManager.StorageManager(self.env, self.txn)
+    storage_manager.load_storages()
+    storage = storage_manager.storages[storage_index]
+    body_loads = []
+    def load_body_file(sequence_id, index):
+      body_loads.append(index)
+      return Storage.MemoryStorage.load_body_file(storage, sequence_id, index)
+    storage.load_body_file = load_body_file
+    readahead_size = StorageManager.LOAD_READAHEAD_SIZE
+    # Every readahead is a single block
+    StorageManager.LOAD_READAHEAD_SIZE = 4096
+    try:
+      self.assertEqual(blocks[0],
+          storage_manager.load_block(Digest.dataDigest(blocks[0])))
+      self.assertEqual([], body_loads)
+      for block in blocks:
+        self.assertEqual(block,
+            storage_manager.load_block(Digest.dataDigest(block)))
+    finally:
+      StorageManager.LOAD_READAHEAD_SIZE = readahead_size
+    self.assertEqual(1, len(body_loads))
+    storage_manager.close()
+  def test_interrupted_upload(self):
+    # Test that a container uploaded by a backup that was interrupted before
+    # committing is adopted when the storage is loaded again
+    storage_manager = StorageManager.StorageManager(self.env, self.txn)
+    storage_manager.load_storages()
+    storage_index = storage_manager.add_storage(
+      {'type': '__mock__', 'encryption_key': 'kuku', 'key': 'a'})
+    storage_manager.make_active_storage(storage_index)
+    storage_manager.add_block(Digest.dataDigest("first"), Container.CODE_DATA,
+        "first")
+    storage_manager.flush()
+    next_index = storage_manager.storages[storage_index].get_next_index()
+    # Fill containers until one is uploaded in the background
+    sequencer = storage_manager.block_sequencer
+    while sequencer.pending_uploads == []:
+      block = os.urandom(64 << 10)
+      storage_manager.add_block(Digest.dataDigest(block), Container.CODE_DATA,
+          block)
+    container, task = sequencer.pending_uploads[0]
+    task.result()
+    self.assertEqual(next_index, container.get_index())
+    # Interrupt the backup. The index of the uploaded container is rolled back
+    # explicitly too, as the aborted transaction does.
+    self.txn.abort()
+    storage_manager.storages[storage_index].set_next_index(next_index)
+    storage_manager.close()
+    self.txn.abort()
+
+    storage_manager = StorageManager.StorageManager(self.env, self.txn)
+    storage_manager.load_storages()
+    storage = storage_manager.storages[storage_index]
+    self.failUnless(next_index < storage.get_next_index())
+    storage_manager.add_block(Digest.dataDigest("second"), Container.CODE_DATA,
+        "second")
+    storage_manager.flush()
+    self.assertEqual("second",
+        storage_manager.load_block(Digest.dataDigest("second")))
+    storage_manager.close()
+  def test_failed_pending_upload(self):
+    # Test that if one of the pending uploads fails, nothing of the containers
+    # written with it is committed
+    storage_manager = StorageManager.StorageManager(self.env, self.txn)
+    storage_manager.load_storages()
+    storage_index = storage_manager.add_storage(
+      {'type': '__mock__', 'encryption_key': 'kuku', 'key': 'a'})
+    storage_manager.make_active_storage(storage_index)
+    storage = storage_manager.storages[storage_index]
+    completed_nodes = CompletedNodesDB.CompletedNodesDB(self.env, self.txn)
+    completed_nodes["before"] = "1"
+    storage_manager.add_block(Digest.dataDigest("first"), Container.CODE_DATA,
+        "first")
+    storage_manager.flush()
+    committed_indices = []
+    def record_commit():
+      committed_indices.append(storage.get_next_index())
+    self.txn.add_precommit_hook(record_commit)
+
+    completed_nodes["after"] = "1"
+    sequencer = storage_manager.block_sequencer
+    while len(sequencer.pending_uploads) < 2:
+      block = os.urandom(64 << 10)
+      storage_manager.add_block(Digest.dataDigest(block), Container.CODE_DATA,
+          block)
+    def fail_upload():
+      raise Exception("upload failed")
+    container, task = sequencer.pending_uploads[1]
+    sequencer.pending_uploads[1] = (container,
+        ThreadPool.ThreadPool(0).submit(fail_upload))
+    self.assertRaises(Exception, sequencer.wait_uploads)
+    # The last commit is still the one of the flush
+    self.assertEqual([], committed_indices)
+    self.failUnless(completed_nodes.completed_nodes_db.has_key("before"))
+    self.failIf(completed_nodes.completed_nodes_db.has_key("after"))
+    self.txn.remove_precommit_hook(record_commit)
+    completed_nodes.close()
 
 suite_StorageManager = unittest.TestLoader().loadTestsFromTestCase(TestStorageManager)
 if __name__ == "__main__":